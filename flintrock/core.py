@@ -1,19 +1,40 @@
 import concurrent.futures
+import difflib
 import functools
+import hashlib
+import heapq
 import json
+import mmap
 import os
 import posixpath
+import queue
+import re
 import shlex
 import sys
+import tarfile
+import threading
+import time
 import logging
+import uuid
+import zlib
+from collections import namedtuple
 from concurrent.futures import FIRST_EXCEPTION
+from datetime import datetime
 
 # External modules
 import paramiko
 
 # Flintrock modules
-from .ssh import get_ssh_client, ssh_check_output, ssh, SSHKeyPair
-from .exceptions import SSHError
+from .ssh import (
+    get_ssh_client,
+    ssh_check_output,
+    ssh_check_output_with_input,
+    ssh,
+    SSHKeyPair,
+    upload_file,
+)
+from .exceptions import Error, SSHError
+from .util import get_file_sha256
 
 FROZEN = getattr(sys, 'frozen', False)
 
@@ -24,6 +45,52 @@ else:
 
 SCRIPTS_DIR = os.path.join(THIS_DIR, 'scripts')
 
+INTRA_CLUSTER_SSH_OPTIONS = '-o StrictHostKeyChecking=no -o BatchMode=yes -o ConnectTimeout=5'
+
+CommandResult = namedtuple('CommandResult', ['exit_status', 'output'])
+# How much of each differing output to show in the run-command summary.
+COMMAND_SUMMARY_MAX_DIFF_LINES = 20
+COMMAND_SUMMARY_MAX_HOSTS = 10
+# How many nodes the master runs a relayed command on at once.
+RELAY_COMMAND_PARALLELISM = 64
+# run-command scripts are kept on the nodes under their SHA-256 digest.
+SCRIPT_REMOTE_PATH_TEMPLATE = '/tmp/flintrock-script-{sha256}.sh'
+
+# Detached run-command jobs keep their state on each node under this directory.
+JOBS_DIR = '.flintrock-jobs'
+JOB_STATUS_PARALLELISM = 32
+JobStatus = namedtuple('JobStatus', ['state', 'exit_status', 'output_size'])
+
+# Lists a node's instance store volumes, one per line. Nodes of different
+# instance types have different volumes, so each node has to be asked.
+LIST_EPHEMERAL_DIRS_COMMAND = 'shopt -s nullglob; for f in /media/ephemeral*; do echo "$f"; done'
+
+# The hardware of a single node. A cluster's master and slaves may be of
+# different instance types.
+NodeResources = namedtuple('NodeResources', ['cores', 'memory_mb', 'ephemeral_dirs'])
+
+LOG_PATHS = {
+    'spark': ['spark/logs/*.out'],
+    'hdfs': ['hadoop/logs/*.log'],
+}
+# Spark logs timestamps like 20/05/12 14:03:01, and Hadoop like
+# 2020-05-12 14:03:01,234.
+LOG_TIMESTAMP_FORMATS = [
+    (re.compile(r'^\d{2}/\d{2}/\d{2} \d{2}:\d{2}:\d{2}'), '%y/%m/%d %H:%M:%S'),
+    (re.compile(r'^\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}'), '%Y-%m-%d %H:%M:%S'),
+]
+# When following logs, hold lines back for this long so that lines arriving
+# from different nodes at about the same time can be put in order.
+LOG_REORDER_SECONDS = 1
+
+# Changed files at least this big are sent as deltas against the remote copy.
+SYNC_DELTA_MIN_SIZE = 1024 * 1024
+SYNC_MIN_BLOCK_SIZE = 4 * 1024
+SYNC_MAX_BLOCK_SIZE = 128 * 1024
+# If a delta would need more literal data than this, or more than half the
+# file, just send the whole file.
+SYNC_MAX_LITERAL_BYTES = 16 * 1024 * 1024
+
 
 logger = logging.getLogger('flintrock.core')
 
@@ -342,26 +409,260 @@ class FlintrockCluster:
             master_only: bool,
             user: str,
             identity_file: str,
-            command: tuple):
+            command: tuple,
+            compress: bool=False,
+            stream_output: bool=True,
+            output_dir: str=None,
+            relay: bool=False,
+            script: str=None):
         """
         Run a shell command on each node of an existing cluster.
 
         If master_only is True, then run the comand on the master only.
+
+        If script is set, then upload that local script to each node and run
+        it with command as its arguments. The script can tell which node it
+        is running on from the variables generate_node_environments() sets.
+        Nodes that already have the same script don't get it again.
+
+        If compress is True, then compress the connections, which helps
+        with commands that produce a lot of output.
+
+        If relay is True, then send the command once to the master and have it
+        run the command on every node over the intra-cluster network. This
+        keeps us to a single connection however big the cluster is.
+
+        Each node's output is printed as it arrives if stream_output is True,
+        and written to output_dir/<host>.log if output_dir is set. Once the
+        command finishes everywhere, a summary groups the nodes by exit status
+        and output. Raise an error if the command failed on any node.
         """
         if master_only:
             target_hosts = [self.master_ip]
         else:
             target_hosts = [self.master_ip] + self.slave_ips
 
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+
+        environments = None
+        if script:
+            self.load_manifest(user=user, identity_file=identity_file)
+            environments = generate_node_environments(cluster=self)
+            sha256 = get_file_sha256(script)
+            script_path = SCRIPT_REMOTE_PATH_TEMPLATE.format(sha256=sha256)
+
+            if relay and not master_only:
+                upload_script_node(
+                    user=user,
+                    host=self.master_ip,
+                    identity_file=identity_file,
+                    local_path=script,
+                    remote_path=script_path,
+                    sha256=sha256)
+
+                master_ssh_client = get_ssh_client(
+                    user=user,
+                    host=self.master_ip,
+                    identity_file=identity_file)
+
+                with master_ssh_client:
+                    broadcast_file(
+                        ssh_client=master_ssh_client,
+                        path=script_path,
+                        sha256=sha256,
+                        hosts=[self.master_private_host] + self.slave_private_hosts)
+            else:
+                partial_func = functools.partial(
+                    upload_script_node,
+                    user=user,
+                    identity_file=identity_file,
+                    local_path=script,
+                    remote_path=script_path,
+                    sha256=sha256)
+
+                run_against_hosts(partial_func=partial_func, hosts=target_hosts)
+
+            command = get_script_command(script_path=script_path, args=command)
+
+        if relay and not master_only:
+            master_ssh_client = get_ssh_client(
+                user=user,
+                host=self.master_ip,
+                identity_file=identity_file,
+                compress=compress)
+
+            with master_ssh_client:
+                results = relay_command(
+                    ssh_client=master_ssh_client,
+                    command=command,
+                    hosts=list(zip(
+                        target_hosts,
+                        [self.master_private_host] + self.slave_private_hosts)),
+                    stream_output=stream_output,
+                    output_dir=output_dir,
+                    environments=environments)
+        else:
+            partial_func = functools.partial(
+                run_command_node,
+                user=user,
+                identity_file=identity_file,
+                command=command,
+                compress=compress,
+                stream_output=stream_output,
+                output_dir=output_dir,
+                environments=environments)
+            hosts = target_hosts
+
+            results = run_against_hosts(partial_func=partial_func, hosts=hosts)
+
+        if len(results) > 1:
+            print(format_command_summary(group_command_results(results)))
+
+        failed_hosts = sorted(host for host, result in results.items() if result.exit_status)
+        if failed_hosts:
+            raise Error(
+                "Command failed on {n} of {t} nodes."
+                .format(n=len(failed_hosts), t=len(results)))
+
+    def start_job(
+            self,
+            *,
+            master_only: bool,
+            user: str,
+            identity_file: str,
+            command: tuple) -> tuple:
+        """
+        Start a shell command in the background on each node of an existing
+        cluster, detached from our SSH sessions so that it survives them.
+
+        If master_only is True, then start the command on the master only.
+
+        Return the job's ID and a list of [ip, private host] pairs for the
+        nodes it runs on.
+        """
+        if master_only:
+            target_hosts = [[self.master_ip, self.master_private_host]]
+        else:
+            target_hosts = [
+                list(pair) for pair in zip(
+                    [self.master_ip] + self.slave_ips,
+                    [self.master_private_host] + self.slave_private_hosts)
+            ]
+
+        job_id = uuid.uuid4().hex[:12]
+
         partial_func = functools.partial(
-            run_command_node,
+            start_job_node,
             user=user,
             identity_file=identity_file,
+            job_id=job_id,
             command=command)
-        hosts = target_hosts
+        hosts = [ip for ip, private_host in target_hosts]
 
         run_against_hosts(partial_func=partial_func, hosts=hosts)
 
+        return (job_id, target_hosts)
+
+    def get_job_statuses(
+            self,
+            *,
+            user: str,
+            identity_file: str,
+            job_id: str,
+            private_hosts: list) -> dict:
+        """
+        Get the status of a detached job on each of the given nodes.
+
+        The master checks on all the nodes over the intra-cluster network, so
+        this takes a single SSH session from us no matter how big the cluster
+        is. Return a dict mapping each private host to a JobStatus, whose
+        state is one of running, done, lost (the job died without recording
+        an exit status), missing, or unreachable.
+        """
+        status_command = """
+            d={job_dir}
+            size=$(stat -c %s "$d/output" 2>/dev/null || echo 0)
+            if [ -f "$d/exit_status" ]; then
+                echo "done $(cat "$d/exit_status") $size"
+            elif [ -f "$d/pid" ] && kill -0 "$(cat "$d/pid")" 2>/dev/null; then
+                echo "running - $size"
+            elif [ -d "$d" ]; then
+                echo "lost - $size"
+            else
+                echo "missing - 0"
+            fi
+        """.format(job_dir=shlex.quote(posixpath.join(JOBS_DIR, job_id)))
+
+        commands = []
+        for batch_start in range(0, len(private_hosts), JOB_STATUS_PARALLELISM):
+            for private_host in private_hosts[batch_start:batch_start + JOB_STATUS_PARALLELISM]:
+                commands.append(
+                    '(status="$(ssh {ssh_opts} {h} {c} 2>/dev/null)" || status="unreachable - 0"; '
+                    'echo {h} $status) &'.format(
+                        ssh_opts=INTRA_CLUSTER_SSH_OPTIONS,
+                        h=shlex.quote(private_host),
+                        c=shlex.quote(status_command)))
+            commands.append('wait')
+
+        master_ssh_client = get_ssh_client(
+            user=user,
+            host=self.master_ip,
+            identity_file=identity_file)
+
+        with master_ssh_client:
+            output = ssh_check_output(
+                client=master_ssh_client,
+                command='\n'.join(commands))
+
+        statuses = {}
+        for line in output.splitlines():
+            private_host, state, exit_status, output_size = line.split()
+            statuses[private_host] = JobStatus(
+                state=state,
+                exit_status=None if exit_status == '-' else int(exit_status),
+                output_size=int(output_size))
+        return statuses
+
+    def fetch_job_output(
+            self,
+            *,
+            user: str,
+            identity_file: str,
+            job_id: str,
+            hosts: list,
+            local_dir: str) -> list:
+        """
+        Bring the local copy of a detached job's output from each of the given
+        nodes up to date, in local_dir/<host>.log.
+
+        Only the output added since the last fetch is transferred. A failure
+        on one node doesn't stop the others. Return the nodes that failed.
+        """
+        os.makedirs(local_dir, exist_ok=True)
+
+        partial_func = functools.partial(
+            fetch_job_output_node,
+            user=user,
+            identity_file=identity_file,
+            job_id=job_id,
+            local_dir=local_dir)
+
+        with concurrent.futures.ThreadPoolExecutor(len(hosts)) as executor:
+            futures = {
+                host: executor.submit(functools.partial(partial_func, host=host))
+                for host in hosts
+            }
+            failed_hosts = []
+            for host, future in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error("[{h}] Could not fetch job output: {e}".format(h=host, e=e))
+                    failed_hosts.append(host)
+
+        return failed_hosts
+
     def copy_file_check(self):
         """
         Check that the cluster is in a state in which files can be copied to
@@ -379,12 +680,50 @@ class FlintrockCluster:
             user: str,
             identity_file: str,
             local_path: str,
-            remote_path: str):
+            remote_path: str,
+            broadcast: bool=False,
+            compress: bool=False):
         """
         Copy a file to each node of an existing cluster.
 
         If master_only is True, then copy the file to the master only.
+
+        If broadcast is True, then upload the file once to the master and
+        relay it from node to node over the intra-cluster network, verifying
+        its checksum at each hop.
+
+        If remote_path is a directory, then the file is copied into it.
+
+        If compress is True, then compress uploads of files that look
+        compressible.
         """
+        sha256 = get_file_sha256(local_path)
+
+        if broadcast and not master_only:
+            # The relay works with file paths only, so it picks up wherever
+            # the file landed on the master.
+            remote_path = copy_file_node(
+                user=user,
+                host=self.master_ip,
+                identity_file=identity_file,
+                local_path=local_path,
+                remote_path=remote_path,
+                sha256=sha256,
+                compress=compress)
+
+            master_ssh_client = get_ssh_client(
+                user=user,
+                host=self.master_ip,
+                identity_file=identity_file)
+
+            with master_ssh_client:
+                broadcast_file(
+                    ssh_client=master_ssh_client,
+                    path=remote_path,
+                    sha256=sha256,
+                    hosts=[self.master_private_host] + self.slave_private_hosts)
+            return
+
         if master_only:
             target_hosts = [self.master_ip]
         else:
@@ -395,11 +734,270 @@ class FlintrockCluster:
             user=user,
             identity_file=identity_file,
             local_path=local_path,
-            remote_path=remote_path)
+            remote_path=remote_path,
+            sha256=sha256,
+            compress=compress)
+        hosts = target_hosts
+
+        run_against_hosts(partial_func=partial_func, hosts=hosts)
+
+    def sync_check(self):
+        """
+        Check that the cluster is in a state in which directories can be
+        synced to it.
+
+        Providers should override this method since we have no way to perform
+        this check in a provider-agnostic way.
+        """
+        pass
+
+    def sync(
+            self,
+            *,
+            master_only: bool,
+            user: str,
+            identity_file: str,
+            local_dir: str,
+            remote_dir: str,
+            compress: bool=False):
+        """
+        Sync a local directory to each node of an existing cluster, sending
+        only the files that are new or changed.
+
+        If master_only is True, then sync the directory to the master only.
+
+        If compress is True, then compress the connections.
+        """
+        if master_only:
+            target_hosts = [self.master_ip]
+        else:
+            target_hosts = [self.master_ip] + self.slave_ips
+
+        partial_func = functools.partial(
+            sync_node,
+            user=user,
+            identity_file=identity_file,
+            local_dir=local_dir,
+            remote_dir=remote_dir,
+            compress=compress)
         hosts = target_hosts
 
         run_against_hosts(partial_func=partial_func, hosts=hosts)
 
+    def fetch_check(self):
+        """
+        Check that the cluster is in a state in which files can be fetched from
+        it.
+
+        Providers should override this method since we have no way to perform
+        this check in a provider-agnostic way.
+        """
+        pass
+
+    def fetch(
+            self,
+            *,
+            master_only: bool,
+            user: str,
+            identity_file: str,
+            remote_glob: str,
+            local_dir: str,
+            max_parallel: int,
+            bandwidth_limit: int=None):
+        """
+        Fetch the files matching a glob from each node of an existing cluster
+        into a subdirectory of local_dir per node.
+
+        If master_only is True, then fetch from the master only.
+
+        At most max_parallel nodes are fetched from at once, and each of them
+        gets an equal share of bandwidth_limit, in bytes per second, if it is
+        set. A failure on one node doesn't stop the others. Once they are all
+        done, we raise an error listing the nodes that failed.
+        """
+        if master_only:
+            target_hosts = [self.master_ip]
+        else:
+            target_hosts = [self.master_ip] + self.slave_ips
+
+        num_parallel = min(max_parallel, len(target_hosts))
+        if bandwidth_limit:
+            bytes_per_second = bandwidth_limit // num_parallel
+        else:
+            bytes_per_second = None
+
+        partial_func = functools.partial(
+            fetch_node,
+            user=user,
+            identity_file=identity_file,
+            remote_glob=remote_glob,
+            local_dir=local_dir,
+            bytes_per_second=bytes_per_second)
+
+        with concurrent.futures.ThreadPoolExecutor(num_parallel) as executor:
+            futures = {
+                host: executor.submit(functools.partial(partial_func, host=host))
+                for host in target_hosts
+            }
+            failed_hosts = []
+            for host, future in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error("[{h}] Fetch failed: {e}".format(h=host, e=e))
+                    failed_hosts.append(host)
+
+        if failed_hosts:
+            raise Error(
+                "Could not fetch files from {n} of {t} nodes: {h}"
+                .format(
+                    n=len(failed_hosts),
+                    t=len(target_hosts),
+                    h=', '.join(failed_hosts)))
+
+    def logs_check(self):
+        """
+        Check that the cluster is in a state in which its logs can be read.
+
+        Providers should override this method since we have no way to perform
+        this check in a provider-agnostic way.
+        """
+        pass
+
+    def logs(
+            self,
+            *,
+            master_only: bool,
+            user: str,
+            identity_file: str,
+            services: list,
+            num_lines: int,
+            follow: bool,
+            grep: str=None):
+        """
+        Print the daemon logs from each node of an existing cluster as a single
+        stream ordered by time, with each line prefixed by its node and file.
+
+        Lines are filtered with grep on the nodes, so only matching lines
+        are sent back. If follow is True, then keep streaming new lines until
+        interrupted.
+        """
+        if master_only:
+            target_hosts = [self.master_ip]
+        else:
+            target_hosts = [self.master_ip] + self.slave_ips
+
+        command = get_log_tail_command(
+            paths=[path for service in services for path in LOG_PATHS[service]],
+            num_lines=num_lines,
+            follow=follow,
+            grep=grep)
+
+        log_queue = queue.Queue()
+        threads = []
+        for host in target_hosts:
+            thread = threading.Thread(
+                target=stream_logs_node,
+                kwargs={
+                    'user': user,
+                    'host': host,
+                    'identity_file': identity_file,
+                    'command': command,
+                    'log_queue': log_queue,
+                },
+                daemon=True)
+            thread.start()
+            threads.append(thread)
+
+        if follow:
+            print_followed_logs(log_queue=log_queue, num_hosts=len(target_hosts))
+        else:
+            for thread in threads:
+                thread.join()
+            log_lines = []
+            while not log_queue.empty():
+                item = log_queue.get()
+                if item[1] is not None:
+                    log_lines.append(item)
+            for host, file_name, line in merge_log_lines(log_lines):
+                print("[{h}:{f}] {l}".format(h=host, f=file_name, l=line))
+
+    def rebuild_spark_check(self):
+        """
+        Check that the cluster is in a state in which Spark can be rebuilt.
+
+        Providers should override this method since we have no way to perform
+        this check in a provider-agnostic way.
+        """
+        pass
+
+    def rebuild_spark(self, *, user: str, identity_file: str, git_commit: str):
+        """
+        Rebuild Spark at a new commit on a cluster that was launched with Spark
+        built from git, and redeploy it.
+
+        The build runs incrementally in the existing build tree on the master,
+        which is set up first if the cluster was launched from a cached build.
+        Only the jars that actually changed are pushed out to the slaves, over
+        the intra-cluster network, after which the Spark daemons are restarted.
+
+        This method assumes the cluster's manifest has already been loaded.
+        """
+        spark = next(
+            (service for service in self.services if isinstance(service, Spark)),
+            None)
+        if not spark or not spark.git_commit:
+            raise Error(
+                "Cluster {c} does not have Spark built from git. Only clusters "
+                "launched with a Spark git commit can be rebuilt."
+                .format(c=self.name))
+
+        master_ssh_client = get_ssh_client(
+            user=user,
+            host=self.master_ip,
+            identity_file=identity_file)
+
+        with master_ssh_client:
+            spark.rebuild(ssh_client=master_ssh_client, git_commit=git_commit)
+            build_jar_hashes = spark.get_jar_hashes(
+                ssh_client=master_ssh_client,
+                build=True)
+
+            partial_func = functools.partial(
+                get_spark_jar_hashes_node,
+                user=user,
+                identity_file=identity_file,
+                spark=spark)
+            node_jar_hashes = run_against_hosts(
+                partial_func=partial_func,
+                hosts=[self.master_ip] + self.slave_ips)
+
+            jar_updates = get_jar_updates(
+                build_jar_hashes=build_jar_hashes,
+                node_jar_hashes=node_jar_hashes,
+                private_hosts=dict(zip(
+                    [self.master_ip] + self.slave_ips,
+                    [self.master_private_host] + self.slave_private_hosts)))
+
+            logger.info(
+                "{n} of {t} nodes need updated jars.".format(
+                    n=len(jar_updates),
+                    t=len(node_jar_hashes)))
+
+            spark.distribute_jars(
+                ssh_client=master_ssh_client,
+                cluster=self,
+                jar_updates=jar_updates)
+            spark.restart_master(
+                ssh_client=master_ssh_client,
+                cluster=self)
+            write_manifest(
+                client=master_ssh_client,
+                services=self.services,
+                ssh_key_pair=self.ssh_key_pair)
+
+        spark.health_check(master_host=self.master_ip)
+
     def login(
             self,
             *,
@@ -422,21 +1020,26 @@ def generate_template_mapping(
     # name.
     spark_executor_instances: int,
     hadoop_version: str,
-    spark_version: str
+    spark_version: str,
+    node_resources: NodeResources
 ) -> dict:
     """
     Generate a template mapping from a FlintrockCluster instance that we can use
     to fill in template parameters.
+
+    The mapping is for the single node whose hardware is described by
+    node_resources, since nodes of different instance types need to be
+    configured differently.
     """
     hadoop_root_dir = posixpath.join(cluster.storage_dirs.root, 'hadoop')
     hadoop_ephemeral_dirs = ','.join(
         posixpath.join(path, 'hadoop')
-        for path in cluster.storage_dirs.ephemeral
+        for path in node_resources.ephemeral_dirs
     )
     spark_root_dir = posixpath.join(cluster.storage_dirs.root, 'spark')
     spark_ephemeral_dirs = ','.join(
         posixpath.join(path, 'spark')
-        for path in cluster.storage_dirs.ephemeral
+        for path in node_resources.ephemeral_dirs
     )
 
     template_mapping = {
@@ -453,6 +1056,10 @@ def generate_template_mapping(
         'spark_short_version': '.'.join(spark_version.split('.')[:2]) if '.' in spark_version else spark_version,
 
         'spark_executor_instances': spark_executor_instances,
+        'spark_executor_cores': max(node_resources.cores // spark_executor_instances, 1) if spark_executor_instances else node_resources.cores,
+        'spark_worker_cores': node_resources.cores,
+        # Leave 1 GiB for the OS, like Spark does by default.
+        'spark_worker_memory': '{m}m'.format(m=max(node_resources.memory_mb - 1024, 1024)),
 
         'hadoop_root_dir': hadoop_root_dir,
         'hadoop_ephemeral_dirs': hadoop_ephemeral_dirs,
@@ -470,6 +1077,71 @@ def generate_template_mapping(
     return template_mapping
 
 
+def get_node_resources(*, ssh_client: paramiko.client.SSHClient) -> NodeResources:
+    """
+    Get the hardware of the node we're connected to.
+    """
+    output = ssh_check_output(
+        client=ssh_client,
+        command="""
+            nproc
+            awk '/^MemTotal:/ {{ print int($2 / 1024) }}' /proc/meminfo
+            {l}
+        """.format(l=LIST_EPHEMERAL_DIRS_COMMAND))
+    cores, memory_mb, *ephemeral_dirs = output.splitlines()
+    return NodeResources(
+        cores=int(cores),
+        memory_mb=int(memory_mb),
+        ephemeral_dirs=sorted(ephemeral_dirs))
+
+
+def generate_node_environments(*, cluster: FlintrockCluster) -> dict:
+    """
+    Generate the environment variables that tell a run-command script which
+    node it is running on, keyed by host.
+
+    FLINTROCK_EPHEMERAL_DIRS isn't among them since it differs between
+    instance types. get_script_command() has each node fill it in itself.
+
+    The cluster's manifest must already be loaded.
+    """
+    hosts = [cluster.master_ip] + cluster.slave_ips
+    private_hosts = [cluster.master_private_host] + cluster.slave_private_hosts
+
+    return {
+        host: {
+            'FLINTROCK_ROLE': 'master' if index == 0 else 'slave',
+            'FLINTROCK_NODE_INDEX': str(index),
+            'FLINTROCK_NUM_NODES': str(len(hosts)),
+            'FLINTROCK_PRIVATE_HOST': private_host,
+            'FLINTROCK_MASTER_PRIVATE_HOST': cluster.master_private_host,
+            'FLINTROCK_ROOT_DIR': cluster.storage_dirs.root,
+        }
+        for index, (host, private_host) in enumerate(zip(hosts, private_hosts))
+    }
+
+
+def get_script_command(*, script_path: str, args: tuple) -> tuple:
+    """
+    Get the command that runs an uploaded run-command script with the given
+    arguments.
+    """
+    return (
+        'FLINTROCK_EPHEMERAL_DIRS="$({l} | paste -sd , -)"'.format(l=LIST_EPHEMERAL_DIRS_COMMAND),
+        'bash',
+        shlex.quote(script_path),
+    ) + tuple(shlex.quote(arg) for arg in args)
+
+
+def get_export_command(environment: dict) -> str:
+    """
+    Get a shell command that exports the given environment variables.
+    """
+    return 'export {v};'.format(v=' '.join(
+        '{k}={v}'.format(k=key, v=shlex.quote(value))
+        for key, value in sorted(environment.items())))
+
+
 # TODO: Cache these files. (?) They are being read potentially tens or
 #       hundreds of times. Maybe it doesn't matter because the files
 #       are so small.
@@ -484,15 +1156,15 @@ def run_against_hosts(*, partial_func: functools.partial, hosts: list):
     Run a function asynchronously against each of the provided hosts.
 
     This function assumes that partial_func accepts `host` as a keyword argument.
+    It returns a dict mapping each host to what partial_func returned for it.
     """
     with concurrent.futures.ThreadPoolExecutor(len(hosts)) as executor:
         futures = {
-            executor.submit(functools.partial(partial_func, host=host))
+            host: executor.submit(functools.partial(partial_func, host=host))
             for host in hosts
         }
-        concurrent.futures.wait(futures, return_when=FIRST_EXCEPTION)
-        for future in futures:
-            future.result()
+        concurrent.futures.wait(futures.values(), return_when=FIRST_EXCEPTION)
+        return {host: future.result() for host, future in futures.items()}
 
 
 def get_installed_java_version(client: paramiko.client.SSHClient):
@@ -693,20 +1365,10 @@ def provision_cluster(
         identity_file=identity_file)
 
     with master_ssh_client:
-        manifest = {
-            'services': [[type(m).__name__, m.manifest] for m in services],
-            'ssh_key_pair': cluster.ssh_key_pair._asdict(),
-        }
-        # The manifest tells us how the cluster is configured. We'll need this
-        # when we resize the cluster or restart it.
-        ssh_check_output(
+        write_manifest(
             client=master_ssh_client,
-            command="""
-                echo {m} > "$HOME/.flintrock-manifest.json"
-                chmod go-rw "$HOME/.flintrock-manifest.json"
-            """.format(
-                m=shlex.quote(json.dumps(manifest, indent=4, sort_keys=True))
-            ))
+            services=services,
+            ssh_key_pair=cluster.ssh_key_pair)
 
         for service in services:
             service.configure_master(
@@ -717,6 +1379,64 @@ def provision_cluster(
         service.health_check(master_host=cluster.master_ip)
 
 
+def get_jar_updates(
+        *,
+        build_jar_hashes: dict,
+        node_jar_hashes: dict,
+        private_hosts: dict) -> dict:
+    """
+    Work out which jars each node needs after a Spark rebuild.
+
+    build_jar_hashes maps the jars in the master's build tree to their
+    SHA-256 hashes, and node_jar_hashes does the same for the jars installed
+    on each node, keyed by host. Return a mapping of each node's private host
+    to the jars that must be copied to it and the stale jars that must be
+    removed from it. Nodes that are already up to date are left out.
+    """
+    jar_updates = {}
+    for host, jar_hashes in node_jar_hashes.items():
+        changed_jars = sorted(
+            name for name, jar_hash in build_jar_hashes.items()
+            if jar_hashes.get(name) != jar_hash)
+        stale_jars = sorted(set(jar_hashes) - set(build_jar_hashes))
+        if changed_jars or stale_jars:
+            jar_updates[private_hosts[host]] = (changed_jars, stale_jars)
+    return jar_updates
+
+
+def get_manifest(*, services: list, ssh_key_pair: SSHKeyPair) -> dict:
+    """
+    Get the cluster manifest that describes how the given services are
+    configured.
+    """
+    return {
+        'services': [[type(m).__name__, m.manifest] for m in services],
+        'ssh_key_pair': ssh_key_pair._asdict(),
+    }
+
+
+def write_manifest(
+        *,
+        client: paramiko.client.SSHClient,
+        services: list,
+        ssh_key_pair: SSHKeyPair):
+    """
+    Write the cluster manifest to the master via the provided SSH client.
+
+    The manifest tells us how the cluster is configured. We'll need this
+    when we resize the cluster or restart it.
+    """
+    manifest = get_manifest(services=services, ssh_key_pair=ssh_key_pair)
+    ssh_check_output(
+        client=client,
+        command="""
+            echo {m} > "$HOME/.flintrock-manifest.json"
+            chmod go-rw "$HOME/.flintrock-manifest.json"
+        """.format(
+            m=shlex.quote(json.dumps(manifest, indent=4, sort_keys=True))
+        ))
+
+
 def provision_node(
         *,
         java_version: int,
@@ -773,14 +1493,17 @@ def start_node(
     with ssh_client:
         # TODO: Consider consolidating ephemeral storage code under a dedicated
         #       Flintrock service.
-        if cluster.storage_dirs.ephemeral:
+        # The master's volumes, which the manifest lists, may not match this
+        # node's.
+        ephemeral_dirs = get_node_resources(ssh_client=ssh_client).ephemeral_dirs
+        if ephemeral_dirs:
             ssh_check_output(
                 client=ssh_client,
                 command="""
                     sudo chown "{u}:{u}" {d}
                 """.format(
                     u=user,
-                    d=' '.join(cluster.storage_dirs.ephemeral)))
+                    d=' '.join(ephemeral_dirs)))
 
         for service in services:
             service.configure(
@@ -850,9 +1573,25 @@ def remove_slaves_node(
             cluster=cluster)
 
 
-def run_command_node(*, user: str, host: str, identity_file: str, command: tuple):
+def run_command_node(
+        *,
+        user: str,
+        host: str,
+        identity_file: str,
+        command: tuple,
+        compress: bool=False,
+        stream_output: bool=True,
+        output_dir: str=None,
+        environments: dict=None) -> CommandResult:
     """
-    Run a shell command on a node.
+    Run a shell command on a node and return its exit status and output.
+
+    If stream_output is True, then print each line of output as it arrives,
+    prefixed with the host. If output_dir is set, then also write the output
+    to output_dir/<host>.log.
+
+    environments optionally maps hosts to environment variables to export
+    for the command.
 
     This method is role-agnostic; it runs on both the cluster master and slaves.
     This method is meant to be called asynchronously.
@@ -860,18 +1599,421 @@ def run_command_node(*, user: str, host: str, identity_file: str, command: tuple
     ssh_client = get_ssh_client(
         user=user,
         host=host,
-        identity_file=identity_file)
+        identity_file=identity_file,
+        compress=compress)
 
     logger.info("[{h}] Running command...".format(h=host))
 
     command_str = ' '.join(command)
+    if environments:
+        command_str = get_export_command(environments[host]) + ' ' + command_str
+
+    with ssh_client:
+        channel = ssh_client.get_transport().open_session()
+        channel.get_pty()
+        channel.exec_command(command_str)
+
+        output_lines = []
+        for raw_line in channel.makefile('rb'):
+            line = raw_line.decode('utf-8', 'replace').rstrip('\r\n')
+            output_lines.append(line)
+            if stream_output:
+                print("[{h}] {l}".format(h=host, l=line), flush=True)
+
+        exit_status = channel.recv_exit_status()
+
+    output = '\n'.join(output_lines)
+    if output_dir:
+        with open(os.path.join(output_dir, host + '.log'), 'w') as output_file:
+            output_file.write(output + '\n' if output else '')
+
+    if exit_status:
+        logger.info("[{h}] Command failed with exit status {e}.".format(h=host, e=exit_status))
+    else:
+        logger.info("[{h}] Command complete.".format(h=host))
+
+    return CommandResult(exit_status=exit_status, output=output)
+
+
+def relay_command(
+        *,
+        ssh_client: paramiko.client.SSHClient,
+        command: tuple,
+        hosts: list,
+        stream_output: bool=True,
+        output_dir: str=None,
+        environments: dict=None) -> dict:
+    """
+    Run a shell command on many nodes by way of the master.
+
+    ssh_client is connected to the master, which runs the command on each node
+    over the intra-cluster network and streams the output back to us. hosts is
+    a list of (host, private host) pairs. Output is printed and written to
+    output_dir, and environments is applied, as they are by run_command_node().
+
+    Return a dict mapping each host to its CommandResult.
+    """
+    hosts_by_private_host = {private_host: host for host, private_host in hosts}
+    output_lines = {host: [] for host, _ in hosts}
+    results = {}
+
+    with ssh_client.open_sftp() as sftp:
+        sftp.put(
+            localpath=os.path.join(SCRIPTS_DIR, 'relay-command.py'),
+            remotepath='/tmp/relay-command.py')
+
+    logger.info("Relaying command to {n} node{s}...".format(
+        n=len(hosts),
+        s='' if len(hosts) == 1 else 's'))
+
+    # No pty here, since a pty would echo our request back to us.
+    stdin, stdout, stderr = ssh_client.exec_command('python /tmp/relay-command.py')
+    stdin.write(json.dumps({
+        'command': ' '.join(command),
+        'hosts': [private_host for _, private_host in hosts],
+        'parallelism': RELAY_COMMAND_PARALLELISM,
+        'ssh_options': shlex.split(INTRA_CLUSTER_SSH_OPTIONS),
+        'environments': {
+            private_host: environments[host]
+            for host, private_host in hosts
+        } if environments else {},
+    }))
+    stdin.flush()
+    stdin.channel.shutdown_write()
+
+    for raw_line in stdout:
+        message = json.loads(raw_line)
+        host = hosts_by_private_host[message['host']]
+
+        if 'line' in message:
+            output_lines[host].append(message['line'])
+            if stream_output:
+                print("[{h}] {l}".format(h=host, l=message['line']), flush=True)
+            continue
+
+        output = '\n'.join(output_lines.pop(host))
+        results[host] = CommandResult(exit_status=message['exit_status'], output=output)
+        if output_dir:
+            with open(os.path.join(output_dir, host + '.log'), 'w') as output_file:
+                output_file.write(output + '\n' if output else '')
+
+        if message['exit_status']:
+            logger.info("[{h}] Command failed with exit status {e}.".format(
+                h=host, e=message['exit_status']))
+        else:
+            logger.info("[{h}] Command complete.".format(h=host))
+
+    relay_error = stderr.read().decode('utf8').rstrip('\n')
+    if stdout.channel.recv_exit_status() or output_lines:
+        raise SSHError(
+            host=ssh_client.get_transport().getpeername()[0],
+            message="Failed to relay command to all nodes. {e}".format(e=relay_error).rstrip())
+
+    return results
+
+
+def upload_script_node(
+        *,
+        user: str,
+        host: str,
+        identity_file: str,
+        local_path: str,
+        remote_path: str,
+        sha256: str):
+    """
+    Upload a run-command script to a node, unless the node already has it.
+
+    This method is role-agnostic; it runs on both the cluster master and slaves.
+    This method is meant to be called asynchronously.
+    """
+    ssh_client = get_ssh_client(
+        user=user,
+        host=host,
+        identity_file=identity_file)
+
+    with ssh_client:
+        remote_sha256 = ssh_check_output(
+            client=ssh_client,
+            command="""
+                if [ -f {p} ]; then
+                    sha256sum {p}
+                fi
+            """.format(p=shlex.quote(remote_path)))
+
+    if remote_sha256.split()[:1] == [sha256]:
+        logger.debug("[{h}] Script is already uploaded.".format(h=host))
+        return
+
+    upload_file(
+        user=user,
+        host=host,
+        identity_file=identity_file,
+        local_path=local_path,
+        remote_path=remote_path,
+        sha256=sha256)
+
+
+def start_job_node(
+        *,
+        user: str,
+        host: str,
+        identity_file: str,
+        job_id: str,
+        command: tuple):
+    """
+    Start a shell command in the background on a node, in its own session so
+    that it outlives the SSH connection.
+
+    The command's output, PID, and exit status are kept under JOBS_DIR.
+
+    This method is role-agnostic; it runs on both the cluster master and slaves.
+    This method is meant to be called asynchronously.
+    """
+    ssh_client = get_ssh_client(
+        user=user,
+        host=host,
+        identity_file=identity_file)
+
+    job_dir = posixpath.join(JOBS_DIR, job_id)
+    command_str = ' '.join(command)
+
+    # The command runs in a nested shell so that an `exit` in it can't skip
+    # recording the exit status.
+    wrapper = """
+        bash -c {command}
+        echo $? > {job_dir}/exit_status.part
+        mv {job_dir}/exit_status.part {job_dir}/exit_status
+    """.format(
+        command=shlex.quote(command_str),
+        job_dir=shlex.quote(job_dir))
 
     with ssh_client:
         ssh_check_output(
             client=ssh_client,
-            command=command_str)
+            command="""
+                set -e
+                mkdir -p {job_dir}
+                echo {command} > {job_dir}/command
+                setsid nohup bash -c {wrapper} > {job_dir}/output 2>&1 < /dev/null &
+                echo $! > {job_dir}/pid
+            """.format(
+                job_dir=shlex.quote(job_dir),
+                command=shlex.quote(command_str),
+                wrapper=shlex.quote(wrapper)))
 
-    logger.info("[{h}] Command complete.".format(h=host))
+    logger.info("[{h}] Job started.".format(h=host))
+
+
+def fetch_job_output_node(
+        *,
+        user: str,
+        host: str,
+        identity_file: str,
+        job_id: str,
+        local_dir: str):
+    """
+    Append whatever a detached job has output on a node since we last looked
+    to local_dir/<host>.log.
+
+    This method is role-agnostic; it runs on both the cluster master and slaves.
+    This method is meant to be called asynchronously.
+    """
+    local_path = os.path.join(local_dir, host + '.log')
+    try:
+        offset = os.path.getsize(local_path)
+    except FileNotFoundError:
+        offset = 0
+
+    ssh_client = get_ssh_client(
+        user=user,
+        host=host,
+        identity_file=identity_file)
+
+    with ssh_client, ssh_client.open_sftp() as sftp:
+        remote_path = posixpath.join(JOBS_DIR, job_id, 'output')
+        try:
+            remote_file = sftp.open(remote_path, 'rb')
+        except FileNotFoundError:
+            raise SSHError(host=host, message="No output found for job {j}.".format(j=job_id))
+
+        with remote_file, open(local_path, 'ab') as local_file:
+            remote_file.seek(offset)
+            remote_file.prefetch()
+            for chunk in iter(lambda: remote_file.read(1024 * 1024), b''):
+                local_file.write(chunk)
+
+
+def group_command_results(results: dict) -> list:
+    """
+    Group hosts that returned the same exit status and output.
+
+    results maps each host to its CommandResult. Return a list of
+    (hosts, result) pairs with the largest group first.
+    """
+    groups = {}
+    for host, result in results.items():
+        key = (
+            result.exit_status,
+            hashlib.sha256(result.output.encode('utf-8')).hexdigest())
+        groups.setdefault(key, (result, []))[1].append(host)
+
+    return sorted(
+        ((sorted(hosts), result) for result, hosts in groups.values()),
+        key=lambda group: (-len(group[0]), group[0][0]))
+
+
+def format_command_summary(groups: list) -> str:
+    """
+    Describe grouped command results, showing how each minority group's output
+    differs from the largest group's.
+    """
+    def describe_hosts(hosts):
+        described = ', '.join(hosts[:COMMAND_SUMMARY_MAX_HOSTS])
+        if len(hosts) > COMMAND_SUMMARY_MAX_HOSTS:
+            described += ', and {n} more'.format(n=len(hosts) - COMMAND_SUMMARY_MAX_HOSTS)
+        return described
+
+    def describe_group(hosts, result):
+        return "{n} host{s}: {status}".format(
+            n=len(hosts),
+            s='' if len(hosts) == 1 else 's',
+            status='OK' if result.exit_status == 0 else 'exit status {e}'.format(e=result.exit_status))
+
+    majority_hosts, majority_result = groups[0]
+    lines = [describe_group(majority_hosts, majority_result)]
+    if len(groups) == 1:
+        lines[0] += ", same output"
+
+    for hosts, result in groups[1:]:
+        lines.append(describe_group(hosts, result))
+        lines.append("    " + describe_hosts(hosts))
+        diff = list(difflib.unified_diff(
+            majority_result.output.splitlines(),
+            result.output.splitlines(),
+            fromfile='{n} host{s}'.format(
+                n=len(majority_hosts), s='' if len(majority_hosts) == 1 else 's'),
+            tofile='{n} host{s}'.format(
+                n=len(hosts), s='' if len(hosts) == 1 else 's'),
+            lineterm=''))
+        for diff_line in diff[:COMMAND_SUMMARY_MAX_DIFF_LINES]:
+            lines.append("    " + diff_line)
+        if len(diff) > COMMAND_SUMMARY_MAX_DIFF_LINES:
+            lines.append("    ...")
+
+    return '\n'.join(lines)
+
+
+def get_spark_jar_hashes_node(
+        *,
+        user: str,
+        host: str,
+        identity_file: str,
+        spark: 'Spark'):
+    """
+    Get the hashes of the Spark jars installed on a node.
+
+    This method is role-agnostic; it runs on both the cluster master and slaves.
+    This method is meant to be called asynchronously.
+    """
+    ssh_client = get_ssh_client(
+        user=user,
+        host=host,
+        identity_file=identity_file)
+
+    with ssh_client:
+        return spark.get_jar_hashes(ssh_client=ssh_client)
+
+
+def get_broadcast_rounds(hosts: list) -> list:
+    """
+    Plan a binomial-tree broadcast of a file from the first host to the rest.
+
+    Return a list of rounds. Each round is a list of (source, target) pairs
+    that can run in parallel, where every source already has the file. The
+    number of hosts with the file doubles every round, so reaching N hosts
+    takes about log2(N) rounds.
+    """
+    rounds = []
+    num_seeded = 1
+    while num_seeded < len(hosts):
+        rounds.append([
+            (hosts[i], hosts[i + num_seeded])
+            for i in range(min(num_seeded, len(hosts) - num_seeded))
+        ])
+        num_seeded *= 2
+    return rounds
+
+
+def broadcast_file(
+        *,
+        ssh_client: paramiko.client.SSHClient,
+        path: str,
+        sha256: str,
+        hosts: list):
+    """
+    Relay a file that is already on the first of the given hosts to the rest
+    of them.
+
+    ssh_client is connected to the master, which drives the relay. Each target
+    pulls the file from its source in the tree and checks it against the
+    expected SHA-256 digest before moving it into place, so a corrupt copy
+    never gets passed on.
+    """
+    rounds = get_broadcast_rounds(hosts)
+    if not rounds:
+        return
+
+    remote_dir = posixpath.dirname(path) or '.'
+    part_path = path + '.flintrock-part'
+
+    commands = []
+    for relays in rounds:
+        for source, target in relays:
+            pull_command = """
+                set -e
+                if [ ! -d {dir} ]; then
+                    echo "Remote directory does not exist: "{dir} >&2
+                    exit 1
+                fi
+                scp {ssh_opts} {source_path} {part}
+                echo {sha256}'  '{part} | sha256sum --check --quiet
+                mv {part} {path}
+            """.format(
+                dir=shlex.quote(remote_dir),
+                ssh_opts=INTRA_CLUSTER_SSH_OPTIONS,
+                source_path=shlex.quote(source + ':' + shlex.quote(path)),
+                part=shlex.quote(part_path),
+                sha256=sha256,
+                path=shlex.quote(path))
+            commands.append(
+                '(ssh {ssh_opts} {target} {command} '
+                '|| {{ echo {error} >&2; exit 1; }}) & pids+=($!)'.format(
+                    ssh_opts=INTRA_CLUSTER_SSH_OPTIONS,
+                    target=shlex.quote(target),
+                    command=shlex.quote(pull_command),
+                    error=shlex.quote(
+                        "[{t}] Failed to relay file from {s}.".format(t=target, s=source))))
+        commands.append('for pid in "${pids[@]}"; do wait "$pid" || failed=1; done')
+        commands.append('pids=()')
+        # Later rounds relay from the targets of this one, so stop here if
+        # any of them failed.
+        commands.append('[ "$failed" = 0 ] || exit 1')
+
+    logger.info("Relaying file to {n} node{s} in {r} round{rs}...".format(
+        n=len(hosts) - 1,
+        s='' if len(hosts) == 2 else 's',
+        r=len(rounds),
+        rs='' if len(rounds) == 1 else 's'))
+
+    ssh_check_output(
+        client=ssh_client,
+        command="""
+            failed=0
+            pids=()
+            {commands}
+        """.format(commands='\n'.join(commands)))
+
+    logger.info("Relay complete.")
 
 
 def copy_file_node(
@@ -880,9 +2022,15 @@ def copy_file_node(
         host: str,
         identity_file: str,
         local_path: str,
-        remote_path: str):
+        remote_path: str,
+        sha256: str=None,
+        compress: bool=False) -> str:
     """
-    Copy a file to the specified remote path on a node.
+    Copy a file to the specified remote path on a node, or into it if it's a
+    directory, and return the path the file was copied to.
+
+    The upload is resumable and verified against the local file's SHA-256
+    digest, which can be passed in as sha256 if it's already known.
 
     This method is role-agnostic; it runs on both the cluster master and slaves.
     This method is meant to be called asynchronously.
@@ -895,22 +2043,574 @@ def copy_file_node(
     with ssh_client:
         remote_dir = posixpath.dirname(remote_path)
 
-        try:
+        remote_path_type = ssh_check_output(
+            client=ssh_client,
+            command="""
+                if [ -d {path} ]; then
+                    echo directory
+                elif [ -d {dir} ]; then
+                    echo file
+                fi
+            """.format(
+                path=shlex.quote(remote_path),
+                dir=shlex.quote(remote_dir)))
+
+    if remote_path_type == 'directory':
+        remote_path = posixpath.join(remote_path, os.path.basename(local_path))
+    elif remote_path_type != 'file':
+        raise Exception("Remote directory does not exist: {d}".format(d=remote_dir))
+
+    logger.info("[{h}] Copying file...".format(h=host))
+
+    upload_file(
+        user=user,
+        host=host,
+        identity_file=identity_file,
+        local_path=local_path,
+        remote_path=remote_path,
+        sha256=sha256,
+        compress=compress)
+
+    logger.info("[{h}] Copy complete.".format(h=host))
+
+    return remote_path
+
+
+def get_local_manifest(local_dir: str) -> dict:
+    """
+    Map each file under a local directory, by its POSIX path relative to the
+    directory, to its [size, mtime].
+    """
+    manifest = {}
+    for dir_path, dir_names, file_names in os.walk(local_dir):
+        for file_name in file_names:
+            path = os.path.join(dir_path, file_name)
+            if os.path.islink(path):
+                continue
+            stat = os.stat(path)
+            relative_path = os.path.relpath(path, local_dir).replace(os.sep, '/')
+            manifest[relative_path] = [stat.st_size, int(stat.st_mtime)]
+    return manifest
+
+
+def get_sync_hash_candidates(*, local_manifest: dict, remote_manifest: dict) -> list:
+    """
+    Get the files whose size is the same on both sides of a sync but whose
+    mtime is not. These may have just been touched, as by a fresh checkout,
+    so their contents are worth comparing before we send them.
+    """
+    return sorted(
+        path for path, (size, mtime) in local_manifest.items()
+        if remote_manifest.get(path, [None])[0] == size and remote_manifest[path][1] != mtime)
+
+
+def get_sync_plan(*, local_manifest: dict, remote_manifest: dict, matching_files=()) -> tuple:
+    """
+    Decide which files a sync needs to send.
+
+    Return a pair of sorted lists: the files to send in full, and the large
+    files that changed and should be sent as deltas against the remote copy.
+    Files with the same size and mtime on both sides are assumed unchanged,
+    as are matching_files, whose contents were found to be the same.
+    """
+    matching_files = set(matching_files)
+    full_files = []
+    delta_files = []
+    for path, (size, mtime) in local_manifest.items():
+        if path not in remote_manifest:
+            full_files.append(path)
+        elif remote_manifest[path] != [size, mtime] and path not in matching_files:
+            if size >= SYNC_DELTA_MIN_SIZE and remote_manifest[path][0] >= SYNC_DELTA_MIN_SIZE:
+                delta_files.append(path)
+            else:
+                full_files.append(path)
+    return (sorted(full_files), sorted(delta_files))
+
+
+def get_sync_block_size(size: int) -> int:
+    """
+    Pick a delta block size for a file, growing with the square root of its
+    size like rsync does.
+    """
+    return max(SYNC_MIN_BLOCK_SIZE, min(SYNC_MAX_BLOCK_SIZE, int(size ** 0.5)))
+
+
+def get_rolling_delta(*, data, block_size: int, signatures: list, max_literal_bytes: int):
+    """
+    Compute an rsync-style delta that rebuilds data from the blocks of a
+    remote file plus literal data.
+
+    signatures holds an [adler32, md5] pair for each full block of the remote
+    file. Return a list of operations that are either ('copy', block_index)
+    or ('data', start, end), where start and end are offsets into data. Return
+    None if the delta would need more than max_literal_bytes of literal data.
+
+    An Adler-32 checksum is rolled over data one byte at a time to find
+    candidate blocks cheaply, and MD5 confirms each candidate.
+    """
+    mod_adler = 65521
+
+    blocks_by_weak_sum = {}
+    for index, (weak_sum, strong_sum) in enumerate(signatures):
+        blocks_by_weak_sum.setdefault(weak_sum, []).append((index, strong_sum))
+
+    ops = []
+    literal_bytes = 0
+    literal_start = 0
+    position = 0
+    weak_sum = None
+    size = len(data)
+
+    while position + block_size <= size:
+        if weak_sum is None:
+            weak_sum = zlib.adler32(data[position:position + block_size]) & 0xffffffff
+            a = weak_sum & 0xffff
+            b = weak_sum >> 16
+
+        candidates = blocks_by_weak_sum.get(weak_sum)
+        if candidates:
+            strong_sum = hashlib.md5(data[position:position + block_size]).hexdigest()
+            index = next((i for i, s in candidates if s == strong_sum), None)
+            if index is not None:
+                if literal_start < position:
+                    literal_bytes += position - literal_start
+                    ops.append(('data', literal_start, position))
+                ops.append(('copy', index))
+                position += block_size
+                literal_start = position
+                weak_sum = None
+                continue
+
+        if literal_bytes + position + 1 - literal_start > max_literal_bytes:
+            return None
+
+        if position + block_size < size:
+            old_byte = data[position]
+            new_byte = data[position + block_size]
+            a = (a - old_byte + new_byte) % mod_adler
+            b = (b - block_size * old_byte + a - 1) % mod_adler
+            weak_sum = (b << 16) | a
+        position += 1
+
+    if literal_start < size:
+        literal_bytes += size - literal_start
+        if literal_bytes > max_literal_bytes:
+            return None
+        ops.append(('data', literal_start, size))
+
+    return ops
+
+
+def write_sync_patch(stream, *, local_path: str, path: str, block_size: int, ops: list):
+    """
+    Write a patch in the format sync-files.py expects, which turns the remote
+    copy of path into the local file, to a binary stream.
+    """
+    stat = os.stat(local_path)
+    header = {
+        'path': path,
+        'size': stat.st_size,
+        'mtime': int(stat.st_mtime),
+        'mode': stat.st_mode & 0o777,
+        'sha256': get_file_sha256(local_path),
+        'block_size': block_size,
+        'ops': [
+            ['copy', op[1]] if op[0] == 'copy' else ['data', op[2] - op[1]]
+            for op in ops
+        ],
+    }
+    stream.write(json.dumps(header).encode('utf-8') + b'\n')
+    with open(local_path, 'rb') as f:
+        for op in ops:
+            if op[0] == 'data':
+                f.seek(op[1])
+                stream.write(f.read(op[2] - op[1]))
+
+
+def sync_node(
+        *,
+        user: str,
+        host: str,
+        identity_file: str,
+        local_dir: str,
+        remote_dir: str,
+        compress: bool=False):
+    """
+    Sync a local directory to the specified remote directory on a node.
+
+    One round trip fetches the size and mtime of every remote file. Files
+    whose size matches but whose mtime doesn't are then compared by SHA-256
+    digest in one more round trip. New and small changed files then go over
+    in a single tar stream, and large changed files go over as
+    rolling-checksum deltas against the remote copies.
+
+    This method is role-agnostic; it runs on both the cluster master and slaves.
+    This method is meant to be called asynchronously.
+    """
+    ssh_client = get_ssh_client(
+        user=user,
+        host=host,
+        identity_file=identity_file,
+        compress=compress)
+
+    with ssh_client:
+        with ssh_client.open_sftp() as sftp:
+            sftp.put(
+                localpath=os.path.join(SCRIPTS_DIR, 'sync-files.py'),
+                remotepath='/tmp/sync-files.py')
+
+        remote_manifest = json.loads(
             ssh_check_output(
                 client=ssh_client,
                 command="""
-                    test -d {path}
-                """.format(path=shlex.quote(remote_dir)))
-        except Exception as e:
-            # TODO: Catch more specific exception.
-            raise Exception("Remote directory does not exist: {d}".format(d=remote_dir))
+                    mkdir -p {d}
+                    python /tmp/sync-files.py manifest {d}
+                """.format(d=shlex.quote(remote_dir))))
+
+        local_manifest = get_local_manifest(local_dir)
+
+        hash_candidates = get_sync_hash_candidates(
+            local_manifest=local_manifest,
+            remote_manifest=remote_manifest)
+        if hash_candidates:
+            digests = {
+                path: [
+                    get_file_sha256(os.path.join(local_dir, *path.split('/'))),
+                    local_manifest[path][1]]
+                for path in hash_candidates
+            }
+            matching_files = json.loads(
+                ssh_check_output_with_input(
+                    client=ssh_client,
+                    command="python /tmp/sync-files.py match {d}".format(
+                        d=shlex.quote(remote_dir)),
+                    write_input=lambda stdin: stdin.write(
+                        json.dumps(digests).encode('utf-8'))))
+        else:
+            matching_files = []
 
-        with ssh_client.open_sftp() as sftp:
-            logger.info("[{h}] Copying file...".format(h=host))
+        full_files, delta_files = get_sync_plan(
+            local_manifest=local_manifest,
+            remote_manifest=remote_manifest,
+            matching_files=matching_files)
+
+        if not full_files and not delta_files:
+            logger.info("[{h}] Already in sync.".format(h=host))
+            return
+
+        logger.info("[{h}] Syncing {n} file{s}...".format(
+            h=host,
+            n=len(full_files) + len(delta_files),
+            s='' if len(full_files) + len(delta_files) == 1 else 's'))
+
+        deltas = {}
+        if delta_files:
+            block_sizes = {
+                path: get_sync_block_size(remote_manifest[path][0])
+                for path in delta_files
+            }
+            signatures = json.loads(
+                ssh_check_output_with_input(
+                    client=ssh_client,
+                    command="python /tmp/sync-files.py signatures {d}".format(
+                        d=shlex.quote(remote_dir)),
+                    write_input=lambda stdin: stdin.write(
+                        json.dumps(block_sizes).encode('utf-8'))))
+
+            for path in delta_files:
+                local_path = os.path.join(local_dir, *path.split('/'))
+                with open(local_path, 'rb') as f, \
+                        mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    ops = get_rolling_delta(
+                        data=data,
+                        block_size=block_sizes[path],
+                        signatures=signatures.get(path, []),
+                        max_literal_bytes=min(SYNC_MAX_LITERAL_BYTES, len(data) // 2))
+                if ops is None:
+                    full_files.append(path)
+                else:
+                    deltas[path] = ops
+
+        if full_files:
+            def write_tar(stdin):
+                with tarfile.open(fileobj=stdin, mode='w|') as tar:
+                    for path in full_files:
+                        tar.add(
+                            os.path.join(local_dir, *path.split('/')),
+                            arcname=path,
+                            recursive=False)
+
+            ssh_check_output_with_input(
+                client=ssh_client,
+                command="tar -x -f - -C {d}".format(d=shlex.quote(remote_dir)),
+                write_input=write_tar)
+
+        if deltas:
+            def write_patches(stdin):
+                for path, ops in sorted(deltas.items()):
+                    write_sync_patch(
+                        stdin,
+                        local_path=os.path.join(local_dir, *path.split('/')),
+                        path=path,
+                        block_size=block_sizes[path],
+                        ops=ops)
+
+            ssh_check_output_with_input(
+                client=ssh_client,
+                command="python /tmp/sync-files.py patch {d}".format(
+                    d=shlex.quote(remote_dir)),
+                write_input=write_patches)
 
-            sftp.put(localpath=local_path, remotepath=remote_path)
+        logger.info(
+            "[{h}] Sync complete. Sent {f} file{fs} in full and {d} as deltas."
+            .format(
+                h=host,
+                f=len(full_files),
+                fs='' if len(full_files) == 1 else 's',
+                d=len(deltas)))
 
-            logger.info("[{h}] Copy complete.".format(h=host))
+
+class ThrottledReader:
+    """
+    A file-like wrapper that limits how fast a stream is read.
+    """
+
+    def __init__(self, stream, *, bytes_per_second: int=None):
+        self.stream = stream
+        self.bytes_per_second = bytes_per_second
+        self.bytes_read = 0
+        self.start_time = time.monotonic()
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.bytes_read += len(data)
+        if self.bytes_per_second:
+            elapsed_seconds = time.monotonic() - self.start_time
+            ahead_seconds = self.bytes_read / self.bytes_per_second - elapsed_seconds
+            if ahead_seconds > 0:
+                time.sleep(ahead_seconds)
+        return data
+
+
+def extract_tar_stream(stream, destination_dir: str):
+    """
+    Extract regular files and directories from a tar stream, refusing
+    anything that would land outside of destination_dir.
+    """
+    with tarfile.open(fileobj=stream, mode='r|*') as tar:
+        if hasattr(tarfile, 'data_filter'):
+            tar.extraction_filter = tarfile.data_filter
+        for member in tar:
+            path = os.path.normpath(member.name)
+            if os.path.isabs(path) or path == '..' or path.startswith('..' + os.sep):
+                raise Error("Refusing to extract unsafe path: {p}".format(p=member.name))
+            if member.isfile() or member.isdir():
+                tar.extract(member, destination_dir)
+
+
+def fetch_node(
+        *,
+        user: str,
+        host: str,
+        identity_file: str,
+        remote_glob: str,
+        local_dir: str,
+        bytes_per_second: int=None):
+    """
+    Fetch the files matching a glob from a node into local_dir/<host>.
+
+    The node streams them to us as a gzipped tar, and we unpack it as it
+    arrives.
+
+    This method is role-agnostic; it runs on both the cluster master and slaves.
+    This method is meant to be called asynchronously.
+    """
+    ssh_client = get_ssh_client(
+        user=user,
+        host=host,
+        identity_file=identity_file)
+
+    host_dir = os.path.join(local_dir, host)
+
+    with ssh_client:
+        logger.info("[{h}] Fetching files...".format(h=host))
+
+        # The glob is deliberately left unquoted so that the remote shell
+        # expands it. tar exits with 1 when a file changes as it's read,
+        # which is expected for live logs.
+        stdin, stdout, stderr = ssh_client.exec_command(
+            """
+                shopt -s nullglob globstar
+                files=( {glob} )
+                if [ "${{#files[@]}}" -eq 0 ]; then
+                    exit 0
+                fi
+                tar -c --warning=no-file-changed --ignore-failed-read -f - -- "${{files[@]}}" | gzip -1
+                tar_status="${{PIPESTATUS[0]}}"
+                if [ "$tar_status" -gt 1 ]; then
+                    exit "$tar_status"
+                fi
+            """.format(glob=remote_glob))
+        stdin.close()
+
+        reader = ThrottledReader(stdout, bytes_per_second=bytes_per_second)
+        # An earlier fetch may have left the directory behind, with files
+        # that aren't ours to clean up.
+        created_host_dir = not os.path.isdir(host_dir)
+        try:
+            os.makedirs(host_dir, exist_ok=True)
+            extract_tar_stream(reader, host_dir)
+        except tarfile.ReadError:
+            if reader.bytes_read:
+                raise
+
+        stderr_output = stderr.read().decode('utf8').rstrip('\n')
+        exit_status = stdout.channel.recv_exit_status()
+        if exit_status:
+            raise SSHError(host=host, message=stderr_output)
+
+    if not reader.bytes_read:
+        if created_host_dir:
+            os.rmdir(host_dir)
+        logger.info("[{h}] No matching files.".format(h=host))
+    else:
+        logger.info("[{h}] Fetched {b} compressed bytes.".format(h=host, b=reader.bytes_read))
+
+
+def get_log_tail_command(*, paths: list, num_lines: int, follow: bool, grep: str=None) -> str:
+    """
+    Build a shell command that tails the log files matching the given globs.
+
+    tail prints a header with the file name whenever it switches files, so the
+    headers always get past grep.
+    """
+    command = """
+        shopt -s nullglob
+        files=( {paths} )
+        if [ "${{#files[@]}}" -eq 0 ]; then
+            exit 0
+        fi
+        tail -v -n {num_lines} {follow} -- "${{files[@]}}"
+    """.format(
+        paths=' '.join(paths),
+        num_lines=num_lines,
+        follow='-F' if follow else '')
+
+    if grep:
+        command = command.rstrip() + " | grep --line-buffered -E -e '^==> .* <==$' -e {p}\n".format(
+            p=shlex.quote(grep))
+
+    return command
+
+
+def parse_log_timestamp(line: str):
+    """
+    Get the timestamp at the start of a log line, or None if there isn't one.
+    """
+    for pattern, timestamp_format in LOG_TIMESTAMP_FORMATS:
+        match = pattern.match(line)
+        if match:
+            try:
+                return datetime.strptime(match.group(0).replace('T', ' '), timestamp_format)
+            except ValueError:
+                return None
+    return None
+
+
+def merge_log_lines(log_lines: list) -> list:
+    """
+    Order (host, file_name, line) tuples from several log files by time.
+
+    Lines without a timestamp, like stack traces, stay right after the line
+    before them in the same file.
+    """
+    keyed_lines = []
+    last_timestamps = {}
+    for index, (host, file_name, line) in enumerate(log_lines):
+        timestamp = parse_log_timestamp(line)
+        if timestamp is None:
+            timestamp = last_timestamps.get((host, file_name), datetime.min)
+        last_timestamps[(host, file_name)] = timestamp
+        keyed_lines.append((timestamp, index, (host, file_name, line)))
+    return [item for timestamp, index, item in sorted(keyed_lines)]
+
+
+def stream_logs_node(
+        *,
+        user: str,
+        host: str,
+        identity_file: str,
+        command: str,
+        log_queue: queue.Queue):
+    """
+    Run a log tail command on a node and put each line of output on a queue
+    as a (host, file_name, line) tuple.
+
+    When the command finishes, put (host, None, None) on the queue. Errors
+    are logged rather than raised, so that one bad node doesn't stop the
+    others.
+
+    This method is role-agnostic; it runs on both the cluster master and slaves.
+    This method is meant to be called asynchronously.
+    """
+    try:
+        ssh_client = get_ssh_client(
+            user=user,
+            host=host,
+            identity_file=identity_file)
+
+        with ssh_client:
+            channel = ssh_client.get_transport().open_session()
+            # The pty makes sure tail dies along with the connection.
+            channel.get_pty()
+            channel.exec_command(command)
+
+            file_name = ''
+            for raw_line in channel.makefile('rb'):
+                line = raw_line.decode('utf-8', 'replace').rstrip('\r\n')
+                if line.startswith('==> ') and line.endswith(' <=='):
+                    file_name = posixpath.basename(line[4:-4])
+                elif line:
+                    log_queue.put((host, file_name, line))
+    except Exception as e:
+        logger.error("[{h}] Could not read logs: {e}".format(h=host, e=e))
+    finally:
+        log_queue.put((host, None, None))
+
+
+def print_followed_logs(*, log_queue: queue.Queue, num_hosts: int):
+    """
+    Print lines from a queue as they arrive, holding each one back briefly
+    so that lines from different nodes come out in time order.
+    """
+    pending = []
+    last_timestamps = {}
+    sequence = 0
+    num_finished = 0
+
+    while num_finished < num_hosts or pending:
+        try:
+            host, file_name, line = log_queue.get(timeout=0.1)
+        except queue.Empty:
+            pass
+        else:
+            if file_name is None:
+                num_finished += 1
+            else:
+                timestamp = parse_log_timestamp(line)
+                if timestamp is None:
+                    timestamp = last_timestamps.get((host, file_name), datetime.min)
+                last_timestamps[(host, file_name)] = timestamp
+                heapq.heappush(
+                    pending,
+                    (timestamp, sequence, time.monotonic(), (host, file_name, line)))
+                sequence += 1
+
+        now = time.monotonic()
+        while pending and (
+                now - pending[0][2] >= LOG_REORDER_SECONDS or num_finished == num_hosts):
+            host, file_name, line = heapq.heappop(pending)[3]
+            print("[{h}:{f}] {l}".format(h=host, f=file_name, l=line), flush=True)
 
 
 # This is necessary down here since we have a circular import dependency between
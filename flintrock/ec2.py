@@ -1,15 +1,22 @@
+import atexit
+import concurrent.futures
+import copy
 import functools
+import hashlib
 import string
 import sys
+import threading
 import time
 import urllib.request
 import base64
 import logging
-from datetime import datetime, timedelta, timezone
+from collections import Counter
+from datetime import datetime
 
 # External modules
 import boto3
 import botocore
+import botocore.config
 import click
 
 # Flintrock modules
@@ -25,10 +32,60 @@ from .exceptions import (
 )
 from .ssh import generate_ssh_key_pair
 from .services import SecurityGroupRule
-from .util import duration_to_timedelta
+from .util import read_cache, write_cache
 
 logger = logging.getLogger('flintrock.ec2')
 
+# EC2 rejects filters with more values than this. We keep lists of
+# instance IDs to the same size.
+EC2_MAX_FILTER_VALUES = 200
+# How long to wait between instance state checks. We check at the minimum
+# interval while instances are changing state and back off towards the
+# maximum while they aren't.
+STATE_POLL_MIN_INTERVAL_SECONDS = 2
+STATE_POLL_MAX_INTERVAL_SECONDS = 15
+
+# Client-side limits on how hard we hit the EC2 API in each region. They're
+# shared by everything we do in a region, and the request rate adapts to any
+# throttling we see.
+EC2_REQUESTS_PER_SECOND = 20
+EC2_REQUEST_BURST = 40
+EC2_MAX_POOL_CONNECTIONS = 50
+EC2_MAX_ATTEMPTS = 10
+EC2_THROTTLING_ERROR_CODES = {'RequestLimitExceeded', 'EC2ThrottledException', 'Throttling'}
+# How many instances to change security groups on at once. The calls still go
+# through the rate limits above.
+MODIFY_INSTANCE_PARALLELISM = 32
+# How long to keep trying to delete a cluster security group that is still
+# in use.
+SECURITY_GROUP_DELETE_TIMEOUT_SECONDS = 5 * 60
+
+# Each cluster's instances are launched from a launch template, whose ID we
+# tag them with.
+LAUNCH_TEMPLATE_TAG = 'flintrock-launch-template'
+
+# Errors from launching instances that mean we should try the next instance
+# type or placement on the list, if there is one.
+LAUNCH_FALLBACK_ERROR_CODES = {
+    'InsufficientInstanceCapacity',
+    'InsufficientFreeAddressesInSubnet',
+    'SpotMaxPriceTooLow',
+    # The instance type isn't offered in the AZ.
+    'Unsupported',
+}
+
+# How many times to try tagging newly launched instances that EC2 doesn't
+# know about yet.
+TAG_MAX_ATTEMPTS = 6
+
+# How long to trust cached lookups of things that rarely change. Our public IP
+# changes whenever we switch networks, so we don't trust it for long. Images
+# never change.
+CLIENT_IP_CACHE_TTL_SECONDS = 10 * 60
+DEFAULT_VPC_CACHE_TTL_SECONDS = 24 * 60 * 60
+INSTANCE_PROFILE_CACHE_TTL_SECONDS = 24 * 60 * 60
+IMAGE_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+
 
 class NoDefaultVPC(Error):
     def __init__(self, *, region: str):
@@ -46,6 +103,135 @@ class ConfigurationNotSupported(Error):
         super().__init__(message)
 
 
+class TokenBucket:
+    """
+    A thread-safe token bucket for client-side rate limiting.
+
+    The refill rate adapts to throttling: it's halved every time a request is
+    throttled, and climbs back towards max_rate as requests succeed.
+    """
+    def __init__(
+            self,
+            *,
+            max_rate: float,
+            capacity: float,
+            min_rate: float=1,
+            clock=time.monotonic,
+            sleep=time.sleep):
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.rate = max_rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.last_refill = clock()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def acquire(self):
+        """
+        Take a token, waiting for one if the bucket is empty.
+        """
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_seconds = (1 - self.tokens) / self.rate
+            self.sleep(wait_seconds)
+
+    def on_throttle(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+
+    def on_success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + 1)
+
+
+# Calls and throttled calls, keyed by EC2 API operation.
+ec2_api_calls = Counter()
+ec2_api_throttles = Counter()
+_ec2_api_stats_lock = threading.Lock()
+
+_ec2_resources = {}
+_ec2_resources_lock = threading.Lock()
+
+
+def _throttle_ec2_request(*, bucket: TokenBucket, event_name: str, **kwargs):
+    bucket.acquire()
+    with _ec2_api_stats_lock:
+        ec2_api_calls[event_name.rsplit('.', 1)[-1]] += 1
+
+
+def _check_ec2_response(*, bucket: TokenBucket, event_name: str, response=None, **kwargs):
+    # Returning None leaves the decision to retry to botocore's own retry
+    # handler, which already retries throttled requests.
+    if response is None:
+        return
+    error_code = response[1].get('Error', {}).get('Code')
+    if error_code in EC2_THROTTLING_ERROR_CODES:
+        bucket.on_throttle()
+        with _ec2_api_stats_lock:
+            ec2_api_throttles[event_name.rsplit('.', 1)[-1]] += 1
+    elif not error_code:
+        bucket.on_success()
+
+
+def get_ec2_resource(*, region: str) -> 'boto3.resources.factory.ec2.ServiceResource':
+    """
+    Get the EC2 resource for a region.
+
+    Everything in a region shares one resource and its underlying client, so
+    that HTTP connections are pooled and all our requests go through the same
+    rate limiter. Throttled requests are retried with backoff.
+    """
+    with _ec2_resources_lock:
+        if region not in _ec2_resources:
+            resource = boto3.session.Session().resource(
+                service_name='ec2',
+                region_name=region,
+                config=botocore.config.Config(
+                    max_pool_connections=EC2_MAX_POOL_CONNECTIONS,
+                    retries={'max_attempts': EC2_MAX_ATTEMPTS}))
+            bucket = TokenBucket(
+                max_rate=EC2_REQUESTS_PER_SECOND,
+                capacity=EC2_REQUEST_BURST)
+            events = resource.meta.client.meta.events
+            events.register('before-send.ec2', functools.partial(_throttle_ec2_request, bucket=bucket))
+            events.register('needs-retry.ec2', functools.partial(_check_ec2_response, bucket=bucket))
+            _ec2_resources[region] = resource
+        return _ec2_resources[region]
+
+
+@atexit.register
+def _log_ec2_api_stats():
+    if ec2_api_calls:
+        logger.debug("EC2 API calls: {c}".format(c=dict(ec2_api_calls)))
+    if ec2_api_throttles:
+        logger.debug("Throttled EC2 API calls: {c}".format(c=dict(ec2_api_throttles)))
+
+
+def get_lookup_cache_key(*parts) -> str:
+    """
+    Get the local cache key for an AWS lookup.
+
+    Keys are scoped to the AWS credentials in use, so that switching accounts
+    doesn't get us another account's VPCs or instance profiles.
+    """
+    credentials = boto3.session.Session().get_credentials()
+    access_key = credentials.access_key if credentials else ''
+    return ':'.join(
+        ('ec2', hashlib.sha256(access_key.encode('utf-8')).hexdigest()[:12]) + parts)
+
+
 def timeit(func):
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
@@ -103,6 +289,13 @@ class EC2Cluster(FlintrockCluster):
     def slave_private_hosts(self):
         return [i.private_dns_name for i in self.slave_instances]
 
+    @property
+    def launch_template_id(self):
+        for tag in self.master_instance.tags or []:
+            if tag['Key'] == LAUNCH_TEMPLATE_TAG:
+                return tag['Value']
+        return None
+
     @property
     def num_masters(self):
         return 1 if self.master_instance else 0
@@ -120,7 +313,7 @@ class EC2Cluster(FlintrockCluster):
         else:
             return 'inconsistent'
 
-    def wait_for_state(self, state: str):
+    def wait_for_state(self, state: str, *, on_transition=None):
         """
         Wait for the cluster's instances to a reach a specific state.
         The state of any services installed on the cluster is a
@@ -128,31 +321,28 @@ class EC2Cluster(FlintrockCluster):
 
         This method updates the cluster's instance metadata and
         master and slave IP addresses and hostnames.
+
+        on_transition, if set, is called with each instance and its previous
+        state whenever the instance changes state.
+        """
+        _wait_for_instances(
+            client=get_ec2_resource(region=self.region).meta.client,
+            instances=self.instances,
+            state=state,
+            on_transition=on_transition)
+
+    def destroy(self, *, wait: bool=True):
+        """
+        Destroy the cluster.
+
+        If wait is False, then return as soon as the instances start
+        terminating instead of waiting for them to finish. The cluster
+        security group may not be deletable yet at that point, in which case
+        it is left behind.
         """
-        ec2 = boto3.resource(service_name='ec2', region_name=self.region)
-
-        while any([i.state['Name'] != state for i in self.instances]):
-            if logger.isEnabledFor(logging.DEBUG):
-                waiting_instances = [i for i in self.instances if i.state['Name'] != state]
-                sample = ', '.join(["'{}'".format(i.id) for i in waiting_instances][:3])
-                logger.debug("{size} instances not in state '{state}': {sample}, ...".format(size=len(waiting_instances), state=state, sample=sample))
-            time.sleep(3)
-            # Update metadata for all instances in one shot. We don't want
-            # to make a call to AWS for each of potentially hundreds of
-            # instances.
-            instances = list(
-                ec2.instances.filter(
-                    # NOTE: We use Filters instead of InstanceIds to avoid
-                    #       the issue described here: https://github.com/boto/boto3/issues/479
-                    Filters=[
-                        {'Name': 'instance-id', 'Values': [i.id for i in self.instances]}
-                    ]))
-            (self.master_instance, self.slave_instances) = _get_cluster_master_slaves(instances)
-
-    def destroy(self):
         self.destroy_check()
         super().destroy()
-        ec2 = boto3.resource(service_name='ec2', region_name=self.region)
+        ec2 = get_ec2_resource(region=self.region)
 
         # TODO: Centralize logic to get Flintrock base security group. (?)
         flintrock_base_group = list(
@@ -166,11 +356,10 @@ class EC2Cluster(FlintrockCluster):
         # 'flintrock-clustername' group) so that we can immediately delete it once
         # the instances are terminated. If we don't do this, we get dependency
         # violations for a couple of minutes before we can actually delete the group.
-        # TODO: Is there a way to do this in one call for all instances?
-        #       Do we need to throttle these calls?
-        for instance in self.instances:
-            instance.modify_attribute(
-                Groups=[flintrock_base_group.id])
+        _set_instance_security_groups(
+            region=self.region,
+            instances=self.instances,
+            group_ids=[flintrock_base_group.id])
 
         # TODO: Centralize logic to get cluster security group name from cluster name.
         cluster_group = list(
@@ -179,15 +368,39 @@ class EC2Cluster(FlintrockCluster):
                     {'Name': 'group-name', 'Values': ['flintrock-' + self.name]},
                     {'Name': 'vpc-id', 'Values': [self.vpc_id]},
                 ]))[0]
-        cluster_group.delete()
 
-        (ec2.instances
-            .filter(
-                Filters=[
-                    {'Name': 'instance-id', 'Values': [i.id for i in self.instances]}
-                ])
-            .terminate())
-        self.wait_for_state('terminated')
+        launch_template_id = self.launch_template_id
+
+        # EC2 can take a little while to notice that the cluster group is no
+        # longer in use, so if we're waiting on the instances anyway, we keep
+        # trying to delete it in the background while they terminate.
+        # Otherwise, we try just once.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            if wait:
+                cluster_group_deleted = executor.submit(
+                    _delete_security_group,
+                    region=self.region,
+                    group_id=cluster_group.id)
+
+            _terminate_instances(
+                region=self.region,
+                instances=self.instances)
+
+            # Instances don't need their launch template once they're running.
+            if launch_template_id:
+                delete_launch_template(
+                    launch_template_id=launch_template_id,
+                    region=self.region)
+
+            if wait:
+                self.wait_for_state('terminated')
+                cluster_group_deleted.result()
+
+        if not wait:
+            _delete_security_group(
+                region=self.region,
+                group_id=cluster_group.id,
+                timeout_seconds=0)
 
     def start_check(self):
         if self.state == 'running':
@@ -201,7 +414,7 @@ class EC2Cluster(FlintrockCluster):
     def start(self, *, user: str, identity_file: str):
         # TODO: Do these _check() methods make sense here?
         self.start_check()
-        ec2 = boto3.resource(service_name='ec2', region_name=self.region)
+        ec2 = get_ec2_resource(region=self.region)
         (ec2.instances
             .filter(
                 Filters=[
@@ -227,7 +440,7 @@ class EC2Cluster(FlintrockCluster):
         self.stop_check()
         super().stop()
 
-        ec2 = boto3.resource(service_name='ec2', region_name=self.region)
+        ec2 = get_ec2_resource(region=self.region)
         (ec2.instances
             .filter(
                 Filters=[
@@ -251,10 +464,101 @@ class EC2Cluster(FlintrockCluster):
             num_slaves: int,
             java_version: int,
             spot_price: float,
-            spot_request_valid_until: str,
             min_root_ebs_size_gb: int,
             tags: list,
-            assume_yes: bool):
+            assume_yes: bool,
+            alternate_instance_types: list=(),
+            alternate_subnet_ids: list=(),
+            alternate_availability_zones: list=()):
+        """
+        Add slaves of the cluster's slave instance type, falling back to the
+        alternate instance types, subnets, and AZs if EC2 runs short of
+        capacity.
+
+        If the options call for changes to the cluster's launch template, like
+        a bigger root volume, then the slaves are launched from a new version
+        of the template with those changes. The default version is left as is.
+        """
+        launch_template_id = self.launch_template_id
+        if not launch_template_id:
+            launch_template_id = self._create_launch_template_from_master(
+                min_root_ebs_size_gb=min_root_ebs_size_gb)
+
+        launch_template_data = get_default_launch_template_data(
+            launch_template_id=launch_template_id,
+            region=self.region)
+        launch_template_changes = get_launch_template_changes(
+            launch_template_data=launch_template_data,
+            spot_price=spot_price,
+            min_root_ebs_size_gb=min_root_ebs_size_gb)
+        if launch_template_changes:
+            launch_template_version = create_launch_template_version(
+                launch_template_id=launch_template_id,
+                region=self.region,
+                launch_template_data=launch_template_changes)
+        else:
+            launch_template_version = '$Default'
+
+        launch_overrides = get_launch_overrides(
+            region=self.region,
+            vpc_id=self.vpc_id,
+            instance_types=[launch_template_data['InstanceType']] + list(alternate_instance_types),
+            subnet_id=self.master_instance.subnet_id,
+            alternate_subnet_ids=alternate_subnet_ids,
+            alternate_availability_zones=alternate_availability_zones)
+
+        self.add_slaves_check()
+        try:
+            new_slave_instances = _create_instances(
+                num_instances=num_slaves,
+                region=self.region,
+                spot_price=spot_price,
+                assume_yes=assume_yes,
+                launch_template_id=launch_template_id,
+                launch_template_version=launch_template_version,
+                launch_overrides=launch_overrides)
+
+            slave_tags = [
+                {'Key': 'flintrock-role', 'Value': 'slave'},
+                {'Key': 'Name', 'Value': '{c}-slave'.format(c=self.name)},
+                {'Key': LAUNCH_TEMPLATE_TAG, 'Value': launch_template_id}]
+            slave_tags += tags
+
+            _tag_instances(
+                region=self.region,
+                instances=new_slave_instances,
+                tags=slave_tags)
+
+            existing_slaves = {i.public_ip_address for i in self.slave_instances}
+
+            self.slave_instances += new_slave_instances
+            self.wait_for_state('running')
+
+            new_slaves = {i.public_ip_address for i in self.slave_instances} - existing_slaves
+
+            super().add_slaves(
+                user=user,
+                identity_file=identity_file,
+                java_version=java_version,
+                new_hosts=new_slaves)
+        except (Exception, KeyboardInterrupt) as e:
+            if isinstance(e, InterruptedEC2Operation):
+                cleanup_instances = e.instances
+            else:
+                cleanup_instances = new_slave_instances
+            _cleanup_instances(
+                instances=cleanup_instances,
+                assume_yes=assume_yes,
+                region=self.region,
+            )
+            raise
+
+    def _create_launch_template_from_master(self, *, min_root_ebs_size_gb: int) -> str:
+        """
+        Create a launch template for a cluster launched before Flintrock used
+        launch templates, copying the master's configuration and the slaves'
+        instance type, and tag the cluster's instances with it.
+        """
         security_group_ids = [
             group['GroupId']
             for group in self.master_instance.security_groups]
@@ -264,7 +568,7 @@ class EC2Cluster(FlintrockCluster):
             region=self.region)
         availability_zone = self.master_instance.placement['AvailabilityZone']
 
-        ec2 = boto3.resource(service_name='ec2', region_name=self.region)
+        ec2 = get_ec2_resource(region=self.region)
         client = ec2.meta.client
 
         response = client.describe_instance_attribute(
@@ -290,67 +594,36 @@ class EC2Cluster(FlintrockCluster):
         else:
             instance_profile_arn = self.master_instance.iam_instance_profile['Arn']
 
-        self.add_slaves_check()
-        try:
-            new_slave_instances = _create_instances(
-                num_instances=num_slaves,
-                region=self.region,
-                spot_price=spot_price,
-                spot_request_valid_until=spot_request_valid_until,
+        launch_template_id = create_launch_template(
+            cluster_name=self.name,
+            vpc_id=self.vpc_id,
+            region=self.region,
+            launch_template_data=get_launch_template_data(
                 ami=self.master_instance.image_id,
-                assume_yes=assume_yes,
                 key_name=self.master_instance.key_name,
-                instance_type=self.master_instance.instance_type,
+                instance_type=(self.slave_instances or [self.master_instance])[0].instance_type,
                 block_device_mappings=block_device_mappings,
                 availability_zone=availability_zone,
                 placement_group=self.master_instance.placement['GroupName'],
                 tenancy=self.master_instance.placement['Tenancy'],
                 security_group_ids=security_group_ids,
-                subnet_id=self.master_instance.subnet_id,
                 instance_profile_arn=instance_profile_arn,
                 ebs_optimized=self.master_instance.ebs_optimized,
                 instance_initiated_shutdown_behavior=instance_initiated_shutdown_behavior,
-                user_data=user_data)
-
-            slave_tags = [
-                {'Key': 'flintrock-role', 'Value': 'slave'},
-                {'Key': 'Name', 'Value': '{c}-slave'.format(c=self.name)}]
-            slave_tags += tags
+                user_data=user_data))
 
-            (ec2.instances
-                .filter(
-                    Filters=[
-                        {'Name': 'instance-id', 'Values': [i.id for i in new_slave_instances]}
-                    ])
-                .create_tags(Tags=slave_tags))
-
-            existing_slaves = {i.public_ip_address for i in self.slave_instances}
-
-            self.slave_instances += new_slave_instances
-            self.wait_for_state('running')
-
-            new_slaves = {i.public_ip_address for i in self.slave_instances} - existing_slaves
+        (ec2.instances
+            .filter(
+                Filters=[
+                    {'Name': 'instance-id', 'Values': [i.id for i in self.instances]}
+                ])
+            .create_tags(Tags=[{'Key': LAUNCH_TEMPLATE_TAG, 'Value': launch_template_id}]))
 
-            super().add_slaves(
-                user=user,
-                identity_file=identity_file,
-                java_version=java_version,
-                new_hosts=new_slaves)
-        except (Exception, KeyboardInterrupt) as e:
-            if isinstance(e, InterruptedEC2Operation):
-                cleanup_instances = e.instances
-            else:
-                cleanup_instances = new_slave_instances
-            _cleanup_instances(
-                instances=cleanup_instances,
-                assume_yes=assume_yes,
-                region=self.region,
-            )
-            raise
+        return launch_template_id
 
     @timeit
     def remove_slaves(self, *, user: str, identity_file: str, num_slaves: int):
-        ec2 = boto3.resource(service_name='ec2', region_name=self.region)
+        ec2 = get_ec2_resource(region=self.region)
 
         # self.remove_slaves_check() (?)
 
@@ -373,17 +646,14 @@ class EC2Cluster(FlintrockCluster):
                     {'Name': 'vpc-id', 'Values': [self.vpc_id]},
                 ]))[0]
 
-        # TODO: Is there a way to do this in one call for all instances?
-        for instance in removed_slave_instances:
-            instance.modify_attribute(
-                Groups=[flintrock_base_group.id])
+        _set_instance_security_groups(
+            region=self.region,
+            instances=removed_slave_instances,
+            group_ids=[flintrock_base_group.id])
 
-        (ec2.instances
-            .filter(
-                Filters=[
-                    {'Name': 'instance-id', 'Values': [i.id for i in removed_slave_instances]}
-                ])
-            .terminate())
+        _terminate_instances(
+            region=self.region,
+            instances=removed_slave_instances)
 
     def run_command_check(self):
         if self.state != 'running':
@@ -392,13 +662,20 @@ class EC2Cluster(FlintrockCluster):
                 state=self.state)
 
     @timeit
-    def run_command(self, *, master_only, command, user, identity_file):
+    def run_command(
+            self, *, master_only, command, user, identity_file, compress=False,
+            stream_output=True, output_dir=None, relay=False, script=None):
         self.run_command_check()
         super().run_command(
             master_only=master_only,
             user=user,
             identity_file=identity_file,
-            command=command)
+            command=command,
+            compress=compress,
+            stream_output=stream_output,
+            output_dir=output_dir,
+            relay=relay,
+            script=script)
 
     def copy_file_check(self):
         if self.state != 'running':
@@ -407,14 +684,86 @@ class EC2Cluster(FlintrockCluster):
                 state=self.state)
 
     @timeit
-    def copy_file(self, *, local_path, remote_path, master_only=False, user, identity_file):
+    def copy_file(
+            self, *, local_path, remote_path, master_only=False, user, identity_file,
+            broadcast=False, compress=False):
         self.copy_file_check()
         super().copy_file(
             master_only=master_only,
             user=user,
             identity_file=identity_file,
             local_path=local_path,
-            remote_path=remote_path)
+            remote_path=remote_path,
+            broadcast=broadcast,
+            compress=compress)
+
+    def sync_check(self):
+        if self.state != 'running':
+            raise ClusterInvalidState(
+                attempted_command='sync',
+                state=self.state)
+
+    @timeit
+    def sync(self, *, local_dir, remote_dir, master_only=False, user, identity_file, compress=False):
+        self.sync_check()
+        super().sync(
+            master_only=master_only,
+            user=user,
+            identity_file=identity_file,
+            local_dir=local_dir,
+            remote_dir=remote_dir,
+            compress=compress)
+
+    def fetch_check(self):
+        if self.state != 'running':
+            raise ClusterInvalidState(
+                attempted_command='fetch',
+                state=self.state)
+
+    @timeit
+    def fetch(
+            self, *, remote_glob, local_dir, master_only=False, user, identity_file,
+            max_parallel, bandwidth_limit=None):
+        self.fetch_check()
+        super().fetch(
+            master_only=master_only,
+            user=user,
+            identity_file=identity_file,
+            remote_glob=remote_glob,
+            local_dir=local_dir,
+            max_parallel=max_parallel,
+            bandwidth_limit=bandwidth_limit)
+
+    def logs_check(self):
+        if self.state != 'running':
+            raise ClusterInvalidState(
+                attempted_command='logs',
+                state=self.state)
+
+    def logs(self, *, master_only=False, user, identity_file, services, num_lines, follow, grep=None):
+        self.logs_check()
+        super().logs(
+            master_only=master_only,
+            user=user,
+            identity_file=identity_file,
+            services=services,
+            num_lines=num_lines,
+            follow=follow,
+            grep=grep)
+
+    def rebuild_spark_check(self):
+        if self.state != 'running':
+            raise ClusterInvalidState(
+                attempted_command='rebuild-spark',
+                state=self.state)
+
+    @timeit
+    def rebuild_spark(self, *, user: str, identity_file: str, git_commit: str):
+        self.rebuild_spark_check()
+        super().rebuild_spark(
+            user=user,
+            identity_file=identity_file,
+            git_commit=git_commit)
 
     def print(self):
         """
@@ -441,13 +790,19 @@ def get_default_vpc(region: str) -> 'boto3.resources.factory.ec2.Vpc':
     """
     Get the user's default VPC in the provided region.
     """
-    ec2 = boto3.resource(service_name='ec2', region_name=region)
+    ec2 = get_ec2_resource(region=region)
+
+    cache_key = get_lookup_cache_key('default-vpc', region)
+    vpc_id = read_cache(cache_key, max_age_seconds=DEFAULT_VPC_CACHE_TTL_SECONDS)
+    if vpc_id:
+        return ec2.Vpc(vpc_id)
 
     default_vpc = list(
         ec2.vpcs.filter(
             Filters=[{'Name': 'isDefault', 'Values': ['true']}]))
 
     if default_vpc:
+        write_cache(cache_key, default_vpc[0].id)
         return default_vpc[0]
     else:
         raise NoDefaultVPC(region=region)
@@ -460,7 +815,7 @@ def check_network_config(*, region_name: str, vpc_id: str, subnet_id: str):
 
     Currently, Flintrock requires DNS names and public IPs to be enabled.
     """
-    ec2 = boto3.resource(service_name='ec2', region_name=region_name)
+    ec2 = get_ec2_resource(region=region_name)
 
     if not ec2.Vpc(vpc_id).describe_attribute(Attribute='enableDnsHostnames')['EnableDnsHostnames']['Value']:
         raise ConfigurationNotSupported(
@@ -483,7 +838,7 @@ def get_security_groups(
         vpc_id,
         region,
         security_group_names) -> "List[boto3.resource('ec2').SecurityGroup]":
-    ec2 = boto3.resource(service_name='ec2', region_name=region)
+    ec2 = get_ec2_resource(region=region)
 
     groups = list(
         ec2.security_groups.filter(
@@ -504,17 +859,39 @@ def get_security_groups(
     return groups
 
 
+def get_client_ip() -> str:
+    """
+    Get the public IP address Flintrock's traffic to EC2 comes from.
+    """
+    cache_key = 'client-ip'
+    client_ip = read_cache(cache_key, max_age_seconds=CLIENT_IP_CACHE_TTL_SECONDS)
+    if not client_ip:
+        client_ip = (
+            urllib.request.urlopen('https://checkip.amazonaws.com/')
+            .read().decode('utf-8').strip())
+        write_cache(cache_key, client_ip)
+    return client_ip
+
+
 def get_or_create_flintrock_security_groups(
         *,
         cluster_name,
         vpc_id,
         region,
-        services) -> "List[boto3.resource('ec2').SecurityGroup]":
+        services,
+        client_ip: str=None,
+        revoke_stale_rules: bool=False) -> "List[boto3.resource('ec2').SecurityGroup]":
     """
     If they do not already exist, create all the security groups needed for a
-    Flintrock cluster.
+    Flintrock cluster, and make sure the cluster group has all the rules the
+    services need.
+
+    client_ip is our public IP address. We look it up if it isn't given.
+
+    If revoke_stale_rules is True, then also revoke any rules on the cluster
+    group that the services no longer need, like those for old client IPs.
     """
-    ec2 = boto3.resource(service_name='ec2', region_name=region)
+    ec2 = get_ec2_resource(region=region)
 
     # TODO: Make these into methods, since we need this logic (though simple)
     #       in multiple places. (?)
@@ -548,10 +925,9 @@ def get_or_create_flintrock_security_groups(
             VpcId=vpc_id)
 
     # Rules for the client interacting with the cluster.
-    flintrock_client_ip = (
-        urllib.request.urlopen('https://checkip.amazonaws.com/')
-        .read().decode('utf-8').strip())
-    flintrock_client_cidr = '{ip}/32'.format(ip=flintrock_client_ip)
+    if client_ip is None:
+        client_ip = get_client_ip()
+    flintrock_client_cidr = '{ip}/32'.format(ip=client_ip)
 
     # Initial security group for SSH is always required
     client_rules = [
@@ -572,36 +948,88 @@ def get_or_create_flintrock_security_groups(
             GroupName=cluster_group_name,
             Description="Flintrock cluster group",
             VpcId=vpc_id)
+        current_ip_permissions = []
+    else:
+        current_ip_permissions = cluster_group.ip_permissions
+
+    cluster_rules = client_rules + [
+        SecurityGroupRule(
+            ip_protocol='-1',  # -1 means all
+            from_port=-1,
+            to_port=-1,
+            cidr_ip=None,
+            src_group=cluster_group.id)
+    ]
 
-    # TODO: Don't try adding rules that already exist.
-    # TODO: Add rules in one shot.
-    for rule in client_rules:
+    # Another launch may add the same rules between our reading the group and
+    # updating it, in which case we read the group again and retry.
+    for attempt in range(2):
+        ip_permissions_to_authorize, ip_permissions_to_revoke = get_security_group_rule_changes(
+            ip_permissions=current_ip_permissions,
+            rules=cluster_rules)
         try:
-            cluster_group.authorize_ingress(
-                IpProtocol=rule.ip_protocol,
-                FromPort=rule.from_port,
-                ToPort=rule.to_port,
-                CidrIp=rule.cidr_ip)
+            if ip_permissions_to_authorize:
+                cluster_group.authorize_ingress(IpPermissions=ip_permissions_to_authorize)
+            break
         except botocore.exceptions.ClientError as e:
-            if e.response['Error']['Code'] != 'InvalidPermission.Duplicate':
-                raise Exception("Error adding rule: {r}".format(r=rule))
+            if e.response['Error']['Code'] != 'InvalidPermission.Duplicate' or attempt:
+                raise Exception("Error adding rules to {g}.".format(g=cluster_group_name)) from e
+            cluster_group.reload()
+            current_ip_permissions = cluster_group.ip_permissions
 
-    try:
-        cluster_group.authorize_ingress(
-            IpPermissions=[
-                {
-                    'IpProtocol': '-1',  # -1 means all
-                    'FromPort': -1,
-                    'ToPort': -1,
-                    'UserIdGroupPairs': [{'GroupId': cluster_group.id}]
-                }])
-    except botocore.exceptions.ClientError as e:
-        if e.response['Error']['Code'] != 'InvalidPermission.Duplicate':
-            raise Exception("Error authorizing cluster ingress to self.") from e
+    if revoke_stale_rules and ip_permissions_to_revoke:
+        cluster_group.revoke_ingress(IpPermissions=ip_permissions_to_revoke)
 
     return [flintrock_group, cluster_group]
 
 
+def get_security_group_rule_changes(*, ip_permissions: list, rules: list) -> (list, list):
+    """
+    Compare a security group's current IpPermissions against the
+    SecurityGroupRules it should have, where a rule's src_group is a group ID.
+
+    Return the IpPermissions to authorize, to add the rules the group is
+    missing, and the IpPermissions to revoke, to remove the rules it has but
+    shouldn't. Each list can be applied in a single call.
+    """
+    current_rules = []
+    for permission in ip_permissions:
+        # FromPort and ToPort are left out for rules that cover all protocols.
+        rule_ports = {
+            'ip_protocol': permission['IpProtocol'],
+            'from_port': permission.get('FromPort', -1),
+            'to_port': permission.get('ToPort', -1),
+        }
+        for ip_range in permission.get('IpRanges', []):
+            current_rules.append(
+                SecurityGroupRule(cidr_ip=ip_range['CidrIp'], src_group=None, **rule_ports))
+        for group_pair in permission.get('UserIdGroupPairs', []):
+            current_rules.append(
+                SecurityGroupRule(cidr_ip=None, src_group=group_pair['GroupId'], **rule_ports))
+
+    def to_ip_permission(rule):
+        ip_permission = {
+            'IpProtocol': rule.ip_protocol,
+            'FromPort': rule.from_port,
+            'ToPort': rule.to_port,
+        }
+        if rule.src_group:
+            ip_permission['UserIdGroupPairs'] = [{'GroupId': rule.src_group}]
+        else:
+            ip_permission['IpRanges'] = [{'CidrIp': rule.cidr_ip}]
+        return ip_permission
+
+    missing_rules = []
+    for rule in rules:
+        if rule not in current_rules and rule not in missing_rules:
+            missing_rules.append(rule)
+    stale_rules = [rule for rule in current_rules if rule not in rules]
+
+    return (
+        [to_ip_permission(rule) for rule in missing_rules],
+        [to_ip_permission(rule) for rule in stale_rules])
+
+
 def get_ec2_block_device_mappings(
         *,
         min_root_ebs_size_gb: int,
@@ -612,25 +1040,13 @@ def get_ec2_block_device_mappings(
 
     This is how we configure storage on the instance.
     """
-    ec2 = boto3.resource(service_name='ec2', region_name=region)
+    image = get_image_devices(ami=ami, region=region)
     block_device_mappings = []
 
-    try:
-        image = list(
-            ec2.images.filter(
-                Filters=[
-                    {'Name': 'image-id', 'Values': [ami]}
-                ]))[0]
-    except IndexError as e:
-        raise Error(
-            "Error: Could not find {ami} in region {region}.".format(
-                ami=ami,
-                region=region))
-
-    if image.root_device_type == 'ebs':
+    if image['root_device_type'] == 'ebs':
         root_device = [
-            device for device in image.block_device_mappings
-            if device['DeviceName'] == image.root_device_name][0]
+            device for device in image['block_device_mappings']
+            if device['DeviceName'] == image['root_device_name']][0]
         if root_device['Ebs']['VolumeSize'] < min_root_ebs_size_gb:
             root_device['Ebs'].update({
                 # Max root volume size for instance store-backed AMIs is 10 GiB.
@@ -653,14 +1069,67 @@ def get_ec2_block_device_mappings(
     return block_device_mappings
 
 
-def _create_instances(
+def get_image_devices(*, ami: str, region: str) -> dict:
+    """
+    Get an AMI's root device type, root device name, and block device
+    mappings.
+    """
+    cache_key = get_lookup_cache_key('image', region, ami)
+    image_devices = read_cache(cache_key, max_age_seconds=IMAGE_CACHE_TTL_SECONDS)
+    if image_devices:
+        return image_devices
+
+    ec2 = get_ec2_resource(region=region)
+
+    try:
+        image = list(
+            ec2.images.filter(
+                Filters=[
+                    {'Name': 'image-id', 'Values': [ami]}
+                ]))[0]
+    except IndexError as e:
+        raise Error(
+            "Error: Could not find {ami} in region {region}.".format(
+                ami=ami,
+                region=region))
+
+    image_devices = {
+        'root_device_type': image.root_device_type,
+        'root_device_name': image.root_device_name,
+        'block_device_mappings': image.block_device_mappings,
+    }
+    write_cache(cache_key, image_devices)
+    return image_devices
+
+
+def get_instance_profile_arn(*, instance_profile_name: str, region: str) -> str:
+    """
+    Get the ARN of an IAM instance profile, or an empty string if no profile
+    is named.
+
+    We use IAM profile ARNs internally because AWS's API prefers that in
+    a few places.
+    See: https://github.com/boto/boto3/issues/769
+    """
+    if not instance_profile_name:
+        return ''
+
+    cache_key = get_lookup_cache_key('instance-profile', instance_profile_name)
+    instance_profile_arn = read_cache(cache_key, max_age_seconds=INSTANCE_PROFILE_CACHE_TTL_SECONDS)
+    if not instance_profile_arn:
+        iam = boto3.resource(service_name='iam', region_name=region)
+        instance_profile_arn = iam.InstanceProfile(instance_profile_name).arn
+        write_cache(cache_key, instance_profile_arn)
+    return instance_profile_arn
+
+
+def get_launch_template_name(*, cluster_name: str, vpc_id: str) -> str:
+    return 'flintrock-{v}-{c}'.format(v=vpc_id, c=cluster_name)
+
+
+def get_launch_template_data(
         *,
-        num_instances,
-        region,
-        spot_price,
-        spot_request_valid_until,
         ami,
-        assume_yes,
         key_name,
         instance_type,
         block_device_mappings,
@@ -668,124 +1137,361 @@ def _create_instances(
         placement_group,
         tenancy,
         security_group_ids,
-        subnet_id,
         instance_profile_arn,
         ebs_optimized,
         instance_initiated_shutdown_behavior,
-        user_data) -> 'List[boto3.resources.factory.ec2.Instance]':
-    ec2 = boto3.resource(service_name='ec2', region_name=region)
+        user_data) -> dict:
+    """
+    Get the LaunchTemplateData for a cluster's launch template.
+    """
+    placement = {'Tenancy': tenancy}
+    if availability_zone:
+        placement['AvailabilityZone'] = availability_zone
+    if placement_group:
+        placement['GroupName'] = placement_group
+
+    launch_template_data = {
+        'ImageId': ami,
+        'KeyName': key_name,
+        'InstanceType': instance_type,
+        'BlockDeviceMappings': block_device_mappings,
+        'Placement': placement,
+        'SecurityGroupIds': security_group_ids,
+        'EbsOptimized': ebs_optimized,
+        'InstanceInitiatedShutdownBehavior': instance_initiated_shutdown_behavior,
+        'UserData': base64.b64encode(user_data.encode('utf-8')).decode(),
+    }
+    if instance_profile_arn:
+        launch_template_data['IamInstanceProfile'] = {'Arn': instance_profile_arn}
+
+    return launch_template_data
+
+
+def create_launch_template(
+        *,
+        cluster_name: str,
+        vpc_id: str,
+        region: str,
+        launch_template_data: dict) -> str:
+    """
+    Create the launch template a cluster's instances are launched from, and
+    return its ID.
+
+    A template left over from an earlier, failed launch of the same cluster
+    gets replaced.
+    """
+    client = get_ec2_resource(region=region).meta.client
+    launch_template_name = get_launch_template_name(cluster_name=cluster_name, vpc_id=vpc_id)
+
+    try:
+        response = client.create_launch_template(
+            LaunchTemplateName=launch_template_name,
+            LaunchTemplateData=launch_template_data)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] != 'InvalidLaunchTemplateName.AlreadyExistsException':
+            raise
+        client.delete_launch_template(LaunchTemplateName=launch_template_name)
+        response = client.create_launch_template(
+            LaunchTemplateName=launch_template_name,
+            LaunchTemplateData=launch_template_data)
+
+    return response['LaunchTemplate']['LaunchTemplateId']
+
+
+def get_default_launch_template_data(*, launch_template_id: str, region: str) -> dict:
+    """
+    Get the LaunchTemplateData of a launch template's default version.
+    """
+    client = get_ec2_resource(region=region).meta.client
+    response = client.describe_launch_template_versions(
+        LaunchTemplateId=launch_template_id,
+        Versions=['$Default'])
+    return response['LaunchTemplateVersions'][0]['LaunchTemplateData']
+
+
+def get_launch_template_changes(
+        *,
+        launch_template_data: dict,
+        spot_price,
+        min_root_ebs_size_gb: int) -> dict:
+    """
+    Get the changes a cluster's launch template needs before we can launch
+    more instances from it with the given options.
+
+    EC2 won't let one-time spot instances stop, so spot instances are always
+    launched with a shutdown behavior of terminate. A root EBS volume smaller
+    than min_root_ebs_size_gb is grown to that size, as at launch.
+    """
+    launch_template_changes = {}
+    if spot_price and launch_template_data.get('InstanceInitiatedShutdownBehavior') == 'stop':
+        launch_template_changes['InstanceInitiatedShutdownBehavior'] = 'terminate'
+
+    block_device_mappings = copy.deepcopy(launch_template_data.get('BlockDeviceMappings', []))
+    for device in block_device_mappings:
+        if 'Ebs' in device and device['Ebs'].get('VolumeSize', 0) < min_root_ebs_size_gb:
+            device['Ebs'].update({
+                'VolumeSize': min_root_ebs_size_gb,
+                'VolumeType': 'gp2'})
+            # A new version's block device mappings replace the old ones
+            # outright, so we pass them all along.
+            launch_template_changes['BlockDeviceMappings'] = block_device_mappings
+
+    return launch_template_changes
+
+
+def create_launch_template_version(
+        *,
+        launch_template_id: str,
+        region: str,
+        launch_template_data: dict) -> str:
+    """
+    Create a version of a launch template that makes the given changes to its
+    default version, and return the new version's number.
+
+    The default version is left alone, so the changes only apply to launches
+    that ask for the new version.
+    """
+    client = get_ec2_resource(region=region).meta.client
+    response = client.create_launch_template_version(
+        LaunchTemplateId=launch_template_id,
+        SourceVersion='$Default',
+        LaunchTemplateData=launch_template_data)
+    return str(response['LaunchTemplateVersion']['VersionNumber'])
+
+
+def delete_launch_template(*, launch_template_id: str, region: str):
+    client = get_ec2_resource(region=region).meta.client
+    try:
+        client.delete_launch_template(LaunchTemplateId=launch_template_id)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] != 'InvalidLaunchTemplateId.NotFound':
+            raise
+
+
+def get_availability_zone_subnet_id(*, region: str, vpc_id: str, availability_zone: str) -> str:
+    """
+    Get a subnet of the given VPC in the given AZ, preferring the AZ's
+    default subnet.
+    """
+    client = get_ec2_resource(region=region).meta.client
+    subnets = client.describe_subnets(
+        Filters=[
+            {'Name': 'vpc-id', 'Values': [vpc_id]},
+            {'Name': 'availability-zone', 'Values': [availability_zone]},
+        ])['Subnets']
+    if not subnets:
+        raise Error(
+            "VPC {v} has no subnet in availability zone {z}, so Flintrock "
+            "can't fall back to it.".format(v=vpc_id, z=availability_zone))
+    subnet = sorted(subnets, key=lambda s: (not s.get('DefaultForAz', False), s['SubnetId']))[0]
+    return subnet['SubnetId']
+
+
+def get_launch_overrides(
+        *,
+        region: str,
+        vpc_id: str,
+        instance_types: list,
+        subnet_id: str,
+        alternate_subnet_ids: list=(),
+        alternate_availability_zones: list=()) -> list:
+    """
+    Get the combinations of instance type and placement we can launch
+    instances with, in order of preference, as EC2 Fleet launch template
+    overrides.
+
+    The first placement is subnet_id, or the launch template's own placement
+    if that's empty. The alternate subnets and AZs follow. Each alternate AZ
+    is placed in a subnet of the cluster's VPC, since that's where the
+    cluster's security groups live.
+    """
+    ec2 = get_ec2_resource(region=region)
+
+    placements = [{'SubnetId': subnet_id} if subnet_id else {}]
+    for alternate_subnet_id in alternate_subnet_ids:
+        # The override's AZ has to match its subnet's, whatever AZ the
+        # launch template asks for.
+        placements.append({
+            'SubnetId': alternate_subnet_id,
+            'AvailabilityZone': ec2.Subnet(alternate_subnet_id).availability_zone,
+        })
+    for availability_zone in alternate_availability_zones:
+        placements.append({
+            'SubnetId': get_availability_zone_subnet_id(
+                region=region,
+                vpc_id=vpc_id,
+                availability_zone=availability_zone),
+            'AvailabilityZone': availability_zone,
+        })
+
+    return [
+        dict(placement, InstanceType=instance_type)
+        for placement in placements
+        for instance_type in instance_types]
+
+
+def _create_instances(
+        *,
+        num_instances,
+        region,
+        spot_price,
+        assume_yes,
+        launch_template_id,
+        launch_overrides: list,
+        launch_template_version='$Default') -> 'List[boto3.resources.factory.ec2.Instance]':
+    """
+    Launch instances from a cluster's launch template.
+
+    launch_overrides lists the combinations of instance type and placement
+    that we may launch instances with, in order of preference. See
+    get_launch_overrides(). We launch as many instances as we can with the
+    first one, and fall back to the next one for the rest whenever EC2 runs
+    out of capacity. The first instance launched is always from the most
+    preferred combination that had capacity.
+
+    Spot instances are requested in one shot, so they are either granted right
+    away or not at all. If there is more than one combination to choose from,
+    then spot instances are launched through an instant EC2 Fleet instead,
+    which fills the request from whichever combinations have the most spare
+    capacity.
+
+    Spot instances always terminate on shutdown, since EC2 won't let one-time
+    spot instances stop. An instant EC2 Fleet can't override this, so the
+    launch template has to say so too.
+    """
+    ec2 = get_ec2_resource(region=region)
+    launch_template = {
+        'LaunchTemplateId': launch_template_id,
+        'Version': launch_template_version}
 
     cluster_instances = []
-    spot_requests = []
 
     try:
-        if spot_price:
-            user_data = base64.b64encode(user_data.encode('utf-8')).decode()
-            logger.info("Requesting {c} spot instances at a max price of ${p}...".format(
-                c=num_instances, p=spot_price))
-            client = ec2.meta.client
-            spot_requests = client.request_spot_instances(
-                SpotPrice=str(spot_price),
-                InstanceCount=num_instances,
-                ValidUntil=spot_request_valid_until,
-                LaunchSpecification={
-                    'ImageId': ami,
-                    'KeyName': key_name,
-                    'InstanceType': instance_type,
-                    'BlockDeviceMappings': block_device_mappings,
-                    'Placement': {
-                        'AvailabilityZone': availability_zone,
-                        'GroupName': placement_group},
-                    'SecurityGroupIds': security_group_ids,
-                    'SubnetId': subnet_id,
-                    'IamInstanceProfile': {
-                        'Arn': instance_profile_arn},
-                    'EbsOptimized': ebs_optimized,
-                    'UserData': user_data})['SpotInstanceRequests']
-
-            request_ids = [r['SpotInstanceRequestId'] for r in spot_requests]
-            pending_request_ids = request_ids
-
-            while pending_request_ids:
-                logger.info("{grant} of {req} instances granted. Waiting...".format(
-                    grant=num_instances - len(pending_request_ids),
-                    req=num_instances))
-                time.sleep(30)
-                spot_requests = client.describe_spot_instance_requests(
-                    SpotInstanceRequestIds=request_ids)['SpotInstanceRequests']
-
-                failed_requests = [r for r in spot_requests if r['State'] == 'failed']
-                if failed_requests:
-                    failure_reasons = {r['Status']['Code'] for r in failed_requests}
-                    raise Error(
-                        "The spot request failed for the following reason{s}: {reasons}"
-                        .format(
-                            s='' if len(failure_reasons) == 1 else 's',
-                            reasons=', '.join(failure_reasons)))
-
-                pending_request_ids = [
-                    r['SpotInstanceRequestId'] for r in spot_requests
-                    if r['State'] == 'open']
-
-            logger.info("All {c} instances granted.".format(c=num_instances))
-
-            cluster_instances = list(
-                ec2.instances.filter(
-                    Filters=[
-                        {'Name': 'instance-id', 'Values': [r['InstanceId'] for r in spot_requests]}
-                    ]))
+        if spot_price and len(launch_overrides) > 1:
+            logger.info(
+                "Requesting {c} spot instances at a max price of ${p} "
+                "across {n} instance type and placement combinations...".format(
+                    c=num_instances, p=spot_price, n=len(launch_overrides)))
+            response = ec2.meta.client.create_fleet(
+                Type='instant',
+                TargetCapacitySpecification={
+                    'TotalTargetCapacity': num_instances,
+                    'DefaultTargetCapacityType': 'spot'},
+                SpotOptions={
+                    'AllocationStrategy': 'capacity-optimized'},
+                LaunchTemplateConfigs=[{
+                    'LaunchTemplateSpecification': launch_template,
+                    'Overrides': [
+                        dict(override, MaxPrice=str(spot_price))
+                        for override in launch_overrides]}])
+            instance_ids = [
+                instance_id
+                for fleet_instances in response['Instances']
+                for instance_id in fleet_instances['InstanceIds']]
+            cluster_instances = _get_launched_instances(ec2=ec2, instance_ids=instance_ids)
+
+            if len(cluster_instances) < num_instances:
+                failure_reasons = {e['ErrorCode'] for e in response['Errors']}
+                raise Error(
+                    "The spot request failed for the following reason{s}: {reasons}"
+                    .format(
+                        s='' if len(failure_reasons) == 1 else 's',
+                        reasons=', '.join(failure_reasons)))
         else:
-            # Move this to flintrock.py?
-            logger.info("Launching {c} instance{s}...".format(
-                c=num_instances,
-                s='' if num_instances == 1 else 's'))
-
-            # TODO: If an exception is raised in here, some instances may be
-            #       left stranded.
-            cluster_instances = ec2.create_instances(
-                MinCount=num_instances,
-                MaxCount=num_instances,
-                ImageId=ami,
-                KeyName=key_name,
-                InstanceType=instance_type,
-                BlockDeviceMappings=block_device_mappings,
-                Placement={
-                    'AvailabilityZone': availability_zone,
-                    'Tenancy': tenancy,
-                    'GroupName': placement_group},
-                SecurityGroupIds=security_group_ids,
-                SubnetId=subnet_id,
-                IamInstanceProfile={
-                    'Arn': instance_profile_arn},
-                EbsOptimized=ebs_optimized,
-                InstanceInitiatedShutdownBehavior=instance_initiated_shutdown_behavior,
-                UserData=user_data)
-        time.sleep(10)  # AWS metadata eventual consistency tax.
+            launch_options = {}
+            if spot_price:
+                logger.info("Requesting {c} spot instances at a max price of ${p}...".format(
+                    c=num_instances, p=spot_price))
+                launch_options['InstanceMarketOptions'] = {
+                    'MarketType': 'spot',
+                    'SpotOptions': {
+                        'MaxPrice': str(spot_price),
+                        'SpotInstanceType': 'one-time'}}
+                launch_options['InstanceInitiatedShutdownBehavior'] = 'terminate'
+            else:
+                # Move this to flintrock.py?
+                logger.info("Launching {c} instance{s}...".format(
+                    c=num_instances,
+                    s='' if num_instances == 1 else 's'))
+
+            for i, override in enumerate(launch_overrides):
+                num_remaining = num_instances - len(cluster_instances)
+                is_last_resort = (i == len(launch_overrides) - 1)
+                placement_options = {}
+                if override.get('SubnetId'):
+                    placement_options['SubnetId'] = override['SubnetId']
+                if override.get('AvailabilityZone'):
+                    placement_options['Placement'] = {
+                        'AvailabilityZone': override['AvailabilityZone']}
+                try:
+                    cluster_instances += ec2.create_instances(
+                        # Take whatever we can get unless there's nothing
+                        # left to fall back to.
+                        MinCount=num_remaining if is_last_resort else 1,
+                        MaxCount=num_remaining,
+                        LaunchTemplate=launch_template,
+                        InstanceType=override['InstanceType'],
+                        **placement_options,
+                        **launch_options)
+                except botocore.exceptions.ClientError as e:
+                    if is_last_resort or e.response['Error']['Code'] not in LAUNCH_FALLBACK_ERROR_CODES:
+                        raise
+                    logger.warning(
+                        "Could not launch {t} instances in {p}: {c}. Falling back to {nt} in {np}.".format(
+                            t=override['InstanceType'],
+                            p=_describe_placement(override),
+                            c=e.response['Error']['Code'],
+                            nt=launch_overrides[i + 1]['InstanceType'],
+                            np=_describe_placement(launch_overrides[i + 1])))
+                    continue
+                if len(cluster_instances) == num_instances:
+                    break
         return cluster_instances
     except (Exception, KeyboardInterrupt) as e:
         if not isinstance(e, KeyboardInterrupt):
             print(e, file=sys.stderr)
-        if spot_requests:
-            request_ids = [r['SpotInstanceRequestId'] for r in spot_requests]
-            if any([r['State'] != 'active' for r in spot_requests]):
-                print("Canceling spot instance requests...", file=sys.stderr)
-                client.cancel_spot_instance_requests(
-                    SpotInstanceRequestIds=request_ids)
-            # Make sure we have the latest information on any launched spot instances.
-            spot_requests = client.describe_spot_instance_requests(
-                SpotInstanceRequestIds=request_ids)['SpotInstanceRequests']
-            instance_ids = [
-                r['InstanceId'] for r in spot_requests
-                if 'InstanceId' in r]
-            if instance_ids:
-                cluster_instances = list(
-                    ec2.instances.filter(
-                        Filters=[
-                            {'Name': 'instance-id', 'Values': instance_ids}
-                        ]))
         raise InterruptedEC2Operation(instances=cluster_instances) from e
 
 
+def _describe_placement(override: dict) -> str:
+    return override.get('SubnetId') or override.get('AvailabilityZone') or 'the default placement'
+
+
+def _get_launched_instances(*, ec2, instance_ids: list) -> list:
+    """
+    Get Instance resources for instances we just launched.
+
+    EC2 may not be able to describe the instances yet, so rather than load
+    them we mark them as pending and let wait_for_state() fill them in.
+    """
+    instances = []
+    for instance_id in instance_ids:
+        instance = ec2.Instance(instance_id)
+        instance.meta.data = {
+            'InstanceId': instance_id,
+            'State': {'Code': 0, 'Name': 'pending'}}
+        instances.append(instance)
+    return instances
+
+
+def _tag_instances(*, region: str, instances: list, tags: list):
+    """
+    Tag instances, retrying while EC2 catches up with ones we just launched.
+    """
+    client = get_ec2_resource(region=region).meta.client
+
+    for attempt in range(TAG_MAX_ATTEMPTS):
+        try:
+            client.create_tags(
+                Resources=[i.id for i in instances],
+                Tags=tags)
+            return
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] != 'InvalidInstanceID.NotFound' or attempt == TAG_MAX_ATTEMPTS - 1:
+                raise
+            time.sleep(0.5 * 2 ** attempt)
+
+
 @timeit
 def launch(
         *,
@@ -803,7 +1509,6 @@ def launch(
         user,
         security_groups,
         spot_price=None,
-        spot_request_duration=None,
         min_root_ebs_size_gb,
         vpc_id,
         subnet_id,
@@ -813,59 +1518,90 @@ def launch(
         ebs_optimized=False,
         instance_initiated_shutdown_behavior='stop',
         user_data,
-        tags):
+        tags,
+        alternate_instance_types=(),
+        alternate_subnet_ids=(),
+        alternate_availability_zones=(),
+        master_instance_type=None):
     """
     Launch a cluster.
+
+    The slaves are launched with instance_type, and so is the master unless
+    master_instance_type says otherwise.
+
+    If EC2 runs short of capacity for instance_type in the cluster's subnet or
+    AZ, then the cluster is filled out with the alternate instance types,
+    subnets, and AZs, in that order of preference.
     """
-    if not vpc_id:
-        vpc_id = get_default_vpc(region=region).id
-    else:
-        # If it's a non-default VPC -- i.e. the user set it up -- make sure it's
-        # configured correctly.
-        check_network_config(
-            region_name=region,
+    def check_cluster_does_not_exist():
+        try:
+            get_cluster(
+                cluster_name=cluster_name,
+                region=region,
+                vpc_id=vpc_id)
+        except ClusterNotFound as e:
+            pass
+        else:
+            raise ClusterAlreadyExists(
+                "Cluster {c} already exists in region {r}, VPC {v}.".format(
+                    c=cluster_name,
+                    r=region,
+                    v=vpc_id))
+
+    # These lookups are independent of each other, save for needing the VPC,
+    # so we make them all at once. Creating the Flintrock security groups
+    # waits on the checks, though, since it changes things.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=6) as executor:
+        block_device_mappings_future = executor.submit(
+            get_ec2_block_device_mappings,
+            min_root_ebs_size_gb=min_root_ebs_size_gb,
+            ami=ami,
+            region=region)
+        instance_profile_arn_future = executor.submit(
+            get_instance_profile_arn,
+            instance_profile_name=instance_profile_name,
+            region=region)
+        client_ip_future = executor.submit(get_client_ip)
+
+        if not vpc_id:
+            vpc_id = get_default_vpc(region=region).id
+            network_check_future = None
+        else:
+            # If it's a non-default VPC -- i.e. the user set it up -- make sure it's
+            # configured correctly.
+            network_check_future = executor.submit(
+                check_network_config,
+                region_name=region,
+                vpc_id=vpc_id,
+                subnet_id=subnet_id)
+
+        cluster_check_future = executor.submit(check_cluster_does_not_exist)
+        user_security_groups_future = executor.submit(
+            get_security_groups,
             vpc_id=vpc_id,
-            subnet_id=subnet_id)
+            region=region,
+            security_group_names=security_groups)
 
-    try:
-        get_cluster(
+        if network_check_future:
+            network_check_future.result()
+        cluster_check_future.result()
+
+        flintrock_security_groups = get_or_create_flintrock_security_groups(
             cluster_name=cluster_name,
+            vpc_id=vpc_id,
             region=region,
-            vpc_id=vpc_id)
-    except ClusterNotFound as e:
-        pass
-    else:
-        raise ClusterAlreadyExists(
-            "Cluster {c} already exists in region {r}, VPC {v}.".format(
-                c=cluster_name,
-                r=region,
-                v=vpc_id))
+            services=services,
+            client_ip=client_ip_future.result())
+        user_security_groups = user_security_groups_future.result()
+        block_device_mappings = block_device_mappings_future.result()
+        instance_profile_arn = instance_profile_arn_future.result()
 
-    flintrock_security_groups = get_or_create_flintrock_security_groups(
-        cluster_name=cluster_name,
-        vpc_id=vpc_id,
-        region=region,
-        services=services)
-    user_security_groups = get_security_groups(
-        vpc_id=vpc_id,
-        region=region,
-        security_group_names=security_groups)
     security_group_ids = [sg.id for sg in user_security_groups + flintrock_security_groups]
-    block_device_mappings = get_ec2_block_device_mappings(
-        min_root_ebs_size_gb=min_root_ebs_size_gb,
-        ami=ami,
-        region=region)
-
-    ec2 = boto3.resource(service_name='ec2', region_name=region)
-    iam = boto3.resource(service_name='iam', region_name=region)
-
-    # We use IAM profile ARNs internally because AWS's API prefers that in
-    # a few places.
-    # See: https://github.com/boto/boto3/issues/769
-    if instance_profile_name:
-        instance_profile_arn = iam.InstanceProfile(instance_profile_name).arn
-    else:
-        instance_profile_arn = ''
+
+    # EC2 won't let one-time spot instances stop, and the spot fleet we may
+    # launch them through takes this from the launch template.
+    if spot_price:
+        instance_initiated_shutdown_behavior = 'terminate'
 
     num_instances = num_slaves + 1
     if user_data is not None:
@@ -873,19 +1609,33 @@ def launch(
     else:
         user_data = ''
 
-    if spot_request_duration is None:
-        spot_request_valid_until = datetime.now(tz=timezone.utc) + timedelta(days=7)
-    else:
-        spot_request_valid_until = datetime.now(tz=timezone.utc) + duration_to_timedelta(spot_request_duration)
-
-    try:
-        cluster_instances = _create_instances(
-            num_instances=num_instances,
+    launch_overrides = get_launch_overrides(
+        region=region,
+        vpc_id=vpc_id,
+        instance_types=[instance_type] + list(alternate_instance_types),
+        subnet_id=subnet_id,
+        alternate_subnet_ids=alternate_subnet_ids,
+        alternate_availability_zones=alternate_availability_zones)
+
+    master_launch_overrides = None
+    if master_instance_type and master_instance_type != instance_type:
+        master_launch_overrides = get_launch_overrides(
             region=region,
-            spot_price=spot_price,
-            spot_request_valid_until=spot_request_valid_until,
+            vpc_id=vpc_id,
+            instance_types=[master_instance_type],
+            subnet_id=subnet_id,
+            alternate_subnet_ids=alternate_subnet_ids,
+            alternate_availability_zones=alternate_availability_zones)
+
+    # Everything the cluster launches, now or when adding slaves later, is
+    # launched from this template so that all its nodes are configured alike.
+    # The template's instance type is the slaves'.
+    launch_template_id = create_launch_template(
+        cluster_name=cluster_name,
+        vpc_id=vpc_id,
+        region=region,
+        launch_template_data=get_launch_template_data(
             ami=ami,
-            assume_yes=assume_yes,
             key_name=key_name,
             instance_type=instance_type,
             block_device_mappings=block_device_mappings,
@@ -893,11 +1643,39 @@ def launch(
             placement_group=placement_group,
             tenancy=tenancy,
             security_group_ids=security_group_ids,
-            subnet_id=subnet_id,
             instance_profile_arn=instance_profile_arn,
             ebs_optimized=ebs_optimized,
             instance_initiated_shutdown_behavior=instance_initiated_shutdown_behavior,
-            user_data=user_data)
+            user_data=user_data))
+    tags = tags + [{'Key': LAUNCH_TEMPLATE_TAG, 'Value': launch_template_id}]
+
+    try:
+        if master_launch_overrides:
+            cluster_instances = _create_instances(
+                num_instances=1,
+                region=region,
+                spot_price=spot_price,
+                assume_yes=assume_yes,
+                launch_template_id=launch_template_id,
+                launch_overrides=master_launch_overrides)
+            try:
+                cluster_instances += _create_instances(
+                    num_instances=num_slaves,
+                    region=region,
+                    spot_price=spot_price,
+                    assume_yes=assume_yes,
+                    launch_template_id=launch_template_id,
+                    launch_overrides=launch_overrides)
+            except InterruptedEC2Operation as e:
+                raise InterruptedEC2Operation(instances=cluster_instances + e.instances) from e
+        else:
+            cluster_instances = _create_instances(
+                num_instances=num_instances,
+                region=region,
+                spot_price=spot_price,
+                assume_yes=assume_yes,
+                launch_template_id=launch_template_id,
+                launch_overrides=launch_overrides)
 
         master_instance = cluster_instances[0]
         slave_instances = cluster_instances[1:]
@@ -907,24 +1685,20 @@ def launch(
             {'Key': 'Name', 'Value': '{c}-master'.format(c=cluster_name)}]
         master_tags += tags
 
-        (ec2.instances
-            .filter(
-                Filters=[
-                    {'Name': 'instance-id', 'Values': [master_instance.id]}
-                ])
-            .create_tags(Tags=master_tags))
+        _tag_instances(
+            region=region,
+            instances=[master_instance],
+            tags=master_tags)
 
         slave_tags = [
             {'Key': 'flintrock-role', 'Value': 'slave'},
             {'Key': 'Name', 'Value': '{c}-slave'.format(c=cluster_name)}]
         slave_tags += tags
 
-        (ec2.instances
-            .filter(
-                Filters=[
-                    {'Name': 'instance-id', 'Values': [i.id for i in slave_instances]}
-                ])
-            .create_tags(Tags=slave_tags))
+        _tag_instances(
+            region=region,
+            instances=slave_instances,
+            tags=slave_tags)
 
         cluster = EC2Cluster(
             name=cluster_name,
@@ -952,11 +1726,15 @@ def launch(
             #       defined.
             # See: https://github.com/nchammas/flintrock/issues/183
             cleanup_instances = cluster_instances
-        _cleanup_instances(
+        terminated = _cleanup_instances(
             instances=cleanup_instances,
             assume_yes=assume_yes,
             region=region,
         )
+        if terminated or not cleanup_instances:
+            delete_launch_template(
+                launch_template_id=launch_template_id,
+                region=region)
         raise
 
 
@@ -979,7 +1757,7 @@ def get_clusters(*, cluster_names: list=[], region: str, vpc_id: str) -> list:
     regardless of how many clusters we have to look up. That's because querying
     AWS -- a network operation -- is by far the slowest step.
     """
-    ec2 = boto3.resource(service_name='ec2', region_name=region)
+    ec2 = get_ec2_resource(region=region)
     if not vpc_id:
         vpc_id = get_default_vpc(region=region).id
 
@@ -1104,8 +1882,134 @@ def _compose_cluster(*, name: str, region: str, vpc_id: str, instances: list) ->
     return cluster
 
 
-def _cleanup_instances(*, instances: list, assume_yes: bool, region: str):
-    ec2 = boto3.resource(service_name='ec2', region_name=region)
+def _wait_for_instances(
+        *,
+        client,
+        instances: list,
+        state: str,
+        on_transition=None):
+    """
+    Wait for EC2 instances to reach a specific state, updating their metadata
+    in place.
+
+    Only the instances that have yet to reach the state are polled. They are
+    described in batches straight through the EC2 client, a page at a time,
+    so that we make few calls even for very large clusters.
+
+    on_transition, if set, is called with each instance and its previous
+    state whenever the instance changes state.
+    """
+    instances_by_id = {i.id: i for i in instances}
+    waiting_ids = sorted(i.id for i in instances if i.state['Name'] != state)
+    interval = STATE_POLL_MIN_INTERVAL_SECONDS
+    paginator = client.get_paginator('describe_instances')
+
+    while waiting_ids:
+        if logger.isEnabledFor(logging.DEBUG):
+            sample = ', '.join(["'{}'".format(i) for i in waiting_ids][:3])
+            logger.debug("{size} instances not in state '{state}': {sample}, ...".format(size=len(waiting_ids), state=state, sample=sample))
+        time.sleep(interval)
+
+        num_transitions = 0
+        for start in range(0, len(waiting_ids), EC2_MAX_FILTER_VALUES):
+            # NOTE: We use Filters instead of InstanceIds to avoid
+            #       the issue described here: https://github.com/boto/boto3/issues/479
+            pages = paginator.paginate(
+                Filters=[
+                    {'Name': 'instance-id', 'Values': waiting_ids[start:start + EC2_MAX_FILTER_VALUES]}
+                ])
+            for page in pages:
+                for reservation in page['Reservations']:
+                    for description in reservation['Instances']:
+                        instance = instances_by_id[description['InstanceId']]
+                        previous_state = instance.state['Name']
+                        instance.meta.data = description
+                        if description['State']['Name'] != previous_state:
+                            num_transitions += 1
+                            if on_transition:
+                                on_transition(instance, previous_state)
+
+        waiting_ids = [i for i in waiting_ids if instances_by_id[i].state['Name'] != state]
+
+        if num_transitions:
+            interval = STATE_POLL_MIN_INTERVAL_SECONDS
+        else:
+            interval = min(interval * 2, STATE_POLL_MAX_INTERVAL_SECONDS)
+
+
+def _set_instance_security_groups(*, region: str, instances: list, group_ids: list):
+    """
+    Replace the security groups of the given instances.
+
+    EC2 only lets us do this one instance at a time, so we make the calls
+    concurrently.
+    """
+    if not instances:
+        return
+    client = get_ec2_resource(region=region).meta.client
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(MODIFY_INSTANCE_PARALLELISM, len(instances))) as executor:
+        futures = [
+            executor.submit(
+                client.modify_instance_attribute,
+                InstanceId=instance.id,
+                Groups=group_ids)
+            for instance in instances]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+
+
+def _terminate_instances(*, region: str, instances: list):
+    """
+    Start terminating the given instances, in as few calls as possible.
+    """
+    client = get_ec2_resource(region=region).meta.client
+    instance_ids = [i.id for i in instances]
+
+    for start in range(0, len(instance_ids), EC2_MAX_FILTER_VALUES):
+        client.terminate_instances(InstanceIds=instance_ids[start:start + EC2_MAX_FILTER_VALUES])
+
+
+def _delete_security_group(
+        *,
+        region: str,
+        group_id: str,
+        timeout_seconds: float=SECURITY_GROUP_DELETE_TIMEOUT_SECONDS) -> bool:
+    """
+    Delete a security group, retrying for as long as something still depends
+    on it, up to timeout_seconds.
+
+    Return whether the group was deleted. If it's still in use when we run
+    out of time, we warn about it rather than fail, since whatever we were
+    tearing down is gone by then.
+    """
+    client = get_ec2_resource(region=region).meta.client
+    deadline = time.monotonic() + timeout_seconds
+    interval = STATE_POLL_MIN_INTERVAL_SECONDS
+
+    while True:
+        try:
+            client.delete_security_group(GroupId=group_id)
+            return True
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] != 'DependencyViolation':
+                raise
+        if time.monotonic() >= deadline:
+            logger.warning(
+                "Security group {g} is still in use, so Flintrock could not delete it. "
+                "Delete it yourself once the instances using it have terminated.".format(g=group_id))
+            return False
+        logger.debug("Security group {g} is still in use. Retrying deletion in {i} seconds...".format(
+            g=group_id, i=interval))
+        time.sleep(interval)
+        interval = min(interval * 2, STATE_POLL_MAX_INTERVAL_SECONDS)
+
+
+def _cleanup_instances(*, instances: list, assume_yes: bool, region: str) -> bool:
+    """
+    Offer to terminate the given instances, and return whether we did.
+    """
     if instances:
         if not assume_yes:
             yes = click.confirm(
@@ -1116,9 +2020,6 @@ def _cleanup_instances(*, instances: list, assume_yes: bool, region: str):
 
         if assume_yes or yes:
             print("Terminating instances...", file=sys.stderr)
-            (ec2.instances
-                .filter(
-                    Filters=[
-                        {'Name': 'instance-id', 'Values': [i.id for i in instances]}
-                    ])
-                .terminate())
+            _terminate_instances(region=region, instances=instances)
+            return True
+    return False
@@ -1,15 +1,19 @@
 import os
 import posixpath
 import errno
+import http.client
 import json
 import resource
 import sys
 import shutil
 import textwrap
+import time
+from datetime import datetime
 import urllib.parse
 import urllib.request
 import warnings
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 # External modules
 import click
@@ -30,6 +34,8 @@ from .exceptions import (
     Error)
 from flintrock import __version__
 from .services import HDFS, Spark  # TODO: Remove this dependency.
+from .core import JobStatus
+from .util import clear_cache, get_cache_dir, read_cache, set_cache_enabled, write_cache
 
 FROZEN = getattr(sys, 'frozen', False)
 
@@ -38,6 +44,16 @@ if FROZEN:
 else:
     THIS_DIR = os.path.dirname(os.path.realpath(__file__))
 
+APACHE_DOWNLOADS_URL = 'https://downloads.apache.org/'
+MAX_MIRROR_CANDIDATES = 8
+MAX_SELECTED_MIRRORS = 3
+MIRROR_PROBE_BYTES = 256 * 1024
+MIRROR_PROBE_TIMEOUT_SECONDS = 5
+# Mirrors are ranked by how long they would take to serve a package of
+# roughly this size, which balances latency against throughput.
+MIRROR_RANKING_PACKAGE_BYTES = 256 * 1024 * 1024
+MIRROR_RANKING_TTL_SECONDS = 6 * 60 * 60
+
 
 logger = logging.getLogger('flintrock.flintrock')
 
@@ -205,7 +221,7 @@ def validate_download_source(url):
             )
         )
         try:
-            urllib.request.urlopen(url)
+            mirrors = select_download_mirrors(url)
         except urllib.error.HTTPError as e:
             raise Error(
                 "Error: Could not access {software} download. Maybe try a more recent release?\n"
@@ -217,6 +233,130 @@ def validate_download_source(url):
                     code=e.code,
                 )
             )
+        if mirrors:
+            logger.info(
+                "Downloading {software} from the fastest mirror: {m}"
+                .format(software=software, m=mirrors[0]))
+        return mirrors
+
+    return []
+
+
+def get_apache_mirror_candidates(url: str) -> list:
+    """
+    Get the URLs a download from the Apache mirror system is available at.
+    The mirror Apache prefers for us comes first.
+    """
+    parsed_url = urllib.parse.urlparse(url)
+    query = urllib.parse.parse_qs(parsed_url.query)
+    query.pop('action', None)
+    query['as_json'] = ['1']
+    json_url = parsed_url._replace(query=urllib.parse.urlencode(query, doseq=True)).geturl()
+
+    with urllib.request.urlopen(json_url, timeout=MIRROR_PROBE_TIMEOUT_SECONDS) as response:
+        mirrors_info = json.loads(response.read().decode('utf-8'))
+
+    mirrors = [mirrors_info['preferred']]
+    mirrors += mirrors_info.get('http', [])
+    mirrors += mirrors_info.get('backup', [])
+    mirrors = mirrors[:MAX_MIRROR_CANDIDATES] + [APACHE_DOWNLOADS_URL]
+
+    candidates = []
+    for mirror in mirrors:
+        candidate = mirror.rstrip('/') + '/' + mirrors_info['path_info'].lstrip('/')
+        if candidate not in candidates:
+            candidates.append(candidate)
+    return candidates
+
+
+def probe_mirror(url: str) -> dict:
+    """
+    Fetch the first few bytes of a download to measure how quickly the server
+    responds and how fast it sends data.
+    """
+    request = urllib.request.Request(
+        url,
+        headers={'Range': 'bytes=0-{e}'.format(e=MIRROR_PROBE_BYTES - 1)})
+
+    start_time = time.monotonic()
+    with urllib.request.urlopen(request, timeout=MIRROR_PROBE_TIMEOUT_SECONDS) as response:
+        latency = time.monotonic() - start_time
+        num_bytes = len(response.read(MIRROR_PROBE_BYTES))
+    transfer_time = time.monotonic() - start_time - latency
+
+    return {
+        'url': url,
+        'latency': latency,
+        'throughput': num_bytes / max(transfer_time, 0.001),
+    }
+
+
+def rank_mirror_probes(probes: list) -> list:
+    """
+    Order mirror URLs from fastest to slowest based on their probes.
+    """
+    def estimated_download_time(probe):
+        return probe['latency'] + MIRROR_RANKING_PACKAGE_BYTES / max(probe['throughput'], 1)
+
+    return [probe['url'] for probe in sorted(probes, key=estimated_download_time)]
+
+
+def select_download_mirrors(url: str) -> list:
+    """
+    Find the fastest mirrors for a download from the Apache mirror system.
+
+    The candidate mirrors are probed in parallel and the ranking is cached
+    for a few hours. Return an empty list if the download is not from the
+    Apache mirror system or if no mirror could be reached, in which case the
+    nodes should use the original URL.
+
+    Raise an HTTP error if Apache's own download server doesn't have the
+    download, or if every mirror refused it. Raise an Error if we can't get
+    the list of mirrors, since then we can't tell whether the download exists.
+    """
+    parsed_url = urllib.parse.urlparse(url)
+    if not (parsed_url.netloc == 'www.apache.org' and parsed_url.path == '/dyn/closer.lua'):
+        return []
+
+    cache_key = 'apache-mirrors:' + url
+    mirrors = read_cache(cache_key, max_age_seconds=MIRROR_RANKING_TTL_SECONDS)
+    if mirrors:
+        logger.debug("Using cached mirror ranking for {u}.".format(u=url))
+        return mirrors
+
+    try:
+        candidates = get_apache_mirror_candidates(url)
+    except (OSError, http.client.HTTPException, ValueError, KeyError) as e:
+        raise Error(
+            "Error: Could not get a list of Apache mirrors for {u}: {e}"
+            .format(u=url, e=e)) from e
+
+    probes = []
+    errors = []
+    with ThreadPoolExecutor(max_workers=len(candidates)) as executor:
+        futures = {candidate: executor.submit(probe_mirror, candidate) for candidate in candidates}
+        for candidate, future in futures.items():
+            try:
+                probes.append(future.result())
+            except (OSError, http.client.HTTPException) as e:
+                logger.debug("Mirror probe failed: {e}".format(e=e))
+                # Apache's own server has every current release, so if it
+                # doesn't have this one, no mirror does.
+                if candidate.startswith(APACHE_DOWNLOADS_URL) and \
+                        isinstance(e, urllib.error.HTTPError) and e.code == 404:
+                    raise
+                errors.append(e)
+
+    mirrors = rank_mirror_probes(probes)[:MAX_SELECTED_MIRRORS]
+    if not mirrors:
+        http_errors = [e for e in errors if isinstance(e, urllib.error.HTTPError)]
+        if len(http_errors) == len(errors):
+            raise http_errors[0]
+        logger.warning("Warning: Could not reach any Apache mirror.")
+        return []
+
+    write_cache(cache_key, mirrors)
+    return mirrors
 
 
 @click.group()
@@ -228,8 +368,11 @@ def validate_download_source(url):
 @click.version_option(version=__version__)
 # TODO: implement some solution like in https://github.com/pallets/click/issues/108
 @click.option('--debug/--no-debug', default=False, help="Show debug information.")
+@click.option('--cache/--no-cache', default=True,
+              help="Reuse recent lookups of things that rarely change, like your public IP, "
+                   "AMI details, and the default VPC.  [default: cache]")
 @click.pass_context
-def cli(cli_context, config, provider, debug):
+def cli(cli_context, config, provider, debug, cache):
     """
     Flintrock
 
@@ -248,6 +391,7 @@ def cli(cli_context, config, provider, debug):
         if config != get_config_file():
             raise FileNotFoundError(errno.ENOENT, 'No such file', config)
     configure_log(debug=debug)
+    set_cache_enabled(cache)
 
 
 @cli.command()
@@ -283,12 +427,20 @@ def cli(cli_context, config, provider, debug):
               help="Git repository to clone Spark from.",
               default='https://github.com/apache/spark',
               show_default=True)
+@click.option('--spark-git-build-cache/--no-spark-git-build-cache', default=False,
+              help="Download the Spark build to a local cache, so relaunching at "
+                   "the same commit skips the build. Builds are a few hundred MB.  "
+                   "[default: no-spark-git-build-cache]")
 @click.option('--assume-yes/--no-assume-yes', default=False)
 @click.option('--ec2-key-name')
 @click.option('--ec2-identity-file',
               type=click.Path(exists=True, dir_okay=False),
               help="Path to SSH .pem file for accessing nodes.")
-@click.option('--ec2-instance-type', default='m5.medium', show_default=True)
+@click.option('--ec2-instance-type', default='m5.medium', show_default=True,
+              help="Instance type for the slaves, and for the master too unless "
+                   "--ec2-master-instance-type is set.")
+@click.option('--ec2-master-instance-type',
+              help="Instance type for the master, if it should differ from the slaves'.")
 @click.option('--ec2-region', default='us-east-1', show_default=True)
 # We set some of these defaults to empty strings because of boto3's parameter validation.
 # See: https://github.com/boto/boto3/issues/400
@@ -300,17 +452,35 @@ def cli(cli_context, config, provider, debug):
               help="Additional security groups names to assign to the instances. "
                    "You can specify this option multiple times.")
 @click.option('--ec2-spot-price', type=float)
-@click.option('--ec2-spot-request-duration', default='7d',
-              help="Duration a spot request is valid (e.g. 3d 2h 1m).")
+# Spot instances are requested in one shot, so there is no longer a
+# standing spot request for this to apply to.
+@click.option('--ec2-spot-request-duration', hidden=True,
+              help="Deprecated. Ignored.")
 @click.option('--ec2-min-root-ebs-size-gb', type=int, default=30)
 @click.option('--ec2-vpc-id', default='', help="Leave empty for default VPC.")
 @click.option('--ec2-subnet-id', default='')
+@click.option('--ec2-alternate-instance-type', 'ec2_alternate_instance_types',
+              multiple=True,
+              help="Instance type to fall back to if EC2 runs out of capacity "
+                   "for the cluster's instance type. "
+                   "You can specify this option multiple times, in order of preference.")
+@click.option('--ec2-alternate-subnet-id', 'ec2_alternate_subnet_ids',
+              multiple=True,
+              help="Subnet to fall back to if EC2 runs out of capacity "
+                   "in the cluster's subnet. "
+                   "You can specify this option multiple times, in order of preference.")
+@click.option('--ec2-alternate-availability-zone', 'ec2_alternate_availability_zones',
+              multiple=True,
+              help="Availability zone to fall back to if EC2 runs out of capacity "
+                   "in the cluster's availability zone. "
+                   "You can specify this option multiple times, in order of preference.")
 @click.option('--ec2-instance-profile-name', default='')
 @click.option('--ec2-placement-group', default='')
 @click.option('--ec2-tenancy', default='default')
 @click.option('--ec2-ebs-optimized/--no-ec2-ebs-optimized', default=False)
 @click.option('--ec2-instance-initiated-shutdown-behavior', default='stop',
-              type=click.Choice(['stop', 'terminate']))
+              type=click.Choice(['stop', 'terminate']),
+              help="Spot instances always terminate on shutdown.")
 @click.option('--ec2-user-data',
               type=click.File(mode='r', encoding='utf-8'),
               help="Path to EC2 user data script that will run on instance launch.")
@@ -333,11 +503,13 @@ def launch(
         spark_version,
         spark_git_commit,
         spark_git_repository,
+        spark_git_build_cache,
         spark_download_source,
         assume_yes,
         ec2_key_name,
         ec2_identity_file,
         ec2_instance_type,
+        ec2_master_instance_type,
         ec2_region,
         ec2_availability_zone,
         ec2_ami,
@@ -348,6 +520,9 @@ def launch(
         ec2_min_root_ebs_size_gb,
         ec2_vpc_id,
         ec2_subnet_id,
+        ec2_alternate_instance_types,
+        ec2_alternate_subnet_ids,
+        ec2_alternate_availability_zones,
         ec2_instance_profile_name,
         ec2_placement_group,
         ec2_tenancy,
@@ -400,36 +575,57 @@ def launch(
         option='--ec2-vpc-id',
         requires_all=['--ec2-subnet-id'],
         scope=locals())
+    if ec2_spot_request_duration:
+        logger.warning(
+            "Warning: --ec2-spot-request-duration is deprecated and has no effect. "
+            "Spot instances are now requested in one shot.")
 
     check_external_dependency('ssh-keygen')
 
+    # Checking the download sources means probing mirrors over the network,
+    # so check them all at once.
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        if install_hdfs:
+            hdfs_download_mirrors_future = executor.submit(
+                validate_download_source, hdfs_download_source)
+        if install_spark and spark_version:
+            spark_download_mirrors_future = executor.submit(
+                validate_download_source, spark_download_source)
+        if install_spark and spark_git_commit == 'latest':
+            spark_latest_commit_future = executor.submit(
+                get_latest_commit, spark_git_repository)
+
     if install_hdfs:
-        validate_download_source(hdfs_download_source)
+        hdfs_download_mirrors = hdfs_download_mirrors_future.result()
         hdfs = HDFS(
             version=hdfs_version,
             download_source=hdfs_download_source,
+            download_mirrors=hdfs_download_mirrors,
         )
         services += [hdfs]
     if install_spark:
         if spark_version:
-            validate_download_source(spark_download_source)
+            spark_download_mirrors = spark_download_mirrors_future.result()
             spark = Spark(
                 spark_executor_instances=spark_executor_instances,
                 version=spark_version,
                 hadoop_version=hdfs_version,
                 download_source=spark_download_source,
+                download_mirrors=spark_download_mirrors,
             )
         elif spark_git_commit:
             logger.warning(
                 "Warning: Building Spark takes a long time. "
-                "e.g. 15-20 minutes on an m5.xlarge instance on EC2.")
+                "e.g. 15-20 minutes on an m5.xlarge instance on EC2. "
+                "Spark is built once on the master and then copied to the slaves.")
             if spark_git_commit == 'latest':
-                spark_git_commit = get_latest_commit(spark_git_repository)
+                spark_git_commit = spark_latest_commit_future.result()
                 logger.info("Building Spark at latest commit: {c}".format(c=spark_git_commit))
             spark = Spark(
                 spark_executor_instances=spark_executor_instances,
                 git_commit=spark_git_commit,
                 git_repository=spark_git_repository,
+                git_build_cache=spark_git_build_cache,
                 hadoop_version=hdfs_version,
             )
         services += [spark]
@@ -444,13 +640,13 @@ def launch(
             key_name=ec2_key_name,
             identity_file=ec2_identity_file,
             instance_type=ec2_instance_type,
+            master_instance_type=ec2_master_instance_type,
             region=ec2_region,
             availability_zone=ec2_availability_zone,
             ami=ec2_ami,
             user=ec2_user,
             security_groups=ec2_security_groups,
             spot_price=ec2_spot_price,
-            spot_request_duration=ec2_spot_request_duration,
             min_root_ebs_size_gb=ec2_min_root_ebs_size_gb,
             vpc_id=ec2_vpc_id,
             subnet_id=ec2_subnet_id,
@@ -460,7 +656,10 @@ def launch(
             ebs_optimized=ec2_ebs_optimized,
             instance_initiated_shutdown_behavior=ec2_instance_initiated_shutdown_behavior,
             user_data=ec2_user_data,
-            tags=ec2_tags)
+            tags=ec2_tags,
+            alternate_instance_types=ec2_alternate_instance_types,
+            alternate_subnet_ids=ec2_alternate_subnet_ids,
+            alternate_availability_zones=ec2_alternate_availability_zones)
     else:
         raise UnsupportedProviderError(provider)
 
@@ -497,8 +696,10 @@ def get_latest_commit(github_repository: str):
 @click.option('--assume-yes/--no-assume-yes', default=False)
 @click.option('--ec2-region', default='us-east-1', show_default=True)
 @click.option('--ec2-vpc-id', default='', help="Leave empty for default VPC.")
+@click.option('--wait/--no-wait', default=True, show_default=True,
+              help="Wait for the cluster's instances to finish terminating.")
 @click.pass_context
-def destroy(cli_context, cluster_name, assume_yes, ec2_region, ec2_vpc_id):
+def destroy(cli_context, cluster_name, assume_yes, ec2_region, ec2_vpc_id, wait):
     """
     Destroy a cluster.
     """
@@ -525,7 +726,7 @@ def destroy(cli_context, cluster_name, assume_yes, ec2_region, ec2_vpc_id):
             abort=True)
 
     logger.info("Destroying {c}...".format(c=cluster.name))
-    cluster.destroy()
+    cluster.destroy(wait=wait)
 
 
 @cli.command()
@@ -726,9 +927,26 @@ def stop(cli_context, cluster_name, ec2_region, ec2_vpc_id, assume_yes):
               help="Path to SSH .pem file for accessing nodes.")
 @click.option('--ec2-user')
 @click.option('--ec2-spot-price', type=float)
-@click.option('--ec2-spot-request-duration', default='7d',
-              help="Duration a spot request is valid (e.g. 3d 2h 1m).")
+# Spot instances are requested in one shot, so there is no longer a
+# standing spot request for this to apply to.
+@click.option('--ec2-spot-request-duration', hidden=True,
+              help="Deprecated. Ignored.")
 @click.option('--ec2-min-root-ebs-size-gb', type=int, default=30)
+@click.option('--ec2-alternate-instance-type', 'ec2_alternate_instance_types',
+              multiple=True,
+              help="Instance type to fall back to if EC2 runs out of capacity "
+                   "for the cluster's slave instance type. "
+                   "You can specify this option multiple times, in order of preference.")
+@click.option('--ec2-alternate-subnet-id', 'ec2_alternate_subnet_ids',
+              multiple=True,
+              help="Subnet to fall back to if EC2 runs out of capacity "
+                   "in the master's subnet. "
+                   "You can specify this option multiple times, in order of preference.")
+@click.option('--ec2-alternate-availability-zone', 'ec2_alternate_availability_zones',
+              multiple=True,
+              help="Availability zone to fall back to if EC2 runs out of capacity "
+                   "in the master's availability zone. "
+                   "You can specify this option multiple times, in order of preference.")
 @click.option('--assume-yes/--no-assume-yes', default=False)
 @click.option('--ec2-tag', 'ec2_tags',
               callback=ec2.cli_validate_tags,
@@ -748,6 +966,9 @@ def add_slaves(
         ec2_spot_price,
         ec2_spot_request_duration,
         ec2_min_root_ebs_size_gb,
+        ec2_alternate_instance_types,
+        ec2_alternate_subnet_ids,
+        ec2_alternate_availability_zones,
         ec2_tags,
         assume_yes):
     """
@@ -766,6 +987,10 @@ def add_slaves(
             '--ec2-identity-file',
             '--ec2-user'],
         scope=locals())
+    if ec2_spot_request_duration:
+        logger.warning(
+            "Warning: --ec2-spot-request-duration is deprecated and has no effect. "
+            "Spot instances are now requested in one shot.")
 
     if provider == 'ec2':
         cluster = ec2.get_cluster(
@@ -777,8 +1002,10 @@ def add_slaves(
         provider_options = {
             'min_root_ebs_size_gb': ec2_min_root_ebs_size_gb,
             'spot_price': ec2_spot_price,
-            'spot_request_valid_until': ec2_spot_request_duration,
-            'tags': ec2_tags
+            'tags': ec2_tags,
+            'alternate_instance_types': ec2_alternate_instance_types,
+            'alternate_subnet_ids': ec2_alternate_subnet_ids,
+            'alternate_availability_zones': ec2_alternate_availability_zones,
         }
     else:
         raise UnsupportedProviderError(provider)
@@ -795,6 +1022,15 @@ def add_slaves(
         identity_file=identity_file)
     cluster.add_slaves_check()
 
+    for service in cluster.services:
+        if isinstance(service, (HDFS, Spark)) and service.download_source:
+            try:
+                service.download_mirrors = select_download_mirrors(service.download_source)
+            except urllib.error.HTTPError:
+                # Let the new slaves try the original download source and
+                # report the error themselves.
+                pass
+
     if provider == 'ec2':
         cluster.add_slaves(
             user=user,
@@ -883,6 +1119,22 @@ def remove_slaves(
 @click.argument('cluster-name')
 @click.argument('command', nargs=-1)
 @click.option('--master-only', help="Run on the master only.", is_flag=True)
+@click.option('--compress/--no-compress', default=False,
+              help="Compress data sent over SSH. Helps with commands that produce a lot of output.")
+@click.option('--stream/--no-stream', 'stream_output', default=True,
+              help="Print each node's output as it arrives, prefixed with the node.  [default: stream]")
+@click.option('--output-dir', type=click.Path(file_okay=False),
+              help="Also write each node's output to <output-dir>/<node>.log.")
+@click.option('--detach', is_flag=True,
+              help="Start the command in the background on each node and return a job ID "
+                   "right away. Check on it later with `flintrock job`.")
+@click.option('--relay', is_flag=True,
+              help="Send the command once to the master and have it run the command on the "
+                   "other nodes over the cluster's internal network. Useful for large clusters.")
+@click.option('--script', type=click.Path(exists=True, dir_okay=False),
+              help="Upload this script to each node and run it, with COMMAND as its arguments. "
+                   "FLINTROCK_ROLE, FLINTROCK_NODE_INDEX, FLINTROCK_PRIVATE_HOST, "
+                   "FLINTROCK_EPHEMERAL_DIRS, and similar variables tell it which node it's on.")
 @click.option('--ec2-region', default='us-east-1', show_default=True)
 @click.option('--ec2-vpc-id', default='', help="Leave empty for default VPC.")
 @click.option('--ec2-identity-file',
@@ -895,6 +1147,12 @@ def run_command(
         cluster_name,
         command,
         master_only,
+        compress,
+        stream_output,
+        output_dir,
+        detach,
+        relay,
+        script,
         ec2_region,
         ec2_vpc_id,
         ec2_identity_file,
@@ -906,6 +1164,12 @@ def run_command(
 
         flintrock run-command my-cluster 'touch /tmp/flintrock'
         flintrock run-command my-cluster -- yum install -y package
+        flintrock run-command --detach my-cluster ./load-data.sh
+        flintrock run-command --relay my-cluster 'df -h /'
+        flintrock run-command --script setup-node.sh my-cluster -- --verbose
+
+    Once the command finishes, Flintrock prints a summary that groups the
+    nodes by exit status and output, and shows how the odd ones out differ.
 
     Flintrock will return a non-zero code if any of the cluster nodes raises an error
     while running the command.
@@ -931,8 +1195,40 @@ def run_command(
     else:
         raise UnsupportedProviderError(provider)
 
+    mutually_exclusive(
+        options=['--detach', '--output-dir'],
+        scope=locals())
+    mutually_exclusive(
+        options=['--detach', '--relay'],
+        scope=locals())
+    mutually_exclusive(
+        options=['--detach', '--script'],
+        scope=locals())
+
     cluster.run_command_check()
 
+    if detach:
+        logger.info("Starting job on {target}...".format(
+            target="master only" if master_only else "cluster"))
+        job_id, hosts = cluster.start_job(
+            command=command,
+            master_only=master_only,
+            user=user,
+            identity_file=identity_file)
+        save_job({
+            'id': job_id,
+            'cluster_name': cluster_name,
+            'provider': provider,
+            'ec2_region': ec2_region,
+            'ec2_vpc_id': ec2_vpc_id,
+            'command': ' '.join(command),
+            'hosts': hosts,
+            'started': datetime.utcnow().isoformat(),
+        })
+        print("Job ID: {j}".format(j=job_id))
+        print("Check on it with: flintrock job status {j}".format(j=job_id))
+        return
+
     logger.info("Running command on {target}...".format(
         target="master only" if master_only else "cluster"))
 
@@ -940,7 +1236,202 @@ def run_command(
         command=command,
         master_only=master_only,
         user=user,
-        identity_file=identity_file)
+        identity_file=identity_file,
+        compress=compress,
+        stream_output=stream_output,
+        output_dir=output_dir,
+        relay=relay,
+        script=script)
+
+
+def get_jobs_dir() -> str:
+    jobs_dir = os.path.join(get_cache_dir(), 'jobs')
+    os.makedirs(jobs_dir, exist_ok=True)
+    return jobs_dir
+
+
+def save_job(job_info: dict):
+    with open(os.path.join(get_jobs_dir(), job_info['id'] + '.json'), 'w') as job_file:
+        json.dump(job_info, job_file, indent=4, sort_keys=True)
+
+
+def load_job(job_id: str) -> dict:
+    try:
+        with open(os.path.join(get_jobs_dir(), job_id + '.json')) as job_file:
+            return json.load(job_file)
+    except FileNotFoundError:
+        raise UsageError("Error: No job with ID {j} was started from this machine.".format(j=job_id))
+
+
+def get_job_cluster(job_info: dict):
+    if job_info['provider'] == 'ec2':
+        cluster = ec2.get_cluster(
+            cluster_name=job_info['cluster_name'],
+            region=job_info['ec2_region'],
+            vpc_id=job_info['ec2_vpc_id'])
+    else:
+        raise UnsupportedProviderError(job_info['provider'])
+
+    cluster.run_command_check()
+    return cluster
+
+
+def summarize_job_statuses(statuses: dict) -> str:
+    """
+    Count a job's nodes by state and exit status, e.g. "3 done (exit 0), 1 running".
+    """
+    counts = {}
+    for status in statuses.values():
+        if status.state == 'done':
+            label = "done (exit {e})".format(e=status.exit_status)
+        else:
+            label = status.state
+        counts[label] = counts.get(label, 0) + 1
+    return ', '.join(
+        "{n} {label}".format(n=n, label=label)
+        for label, n in sorted(counts.items(), key=lambda item: (-item[1], item[0])))
+
+
+@cli.group()
+def job():
+    """
+    Check on commands started with `run-command --detach`.
+    """
+    pass
+
+
+def job_options(func):
+    func = click.option('--ec2-user')(func)
+    func = click.option('--ec2-identity-file',
+                        type=click.Path(exists=True, dir_okay=False),
+                        help="Path to SSH .pem file for accessing nodes.")(func)
+    func = click.argument('job-id')(func)
+    return func
+
+
+@job.command(name='status')
+@job_options
+@click.pass_context
+def job_status(cli_context, job_id, ec2_identity_file, ec2_user):
+    """
+    Show the status of a detached job on each node.
+    """
+    job_info = load_job(job_id)
+
+    option_requires(
+        option='--provider',
+        conditional_value='ec2',
+        requires_all=[
+            '--ec2-identity-file',
+            '--ec2-user'],
+        scope=dict(locals(), provider=job_info['provider']))
+
+    cluster = get_job_cluster(job_info)
+    statuses = cluster.get_job_statuses(
+        user=ec2_user,
+        identity_file=ec2_identity_file,
+        job_id=job_id,
+        private_hosts=[private_host for ip, private_host in job_info['hosts']])
+
+    print("Job {j} on {c}: {command}".format(j=job_id, c=job_info['cluster_name'], command=job_info['command']))
+    for ip, private_host in job_info['hosts']:
+        status = statuses.get(private_host, JobStatus('unreachable', None, 0))
+        print("  {ip}: {state}{exit} ({b} bytes of output)".format(
+            ip=ip,
+            state=status.state,
+            exit='' if status.exit_status is None else ', exit {e}'.format(e=status.exit_status),
+            b=status.output_size))
+    print(summarize_job_statuses(statuses))
+
+
+@job.command(name='wait')
+@job_options
+@click.option('--poll-interval', type=click.IntRange(min=1), default=30, show_default=True,
+              help="Seconds between checks.")
+@click.pass_context
+def job_wait(cli_context, job_id, ec2_identity_file, ec2_user, poll_interval):
+    """
+    Wait for a detached job to finish on every node.
+
+    Flintrock will return a non-zero code if the job failed on any node.
+    """
+    job_info = load_job(job_id)
+
+    option_requires(
+        option='--provider',
+        conditional_value='ec2',
+        requires_all=[
+            '--ec2-identity-file',
+            '--ec2-user'],
+        scope=dict(locals(), provider=job_info['provider']))
+
+    cluster = get_job_cluster(job_info)
+    while True:
+        statuses = cluster.get_job_statuses(
+            user=ec2_user,
+            identity_file=ec2_identity_file,
+            job_id=job_id,
+            private_hosts=[private_host for ip, private_host in job_info['hosts']])
+        logger.info(summarize_job_statuses(statuses))
+        if not any(status.state == 'running' for status in statuses.values()):
+            break
+        time.sleep(poll_interval)
+
+    failed = [
+        status for status in statuses.values()
+        if status.state != 'done' or status.exit_status != 0]
+    if failed:
+        raise Error(
+            "Job {j} failed on {n} of {t} nodes."
+            .format(j=job_id, n=len(failed), t=len(statuses)))
+
+
+@job.command(name='output')
+@job_options
+@click.pass_context
+def job_output(cli_context, job_id, ec2_identity_file, ec2_user):
+    """
+    Show the output of a detached job so far, prefixed with each node.
+
+    Output is cached locally, so each call only transfers what is new.
+    """
+    job_info = load_job(job_id)
+
+    option_requires(
+        option='--provider',
+        conditional_value='ec2',
+        requires_all=[
+            '--ec2-identity-file',
+            '--ec2-user'],
+        scope=dict(locals(), provider=job_info['provider']))
+
+    cluster = get_job_cluster(job_info)
+    output_dir = os.path.join(get_jobs_dir(), job_id)
+    hosts = [ip for ip, private_host in job_info['hosts']]
+    failed_hosts = cluster.fetch_job_output(
+        user=ec2_user,
+        identity_file=ec2_identity_file,
+        job_id=job_id,
+        hosts=hosts,
+        local_dir=output_dir)
+
+    # Show whatever we have for the nodes we couldn't reach, too.
+    for host in hosts:
+        output_path = os.path.join(output_dir, host + '.log')
+        if not os.path.isfile(output_path):
+            continue
+        with open(output_path, errors='replace') as output_file:
+            for line in output_file:
+                print("[{h}] {l}".format(h=host, l=line.rstrip('\n')))
+
+    if failed_hosts:
+        raise Error(
+            "Could not fetch the output of job {j} from {n} of {t} nodes: {h}"
+            .format(
+                j=job_id,
+                n=len(failed_hosts),
+                t=len(hosts),
+                h=', '.join(failed_hosts)))
 
 
 @cli.command(name='copy-file')
@@ -948,6 +1439,11 @@ def run_command(
 @click.argument('local_path', type=click.Path(exists=True, dir_okay=False))
 @click.argument('remote_path', type=click.Path())
 @click.option('--master-only', help="Copy to the master only.", is_flag=True)
+@click.option('--broadcast', '--relay', 'broadcast', is_flag=True,
+              help="Upload the file once to the master and relay it from node to node "
+                   "over the cluster's internal network.")
+@click.option('--compress/--no-compress', default=False,
+              help="Compress data sent over SSH. Files that are already compressed are sent as-is.")
 @click.option('--ec2-region', default='us-east-1', show_default=True)
 @click.option('--ec2-vpc-id', default='', help="Leave empty for default VPC.")
 @click.option('--ec2-identity-file',
@@ -962,6 +1458,8 @@ def copy_file(
         local_path,
         remote_path,
         master_only,
+        broadcast,
+        compress,
         ec2_region,
         ec2_vpc_id,
         ec2_identity_file,
@@ -976,11 +1474,16 @@ def copy_file(
 
         flintrock copy-file my-cluster /tmp/file.102.txt /tmp/file.txt
         flintrock copy-file my-cluster /tmp/spark-defaults.conf /tmp/
+        flintrock copy-file --broadcast my-cluster /tmp/job.jar /tmp/
 
     Flintrock will return a non-zero code if any of the cluster nodes raises an error.
     """
     provider = cli_context.obj['provider']
 
+    mutually_exclusive(
+        options=['--master-only', '--broadcast'],
+        scope=locals())
+
     option_requires(
         option='--provider',
         conditional_value='ec2',
@@ -1007,7 +1510,7 @@ def copy_file(
 
     cluster.copy_file_check()
 
-    if not assume_yes and not master_only:
+    if not assume_yes and not master_only and not broadcast:
         file_size_bytes = os.path.getsize(local_path)
         num_nodes = len(cluster.slave_ips) + 1  # TODO: cluster.num_nodes
         total_size_bytes = file_size_bytes * num_nodes
@@ -1022,7 +1525,8 @@ def copy_file(
                         a long time.
                         You may be better off uploading this file to a storage service like
                         Amazon S3 and downloading it from there to the cluster using
-                        `flintrock run-command ...`.
+                        `flintrock run-command ...`, or using --broadcast to upload it
+                        once and relay it between the nodes.
                         """.format(
                             size=file_size_bytes,
                             count=num_nodes,
@@ -1041,9 +1545,317 @@ def copy_file(
         local_path=local_path,
         remote_path=remote_path,
         master_only=master_only,
+        user=user,
+        identity_file=identity_file,
+        broadcast=broadcast,
+        compress=compress)
+
+
+@cli.command()
+@click.argument('cluster-name')
+@click.argument('local_dir', type=click.Path(exists=True, file_okay=False))
+@click.argument('remote_dir', type=click.Path())
+@click.option('--master-only', help="Sync to the master only.", is_flag=True)
+@click.option('--compress/--no-compress', default=False,
+              help="Compress data sent over SSH. Helps with text-heavy directories.")
+@click.option('--ec2-region', default='us-east-1', show_default=True)
+@click.option('--ec2-vpc-id', default='', help="Leave empty for default VPC.")
+@click.option('--ec2-identity-file',
+              type=click.Path(exists=True, dir_okay=False),
+              help="Path to SSH .pem file for accessing nodes.")
+@click.option('--ec2-user')
+@click.pass_context
+def sync(
+        cli_context,
+        cluster_name,
+        local_dir,
+        remote_dir,
+        master_only,
+        compress,
+        ec2_region,
+        ec2_vpc_id,
+        ec2_identity_file,
+        ec2_user):
+    """
+    Sync a local directory up to a cluster.
+
+    This will make the contents of the remote directory on each node of the
+    cluster match the local directory, sending only new or changed files.
+    Large files that changed are sent as deltas against the remote copy.
+    Remote files that don't exist locally are left alone.
+
+    Examples:
+
+        flintrock sync my-cluster ./my-app/ /home/ec2-user/my-app/
+
+    Flintrock will return a non-zero code if any of the cluster nodes raises an error.
+    """
+    provider = cli_context.obj['provider']
+
+    option_requires(
+        option='--provider',
+        conditional_value='ec2',
+        requires_all=[
+            '--ec2-region',
+            '--ec2-identity-file',
+            '--ec2-user'],
+        scope=locals())
+
+    if provider == 'ec2':
+        cluster = ec2.get_cluster(
+            cluster_name=cluster_name,
+            region=ec2_region,
+            vpc_id=ec2_vpc_id)
+        user = ec2_user
+        identity_file = ec2_identity_file
+    else:
+        raise UnsupportedProviderError(provider)
+
+    cluster.sync_check()
+
+    logger.info("Syncing directory to {target}...".format(
+        target="master only" if master_only else "cluster"))
+
+    cluster.sync(
+        local_dir=local_dir,
+        remote_dir=remote_dir,
+        master_only=master_only,
+        user=user,
+        identity_file=identity_file,
+        compress=compress)
+
+
+@cli.command()
+@click.argument('cluster-name')
+@click.argument('remote_glob')
+@click.argument('local_dir', type=click.Path(file_okay=False))
+@click.option('--master-only', help="Fetch from the master only.", is_flag=True)
+@click.option('--max-parallel', type=click.IntRange(min=1), default=32, show_default=True,
+              help="Maximum number of nodes to fetch from at once.")
+@click.option('--bandwidth-limit', type=click.IntRange(min=1),
+              help="Total download bandwidth to use, in MB/s. "
+                   "Each node being fetched from gets an equal share.")
+@click.option('--ec2-region', default='us-east-1', show_default=True)
+@click.option('--ec2-vpc-id', default='', help="Leave empty for default VPC.")
+@click.option('--ec2-identity-file',
+              type=click.Path(exists=True, dir_okay=False),
+              help="Path to SSH .pem file for accessing nodes.")
+@click.option('--ec2-user')
+@click.pass_context
+def fetch(
+        cli_context,
+        cluster_name,
+        remote_glob,
+        local_dir,
+        master_only,
+        max_parallel,
+        bandwidth_limit,
+        ec2_region,
+        ec2_vpc_id,
+        ec2_identity_file,
+        ec2_user):
+    """
+    Fetch files from a cluster.
+
+    This will copy the files matching REMOTE_GLOB on each node of the cluster
+    into a subdirectory of LOCAL_DIR named after the node. Quote the glob so
+    your local shell doesn't expand it. ** matches across directories.
+
+    Examples:
+
+        flintrock fetch my-cluster 'spark/work/**/stderr' ./logs/
+        flintrock fetch my-cluster '/tmp/*.hprof' ./heap-dumps/
+
+    Flintrock keeps going if some nodes fail, and returns a non-zero code at
+    the end if any of them did.
+    """
+    provider = cli_context.obj['provider']
+
+    option_requires(
+        option='--provider',
+        conditional_value='ec2',
+        requires_all=[
+            '--ec2-region',
+            '--ec2-identity-file',
+            '--ec2-user'],
+        scope=locals())
+
+    if provider == 'ec2':
+        cluster = ec2.get_cluster(
+            cluster_name=cluster_name,
+            region=ec2_region,
+            vpc_id=ec2_vpc_id)
+        user = ec2_user
+        identity_file = ec2_identity_file
+    else:
+        raise UnsupportedProviderError(provider)
+
+    cluster.fetch_check()
+
+    logger.info("Fetching files from {target}...".format(
+        target="master only" if master_only else "cluster"))
+
+    cluster.fetch(
+        remote_glob=remote_glob,
+        local_dir=local_dir,
+        master_only=master_only,
+        user=user,
+        identity_file=identity_file,
+        max_parallel=max_parallel,
+        bandwidth_limit=bandwidth_limit * 10 ** 6 if bandwidth_limit else None)
+
+
+@cli.command()
+@click.argument('cluster-name')
+@click.option('--service', 'services', type=click.Choice(['spark', 'hdfs']), multiple=True,
+              help="Only show logs for this service. "
+                   "You can specify this option multiple times. [default: all]")
+@click.option('--follow', is_flag=True, help="Keep streaming new log lines.")
+@click.option('--grep', help="Only show lines matching this extended regular expression.")
+@click.option('--lines', 'num_lines', type=click.IntRange(min=0), default=100, show_default=True,
+              help="Number of lines to show from the end of each log file.")
+@click.option('--master-only', help="Show logs from the master only.", is_flag=True)
+@click.option('--ec2-region', default='us-east-1', show_default=True)
+@click.option('--ec2-vpc-id', default='', help="Leave empty for default VPC.")
+@click.option('--ec2-identity-file',
+              type=click.Path(exists=True, dir_okay=False),
+              help="Path to SSH .pem file for accessing nodes.")
+@click.option('--ec2-user')
+@click.pass_context
+def logs(
+        cli_context,
+        cluster_name,
+        services,
+        follow,
+        grep,
+        num_lines,
+        master_only,
+        ec2_region,
+        ec2_vpc_id,
+        ec2_identity_file,
+        ec2_user):
+    """
+    Show the Spark and HDFS daemon logs from a cluster.
+
+    Lines from all the nodes are merged in time order and prefixed with the
+    node and log file they came from.
+
+    Examples:
+
+        flintrock logs my-cluster --service spark --grep 'ERROR|Exception'
+        flintrock logs my-cluster --follow
+    """
+    provider = cli_context.obj['provider']
+
+    option_requires(
+        option='--provider',
+        conditional_value='ec2',
+        requires_all=[
+            '--ec2-region',
+            '--ec2-identity-file',
+            '--ec2-user'],
+        scope=locals())
+
+    if provider == 'ec2':
+        cluster = ec2.get_cluster(
+            cluster_name=cluster_name,
+            region=ec2_region,
+            vpc_id=ec2_vpc_id)
+        user = ec2_user
+        identity_file = ec2_identity_file
+    else:
+        raise UnsupportedProviderError(provider)
+
+    cluster.logs_check()
+
+    cluster.logs(
+        master_only=master_only,
+        user=user,
+        identity_file=identity_file,
+        services=list(services) or ['spark', 'hdfs'],
+        num_lines=num_lines,
+        follow=follow,
+        grep=grep)
+
+
+@cli.command(name='rebuild-spark')
+@click.argument('cluster-name')
+@click.option('--commit', required=True,
+              help="Git commit to rebuild Spark at. "
+                   "Set to 'latest' to rebuild Spark from the latest commit on the "
+                   "repository's default branch.")
+@click.option('--ec2-region', default='us-east-1', show_default=True)
+@click.option('--ec2-vpc-id', default='', help="Leave empty for default VPC.")
+@click.option('--ec2-identity-file',
+              type=click.Path(exists=True, dir_okay=False),
+              help="Path to SSH .pem file for accessing nodes.")
+@click.option('--ec2-user')
+@click.pass_context
+def rebuild_spark(
+        cli_context,
+        cluster_name,
+        commit,
+        ec2_region,
+        ec2_vpc_id,
+        ec2_identity_file,
+        ec2_user):
+    """
+    Rebuild Spark at a new commit on a running cluster.
+
+    This only works on clusters launched with --spark-git-commit. The build
+    runs incrementally in the existing build tree on the master, only the
+    jars that changed are pushed to the slaves, and the Spark daemons are
+    then restarted. If the cluster was launched from a cached build, then
+    the first rebuild sets up the build tree from scratch.
+
+    Examples:
+
+        flintrock rebuild-spark my-cluster --commit latest
+        flintrock rebuild-spark my-cluster --commit 7955b3962ac46b89564e0613db7bea98a1478bf2
+    """
+    provider = cli_context.obj['provider']
+
+    option_requires(
+        option='--provider',
+        conditional_value='ec2',
+        requires_all=[
+            '--ec2-region',
+            '--ec2-identity-file',
+            '--ec2-user'],
+        scope=locals())
+
+    if provider == 'ec2':
+        cluster = ec2.get_cluster(
+            cluster_name=cluster_name,
+            region=ec2_region,
+            vpc_id=ec2_vpc_id)
+        user = ec2_user
+        identity_file = ec2_identity_file
+    else:
+        raise UnsupportedProviderError(provider)
+
+    cluster.rebuild_spark_check()
+    cluster.load_manifest(
         user=user,
         identity_file=identity_file)
 
+    if commit == 'latest':
+        spark = next(
+            (service for service in cluster.services if isinstance(service, Spark)),
+            None)
+        if not spark or not spark.git_repository:
+            raise Error(
+                "Cluster {c} does not have Spark built from git."
+                .format(c=cluster_name))
+        commit = get_latest_commit(spark.git_repository)
+        logger.info("Rebuilding Spark at latest commit: {c}".format(c=commit))
+
+    logger.info("Rebuilding Spark on {c}...".format(c=cluster_name))
+    cluster.rebuild_spark(
+        user=user,
+        identity_file=identity_file,
+        git_commit=commit)
+
 
 def normalize_keys(obj):
     """
@@ -1085,6 +1897,15 @@ def config_to_click(config: dict) -> dict:
         'remove-slaves': ec2_configs,
         'run-command': ec2_configs,
         'copy-file': ec2_configs,
+        'sync': ec2_configs,
+        'fetch': ec2_configs,
+        'logs': ec2_configs,
+        'rebuild-spark': ec2_configs,
+        'job': {
+            'status': ec2_configs,
+            'wait': ec2_configs,
+            'output': ec2_configs,
+        },
     }
 
     return click_map
@@ -1126,6 +1947,21 @@ def configure(cli_context, locate):
         )
 
 
+@cli.command(name='clear-cache')
+def clear_cache_command():
+    """
+    Forget Flintrock's cached lookups.
+
+    Flintrock caches lookups of things that rarely change, like your public
+    IP, AMI details, the default VPC, and the fastest Apache mirrors. Clear
+    the cache if any of those have changed.
+    """
+    num_entries = clear_cache()
+    logger.info("Cleared {n} cached lookup{s}.".format(
+        n=num_entries,
+        s='' if num_entries == 1 else 's'))
+
+
 def flintrock_is_in_development_mode() -> bool:
     """
     Check if Flintrock was installed in development mode.
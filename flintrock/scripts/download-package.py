@@ -1,25 +1,418 @@
+"""
+Download a package tarball and unpack it into a destination directory.
+
+The download is streamed straight through a checksum and into tar, so the
+package never touches the disk in compressed form. Dropped connections are
+resumed with HTTP Range requests, and failed attempts are retried with
+exponential backoff.
+
+Large downloads from servers that support ranges are split into several
+segments that are downloaded concurrently, since a single connection to a
+distant mirror rarely saturates the node's bandwidth. The segments are
+spooled to disk and fed to tar in order as they complete.
+
+This script runs on the cluster nodes, so it must work with both Python 2
+and Python 3.
+"""
 from __future__ import print_function
 
 import argparse
 import errno
+import hashlib
+import os
 import os.path
+import shutil
+import string
 import sys
-import subprocess
+import tarfile
+import tempfile
+import threading
 import time
+import zlib
+
+try:
+    from http.client import HTTPException
+    from urllib.parse import parse_qs, urlparse
+    from urllib.request import Request, urlopen
+except ImportError:
+    from httplib import HTTPException
+    from urllib2 import Request, urlopen
+    from urlparse import parse_qs, urlparse
 
 MAX_TRIES = 5
+MAX_RESUMES = 5
+CHUNK_SIZE = 1024 * 1024
+TIMEOUT_SECONDS = 30
+SEGMENTS = 4
+MIN_SEGMENT_SIZE = 16 * 1024 * 1024
+
+
+class ChecksumMismatch(Exception):
+    pass
 
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('url')
     parser.add_argument('destination_dir')
-    args = parser.parse_args()
-    return (args.url, args.destination_dir)
+    parser.add_argument(
+        '--sha512',
+        help="Expected SHA-512 digest of the package. If not provided, it is "
+             "looked up from the Apache .sha512 file, when there is one.")
+    parser.add_argument('--max-tries', type=int, default=MAX_TRIES)
+    parser.add_argument(
+        '--segments', type=int, default=SEGMENTS,
+        help="Maximum number of concurrent range requests to split the download into.")
+    parser.add_argument('--min-segment-size', type=int, default=MIN_SEGMENT_SIZE)
+    parser.add_argument(
+        '--mirror', action='append', default=[],
+        help="A mirror URL for the package, to try before the main URL. "
+             "You can specify this option multiple times.")
+    return parser.parse_args()
+
+
+def get_backoff_seconds(attempt):
+    return min(2 ** attempt, 60)
+
+
+def get_apache_checksum_urls(url):
+    """
+    Get the URLs where the .sha512 file for an Apache download might be found.
+    """
+    parsed_url = urlparse(url)
+
+    if parsed_url.netloc == 'www.apache.org' and parsed_url.path == '/dyn/closer.lua':
+        filename = parse_qs(parsed_url.query).get('filename', [''])[0]
+        if not filename:
+            return []
+        return [
+            'https://downloads.apache.org/' + filename + '.sha512',
+            'https://archive.apache.org/dist/' + filename + '.sha512',
+        ]
+    elif parsed_url.netloc.endswith('apache.org'):
+        return [url + '.sha512']
+    else:
+        return []
+
+
+def parse_sha512_file(contents, filename):
+    """
+    Extract the digest from an Apache .sha512 file.
+
+    These files come in a few formats: plain `sha512sum` output, BSD-style
+    `SHA512 (file) = digest` lines, and `gpg --print-md` output where the
+    digest is split into upper-case groups across several lines.
+    """
+    contents = contents.replace(filename, ' ')
+    contents = contents.replace('SHA512', ' ').replace('sha512', ' ')
+    digest = ''.join(c for c in contents if c in string.hexdigits).lower()
+    if len(digest) == 128:
+        return digest
+    else:
+        return None
+
+
+def get_expected_sha512(url):
+    checksum_urls = get_apache_checksum_urls(url)
+
+    for checksum_url in checksum_urls:
+        try:
+            response = urlopen(checksum_url, timeout=TIMEOUT_SECONDS)
+            contents = response.read().decode('utf-8')
+        except (IOError, OSError, HTTPException):
+            continue
+        digest = parse_sha512_file(
+            contents,
+            filename=os.path.basename(urlparse(checksum_url).path)[:-len('.sha512')])
+        if digest:
+            return digest
+
+    if checksum_urls:
+        print(
+            "Could not find a SHA-512 checksum for '{url}'. "
+            "Skipping verification.".format(url=url),
+            file=sys.stderr)
+    return None
+
+
+def probe_range_support(url):
+    """
+    Check whether the server behind a URL supports range requests.
+
+    Return the URL to use for range requests, which is where any redirects
+    ended up, and the total size of the download. The size is None if ranges
+    are not supported.
+    """
+    request = Request(url)
+    request.add_header('Range', 'bytes=0-0')
+    try:
+        response = urlopen(request, timeout=TIMEOUT_SECONDS)
+    except (IOError, OSError, HTTPException):
+        return (url, None)
+
+    try:
+        if response.getcode() != 206:
+            return (url, None)
+        # e.g. Content-Range: bytes 0-0/1234
+        total_size = (response.info().get('Content-Range') or '').rsplit('/', 1)[-1]
+        if not total_size.isdigit():
+            return (url, None)
+        return (response.geturl(), int(total_size))
+    finally:
+        response.close()
+
+
+class ResumableDownload(object):
+    """
+    A file-like object that streams a download, hashing it as it goes and
+    transparently resuming it with an HTTP Range request if the connection
+    drops partway through.
+
+    Set start and end to download just that inclusive range of bytes.
+    """
+
+    def __init__(self, url, start=0, end=None, checksum=True):
+        self.url = url
+        self.start = start
+        self.end = end
+        self.offset = 0
+        self.expected_size = None if end is None else end - start + 1
+        self.resumes = 0
+        self.hasher = hashlib.sha512() if checksum else None
+        self.response = self._open()
+
+    def _open(self):
+        request = Request(self.url)
+        if self.offset or self.end is not None:
+            request.add_header('Range', 'bytes={s}-{e}'.format(
+                s=self.start + self.offset,
+                e='' if self.end is None else self.end))
+        response = urlopen(request, timeout=TIMEOUT_SECONDS)
+
+        if self.end is not None and response.getcode() != 206:
+            raise IOError("Server did not honor range request for '{u}'.".format(u=self.url))
+        elif self.offset and response.getcode() != 206:
+            # The server doesn't support ranges, so skip what we already have.
+            remaining = self.offset
+            while remaining:
+                skipped = response.read(min(remaining, CHUNK_SIZE))
+                if not skipped:
+                    raise IOError("Download of '{u}' ended early.".format(u=self.url))
+                remaining -= len(skipped)
+        elif not self.offset and self.expected_size is None:
+            content_length = response.info().get('Content-Length')
+            if content_length:
+                self.expected_size = int(content_length)
+
+        return response
+
+    def _resume(self, error):
+        if self.resumes >= MAX_RESUMES:
+            raise error
+        self.resumes += 1
+        print(
+            "Download interrupted at byte {o}: {e}. Resuming...".format(
+                o=self.offset, e=error),
+            file=sys.stderr)
+        time.sleep(get_backoff_seconds(self.resumes - 1))
+        self.response = self._open()
+
+    def read(self, size=CHUNK_SIZE):
+        while True:
+            try:
+                data = self.response.read(size)
+            except (IOError, OSError, HTTPException) as e:
+                self._resume(e)
+                continue
+            if not data and self.expected_size is not None and self.offset < self.expected_size:
+                self._resume(IOError("Connection closed early."))
+                continue
+            break
+
+        self.offset += len(data)
+        if self.hasher:
+            self.hasher.update(data)
+        return data
+
+    def drain(self):
+        while self.read(CHUNK_SIZE):
+            pass
+
+    def close(self):
+        self.response.close()
+
+
+class SegmentDownloader(threading.Thread):
+    """
+    Download one segment of a file to a spool file in the background.
+    """
+
+    def __init__(self, url, start, end, path):
+        super(SegmentDownloader, self).__init__()
+        self.daemon = True
+        self.url = url
+        self.start_byte = start
+        self.end_byte = end
+        self.path = path
+        self.cancelled = False
+        self.error = None
+
+    def run(self):
+        try:
+            download = ResumableDownload(
+                self.url,
+                start=self.start_byte,
+                end=self.end_byte,
+                checksum=False)
+            with open(self.path, 'wb') as f:
+                while not self.cancelled:
+                    data = download.read(CHUNK_SIZE)
+                    if not data:
+                        break
+                    f.write(data)
+            download.close()
+            if not self.cancelled and download.offset != download.expected_size:
+                raise IOError(
+                    "Segment {s}-{e} of '{u}' is {a} bytes instead of {x}."
+                    .format(
+                        s=self.start_byte,
+                        e=self.end_byte,
+                        u=self.url,
+                        a=download.offset,
+                        x=download.expected_size))
+        except Exception as e:
+            self.error = e
+
+
+class SegmentedDownload(object):
+    """
+    A file-like object that downloads a file as several concurrent range
+    requests and reads the segments back in order, hashing them as it goes.
+    """
+
+    def __init__(self, url, size, num_segments, work_dir):
+        self.work_dir = tempfile.mkdtemp(prefix='.download-', dir=work_dir)
+        self.hasher = hashlib.sha512()
+        self.current_segment = 0
+        self.current_file = None
+
+        segment_size = -(-size // num_segments)
+        self.segments = [
+            SegmentDownloader(
+                url,
+                start=start,
+                end=min(start + segment_size, size) - 1,
+                path=os.path.join(self.work_dir, str(i)))
+            for i, start in enumerate(range(0, size, segment_size))
+        ]
+        for segment in self.segments:
+            segment.start()
+
+    def read(self, size=CHUNK_SIZE):
+        while self.current_segment < len(self.segments):
+            segment = self.segments[self.current_segment]
+            if self.current_file is None:
+                segment.join()
+                if segment.error:
+                    raise segment.error
+                self.current_file = open(segment.path, 'rb')
+
+            data = self.current_file.read(size)
+            if data:
+                self.hasher.update(data)
+                return data
+
+            self.current_file.close()
+            self.current_file = None
+            os.remove(segment.path)
+            self.current_segment += 1
+        return b''
+
+    def drain(self):
+        while self.read(CHUNK_SIZE):
+            pass
+
+    def close(self):
+        for segment in self.segments:
+            segment.cancelled = True
+        if self.current_file is not None:
+            self.current_file.close()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+def open_download(url, destination_dir, num_segments, min_segment_size):
+    """
+    Open a download as concurrent range requests if it's large enough and the
+    server supports it, or as a single stream otherwise.
+    """
+    if num_segments > 1:
+        range_url, size = probe_range_support(url)
+        if size is not None:
+            num_segments = min(num_segments, size // min_segment_size)
+            if num_segments > 1:
+                return SegmentedDownload(
+                    range_url,
+                    size=size,
+                    num_segments=num_segments,
+                    work_dir=os.path.dirname(os.path.abspath(destination_dir)))
+    return ResumableDownload(url)
+
+
+def download_and_unpack(url, destination_dir, expected_sha512, num_segments, min_segment_size):
+    download = open_download(
+        url,
+        destination_dir=destination_dir,
+        num_segments=num_segments,
+        min_segment_size=min_segment_size)
+    try:
+        unpack(download, destination_dir)
+    finally:
+        download.close()
+
+    if expected_sha512:
+        actual_sha512 = download.hasher.hexdigest()
+        if actual_sha512 != expected_sha512.lower():
+            raise ChecksumMismatch(
+                "Checksum mismatch for '{url}'. Expected SHA-512 {e}, got {a}."
+                .format(url=url, e=expected_sha512, a=actual_sha512))
+
+
+def unpack(download, destination_dir):
+    with tarfile.open(fileobj=download, mode='r|gz') as tar:
+        if hasattr(tarfile, 'fully_trusted_filter'):
+            # We sanitize member names ourselves, the way `tar` would.
+            tar.extraction_filter = tarfile.fully_trusted_filter
+        for member in tar:
+            # Equivalent to `tar --strip-components=1`.
+            name = member.name.split('/', 1)[1] if '/' in member.name else ''
+            if not name or os.path.isabs(name) or '..' in name.split('/'):
+                continue
+            member.name = name
+            if member.islnk():
+                member.linkname = member.linkname.split('/', 1)[-1]
+            tar.extract(member, destination_dir)
+
+    # Consume any trailing padding so the checksum covers the whole file.
+    download.drain()
+
+
+def reset_directory(path):
+    shutil.rmtree(path, ignore_errors=True)
+    try:
+        os.makedirs(path, mode=0o755)
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            pass
+        else:
+            raise
 
 
 if __name__ == '__main__':
-    url, destination_dir = parse_args()
+    args = parse_args()
+    url = args.url
+    destination_dir = args.destination_dir
+    expected_sha512 = args.sha512
+    max_tries = args.max_tries
 
     try:
         os.makedirs(destination_dir, mode=0o755)
@@ -29,26 +422,37 @@ if __name__ == '__main__':
         else:
             raise
 
-    download_path = '{}.download'.format(os.path.basename(destination_dir))
+    if not expected_sha512:
+        expected_sha512 = get_expected_sha512(url)
+
+    # Try the mirrors in order of preference, then the main URL, and cycle
+    # through them again if they all fail.
+    urls = args.mirror + [url]
 
     tries = 0
     while True:
         try:
-            subprocess.check_call(['curl', '--location', '--output', download_path, url])
-            subprocess.check_call(['gzip', '--test', download_path])
-            subprocess.check_call(['tar', 'xzf', download_path, '-C', destination_dir, '--strip-components=1'])
-            subprocess.check_call(['rm', download_path])
-        except subprocess.CalledProcessError as e:
+            download_and_unpack(
+                urls[tries % len(urls)],
+                destination_dir,
+                expected_sha512,
+                num_segments=args.segments,
+                min_segment_size=args.min_segment_size)
+        except (IOError, OSError, EOFError, HTTPException,
+                tarfile.TarError, zlib.error, ChecksumMismatch) as e:
             print(e, file=sys.stderr)
-            if tries < MAX_TRIES:
+            if tries < max_tries:
+                reset_directory(destination_dir)
+                if (tries + 1) % len(urls) == 0:
+                    time.sleep(get_backoff_seconds(tries // len(urls)))
                 tries += 1
-                time.sleep(1)
             else:
+                reset_directory(destination_dir)
                 print(
                     "Failed to download and unpack '{url}' after {tries} tries."
                     .format(
                         url=url,
-                        tries=MAX_TRIES,
+                        tries=tries + 1,
                     ),
                     file=sys.stderr,
                 )
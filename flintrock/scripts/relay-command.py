@@ -0,0 +1,106 @@
+"""
+Run a shell command on many cluster nodes from the master, on behalf of a
+Flintrock client that only holds a single connection to the master.
+
+Reads a JSON object from stdin with the keys:
+
+    command: The shell command to run.
+    hosts: The private hosts to run it on.
+    parallelism: The maximum number of hosts to run it on at once.
+    ssh_options: A list of extra options for ssh.
+    environments: Maps hosts to environment variables to export for the
+        command there.
+
+Writes one JSON object per line to stdout as results come in. Each is
+either {"host": ..., "line": ...} for a line of output or
+{"host": ..., "exit_status": ...} once the command finishes on a host.
+ssh exits with 255 if it can't reach a host.
+
+This script runs on the cluster nodes, so it must work with both Python 2
+and Python 3.
+
+WARNING: Be conscious about what this script prints to stdout, as that
+         output is parsed by Flintrock.
+"""
+from __future__ import print_function
+
+import json
+import subprocess
+import sys
+import threading
+
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+output_lock = threading.Lock()
+
+
+def emit(message):
+    with output_lock:
+        sys.stdout.write(json.dumps(message) + '\n')
+        sys.stdout.flush()
+
+
+def get_export_command(environment):
+    return 'export {v};'.format(v=' '.join(
+        '{k}={v}'.format(k=key, v=quote(value))
+        for key, value in sorted(environment.items())))
+
+
+def run_on_host(host, command, ssh_options, environment):
+    if environment:
+        command = get_export_command(environment) + ' ' + command
+
+    try:
+        process = subprocess.Popen(
+            ['ssh'] + ssh_options + [host, command],
+            stdin=open('/dev/null'),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+    except OSError as e:
+        emit({'host': host, 'line': str(e)})
+        emit({'host': host, 'exit_status': 255})
+        return
+
+    for raw_line in iter(process.stdout.readline, b''):
+        emit({'host': host, 'line': raw_line.decode('utf-8', 'replace').rstrip('\r\n')})
+    emit({'host': host, 'exit_status': process.wait()})
+
+
+def worker(host_queue, command, ssh_options, environments):
+    while True:
+        try:
+            host = host_queue.get_nowait()
+        except Empty:
+            return
+        run_on_host(host, command, ssh_options, environments.get(host))
+
+
+if __name__ == '__main__':
+    request = json.loads(sys.stdin.read())
+
+    host_queue = Queue()
+    for host in request['hosts']:
+        host_queue.put(host)
+
+    threads = [
+        threading.Thread(
+            target=worker,
+            args=(
+                host_queue,
+                request['command'],
+                request['ssh_options'],
+                request.get('environments', {})))
+        for _ in range(min(request['parallelism'], len(request['hosts'])))
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
@@ -0,0 +1,164 @@
+"""
+Remote side of `flintrock sync`.
+
+Subcommands:
+
+    manifest <dir>
+        Print a JSON object mapping each file under <dir>, relative to it,
+        to its [size, mtime].
+
+    match <dir>
+        Read a JSON object mapping relative paths to [sha256, mtime] pairs
+        from stdin. Print a JSON list of the paths whose contents match their
+        SHA-256 digest. Each match gets the given mtime, so later syncs can
+        tell it is unchanged without hashing it again.
+
+    signatures <dir>
+        Read a JSON object mapping relative paths to block sizes from stdin.
+        Print a JSON object mapping each path that exists to a list of
+        [adler32, md5] pairs, one per full block.
+
+    patch <dir>
+        Read a stream of file patches from stdin and apply them. Each patch is
+        a JSON header on its own line followed by the literal data its
+        operations refer to. The header has the keys:
+            path, size, mtime, mode, sha256, block_size, ops
+        where each op is either ["copy", block_index] or ["data", length].
+        Patched files are checked against their SHA-256 digest before they
+        replace the originals.
+
+This script runs on the cluster nodes, so it must work with both Python 2
+and Python 3.
+
+WARNING: Be conscious about what this script prints to stdout, as that
+         output is parsed by Flintrock.
+"""
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+import sys
+import zlib
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def get_manifest(base_dir):
+    manifest = {}
+    for dir_path, dir_names, file_names in os.walk(base_dir):
+        for file_name in file_names:
+            path = os.path.join(dir_path, file_name)
+            if os.path.islink(path):
+                continue
+            stat = os.stat(path)
+            manifest[os.path.relpath(path, base_dir)] = [stat.st_size, int(stat.st_mtime)]
+    return manifest
+
+
+def get_file_sha256(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def match_files(base_dir, digests):
+    matches = []
+    for relative_path, (sha256, mtime) in digests.items():
+        path = os.path.join(base_dir, relative_path)
+        if os.path.isfile(path) and get_file_sha256(path) == sha256:
+            os.utime(path, (mtime, mtime))
+            matches.append(relative_path)
+    return sorted(matches)
+
+
+def get_signatures(base_dir, block_sizes):
+    signatures = {}
+    for relative_path, block_size in block_sizes.items():
+        path = os.path.join(base_dir, relative_path)
+        if not os.path.isfile(path):
+            continue
+        blocks = []
+        with open(path, 'rb') as f:
+            while True:
+                block = f.read(block_size)
+                if len(block) < block_size:
+                    break
+                blocks.append([
+                    zlib.adler32(block) & 0xffffffff,
+                    hashlib.md5(block).hexdigest()])
+        signatures[relative_path] = blocks
+    return signatures
+
+
+def read_exactly(stream, length):
+    data = stream.read(length)
+    if len(data) != length:
+        raise IOError("Patch stream ended early.")
+    return data
+
+
+def apply_patch(base_dir, header, stream):
+    path = os.path.join(base_dir, header['path'])
+    temp_path = path + '.flintrock-part'
+    block_size = header['block_size']
+    hasher = hashlib.sha256()
+
+    with open(path, 'rb') as original, open(temp_path, 'wb') as patched:
+        for op, value in header['ops']:
+            if op == 'copy':
+                original.seek(value * block_size)
+                data = read_exactly(original, block_size)
+                patched.write(data)
+                hasher.update(data)
+            else:
+                remaining = value
+                while remaining:
+                    data = read_exactly(stream, min(remaining, CHUNK_SIZE))
+                    patched.write(data)
+                    hasher.update(data)
+                    remaining -= len(data)
+
+    if hasher.hexdigest() != header['sha256']:
+        os.remove(temp_path)
+        raise IOError("Checksum mismatch after patching {p}.".format(p=header['path']))
+
+    os.chmod(temp_path, header['mode'])
+    os.utime(temp_path, (header['mtime'], header['mtime']))
+    os.rename(temp_path, path)
+
+
+def get_binary_stdin():
+    return getattr(sys.stdin, 'buffer', sys.stdin)
+
+
+if __name__ == '__main__':
+    command, base_dir = sys.argv[1:3]
+
+    if command == 'manifest':
+        if os.path.isdir(base_dir):
+            manifest = get_manifest(base_dir)
+        else:
+            manifest = {}
+        print(json.dumps(manifest))
+    elif command == 'match':
+        digests = json.loads(sys.stdin.read())
+        print(json.dumps(match_files(base_dir, digests)))
+    elif command == 'signatures':
+        block_sizes = json.loads(sys.stdin.read())
+        print(json.dumps(get_signatures(base_dir, block_sizes)))
+    elif command == 'patch':
+        stream = get_binary_stdin()
+        while True:
+            header_line = stream.readline()
+            if not header_line:
+                break
+            apply_patch(base_dir, json.loads(header_line.decode('utf-8')), stream)
+    else:
+        print("Unknown command: {c}".format(c=command), file=sys.stderr)
+        sys.exit(1)
@@ -1,5 +1,6 @@
 import json
 import os
+import posixpath
 import shlex
 import socket
 import sys
@@ -15,9 +16,11 @@ import paramiko
 from .core import (
     FlintrockCluster,
     generate_template_mapping,
+    get_node_resources,
     get_formatted_template,
 )
 from .ssh import ssh_check_output
+from .util import get_cache_dir
 
 FROZEN = getattr(sys, 'frozen', False)
 
@@ -28,6 +31,17 @@ else:
 
 SCRIPTS_DIR = os.path.join(THIS_DIR, 'scripts')
 
+# Spark builds from git happen once on the master. The resulting distribution
+# is cached there, relative to the home directory, for the slaves to pick up.
+SPARK_BUILD_SOURCE_DIR = 'spark-source'
+SPARK_BUILD_CACHE_DIR = '.flintrock-cache'
+SPARK_BUILD_TIMEOUT_SECONDS = 2 * 60 * 60
+# Hardcoding this here until we figure out a better way to handle
+# the supported build profiles.
+SPARK_BUILD_HADOOP_SHORT_VERSION = '2.7'
+# How many slaves the master pushes rebuilt jars to at once.
+SPARK_JAR_COPY_PARALLELISM = 32
+
 
 logger = logging.getLogger('flintrock.services')
 
@@ -40,6 +54,35 @@ SecurityGroupRule = namedtuple(
         'cidr_ip'])
 
 
+def get_spark_build_tree_command(*, git_repository: str, git_commit: str) -> str:
+    """
+    Get the command that checks out Spark at the given commit in the build
+    tree on the master, setting up the tree and the tools to build it first
+    if needed.
+    """
+    return """
+        set -e
+        if ! command -v git >/dev/null || ! command -v javac >/dev/null; then
+            sudo yum install -y git java-devel
+        fi
+        if [ ! -d {source_dir}/.git ]; then
+            rm -rf {source_dir}
+            git clone {repo} {source_dir}
+        fi
+        cd {source_dir}
+        if ! git cat-file -e {commit}^{{commit}} 2>/dev/null; then
+            git fetch --quiet origin
+        fi
+        if ! git cat-file -e {commit}^{{commit}} 2>/dev/null; then
+            git fetch --quiet origin {commit}
+        fi
+        git reset --hard {commit}
+    """.format(
+        repo=shlex.quote(git_repository),
+        source_dir=shlex.quote(SPARK_BUILD_SOURCE_DIR),
+        commit=shlex.quote(git_commit))
+
+
 class FlintrockService:
     """
     This is an abstract class. Implementations of this class capture all the logic
@@ -122,10 +165,20 @@ class FlintrockService:
         raise NotImplementedError
 
 
+def get_mirror_options(mirrors: list) -> str:
+    """
+    Format mirror URLs as options for download-package.py.
+    """
+    return ' '.join('--mirror ' + shlex.quote(mirror) for mirror in mirrors)
+
+
 class HDFS(FlintrockService):
-    def __init__(self, *, version, download_source):
+    def __init__(self, *, version, download_source, download_mirrors: list=None):
         self.version = version
         self.download_source = download_source
+        # Mirrors are chosen fresh for each launch, so unlike the download
+        # source they are not tracked in the manifest.
+        self.download_mirrors = download_mirrors or []
         self.name_node_ui_port = 50070 if version < '3.0' else 9870
         self.manifest = {'version': version, 'download_source': download_source}
 
@@ -146,7 +199,7 @@ class HDFS(FlintrockService):
             command="""
                 set -e
 
-                python /tmp/download-package.py "{download_source}" "hadoop"
+                python /tmp/download-package.py "{download_source}" "hadoop" {mirror_options}
 
                 for f in $(find hadoop/bin -type f -executable -not -name '*.cmd'); do
                     sudo ln -s "$(pwd)/$f" "/usr/local/bin/$(basename $f)"
@@ -156,6 +209,7 @@ class HDFS(FlintrockService):
             """.format(
                 version=self.version,
                 download_source=self.download_source.format(v=self.version),
+                mirror_options=get_mirror_options(self.download_mirrors),
             ))
 
     def configure(
@@ -175,6 +229,7 @@ class HDFS(FlintrockService):
             client=ssh_client,
             command="mkdir -p hadoop/conf",
         )
+        node_resources = get_node_resources(ssh_client=ssh_client)
 
         for template_path in template_paths:
             ssh_check_output(
@@ -192,6 +247,7 @@ class HDFS(FlintrockService):
                                 # Spark version we're using.
                                 spark_version='',
                                 spark_executor_instances=0,
+                                node_resources=node_resources,
                             ))),
                     p=shlex.quote(template_path)))
 
@@ -275,8 +331,10 @@ class Spark(FlintrockService):
         version: str=None,
         hadoop_version: str,
         download_source: str=None,
+        download_mirrors: list=None,
         git_commit: str=None,
-        git_repository: str=None
+        git_repository: str=None,
+        git_build_cache: bool=False
     ):
         # TODO: Convert these checks into something that throws a proper exception.
         #       Perhaps reuse logic from CLI.
@@ -288,8 +346,10 @@ class Spark(FlintrockService):
         self.version = version
         self.hadoop_version = hadoop_version
         self.download_source = download_source
+        self.download_mirrors = download_mirrors or []
         self.git_commit = git_commit
         self.git_repository = git_repository
+        self.git_build_cache = git_build_cache
 
         self.manifest = {
             'version': version,
@@ -315,48 +375,311 @@ class Spark(FlintrockService):
             ssh_check_output(
                 client=ssh_client,
                 command="""
-                    python /tmp/download-package.py "{download_source}" "spark"
+                    python /tmp/download-package.py "{download_source}" "spark" {mirror_options}
                 """.format(
                     version=self.version,
                     download_source=self.download_source.format(v=self.version),
+                    mirror_options=get_mirror_options(self.download_mirrors),
                 ))
-
+        elif ssh_client.get_transport().getpeername()[0] == cluster.master_ip:
+            self._build_from_git(ssh_client=ssh_client)
         else:
+            self._install_from_master_build(
+                ssh_client=ssh_client,
+                cluster=cluster)
+
+        ssh_check_output(
+            client=ssh_client,
+            command="""
+                set -e
+                for f in $(find spark/bin -type f -executable -not -name '*.cmd'); do
+                    sudo ln -s "$(pwd)/$f" "/usr/local/bin/$(basename $f)"
+                done
+                echo "export SPARK_HOME='$(pwd)/spark'" >> .bashrc
+            """)
+
+    @property
+    def build_tarball_name(self) -> str:
+        """
+        The name of the Spark distribution built from git. Builds are keyed by
+        commit and Hadoop profile so they can be cached and reused.
+        """
+        return 'spark-{commit}-hadoop{hadoop_short_version}.tgz'.format(
+            commit=self.git_commit,
+            hadoop_short_version=SPARK_BUILD_HADOOP_SHORT_VERSION)
+
+    def _build_from_git(self, *, ssh_client: paramiko.client.SSHClient):
+        """
+        Build Spark once on the master.
+
+        The resulting distribution tarball is left in the master's build cache
+        so the slaves can fetch it from there instead of building Spark
+        themselves.
+
+        If git_build_cache is set, then we also keep a copy of the tarball in
+        the local cache, and reuse it instead of building Spark when we launch
+        a cluster at the same commit again. Downloading the tarball takes a
+        while, so this is off by default. A cluster launched from a cached build
+        has no build tree on the master until rebuild() sets one up.
+        """
+        host = ssh_client.get_transport().getpeername()[0]
+        tarball_path = posixpath.join(SPARK_BUILD_CACHE_DIR, self.build_tarball_name)
+        local_tarball_path = os.path.join(get_cache_dir(), self.build_tarball_name)
+
+        ssh_check_output(
+            client=ssh_client,
+            command="mkdir -p {d}".format(d=shlex.quote(SPARK_BUILD_CACHE_DIR)))
+
+        if self.git_build_cache and os.path.isfile(local_tarball_path):
+            logger.info("[{h}] Uploading cached Spark build for {c}...".format(
+                h=host, c=self.git_commit))
+            with ssh_client.open_sftp() as sftp:
+                sftp.put(
+                    localpath=local_tarball_path,
+                    remotepath=tarball_path + '.part')
             ssh_check_output(
                 client=ssh_client,
-                command="""
-                    set -e
-                    sudo yum install -y git
-                    sudo yum install -y java-devel
-                    """)
+                command="mv {p}.part {p}".format(p=shlex.quote(tarball_path)))
+        else:
+            logger.info("[{h}] Building Spark at {c}...".format(
+                h=host, c=self.git_commit))
             ssh_check_output(
                 client=ssh_client,
                 command="""
                     set -e
-                    git clone {repo} spark
-                    cd spark
-                    git reset --hard {commit}
+                    tarball="$HOME"/{tarball}
+                    # Let the slaves waiting on this build know if it fails.
+                    trap 'touch "$tarball.failed"' ERR
+
+                    {build_tree_command}
+
                     if [ -e "make-distribution.sh" ]; then
-                        ./make-distribution.sh -Phadoop-{hadoop_short_version}
+                        ./make-distribution.sh --tgz --name flintrock -Phadoop-{hadoop_short_version}
                     else
-                        ./dev/make-distribution.sh -Phadoop-{hadoop_short_version}
+                        ./dev/make-distribution.sh --tgz --name flintrock -Phadoop-{hadoop_short_version}
                     fi
+                    mv spark-*-bin-flintrock.tgz "$tarball"
                 """.format(
-                    repo=shlex.quote(self.git_repository),
-                    commit=shlex.quote(self.git_commit),
-                    # Hardcoding this here until we figure out a better way to handle
-                    # the supported build profiles.
-                    hadoop_short_version='2.7',
+                    tarball=shlex.quote(tarball_path),
+                    build_tree_command=get_spark_build_tree_command(
+                        git_repository=self.git_repository,
+                        git_commit=self.git_commit),
+                    hadoop_short_version=SPARK_BUILD_HADOOP_SHORT_VERSION,
                 ))
+
+            if self.git_build_cache:
+                logger.info("[{h}] Caching Spark build for {c} locally...".format(
+                    h=host, c=self.git_commit))
+                with ssh_client.open_sftp() as sftp:
+                    sftp.get(
+                        remotepath=tarball_path,
+                        localpath=local_tarball_path + '.part')
+                os.replace(local_tarball_path + '.part', local_tarball_path)
+
         ssh_check_output(
             client=ssh_client,
             command="""
                 set -e
-                for f in $(find spark/bin -type f -executable -not -name '*.cmd'); do
-                    sudo ln -s "$(pwd)/$f" "/usr/local/bin/$(basename $f)"
+                mkdir -p spark
+                tar xzf {tarball} -C spark --strip-components=1
+            """.format(tarball=shlex.quote(tarball_path)))
+
+    def _install_from_master_build(
+            self,
+            *,
+            ssh_client: paramiko.client.SSHClient,
+            cluster: FlintrockCluster):
+        """
+        Wait for the master to finish building Spark, then copy the build over
+        the intra-cluster network and unpack it.
+        """
+        ssh_check_output(
+            client=ssh_client,
+            command="""
+                set -e
+                ssh_opts="-o StrictHostKeyChecking=no -o BatchMode=yes -o ConnectTimeout=5"
+                tarball={tarball}
+
+                waited=0
+                while true; do
+                    build_status="$(
+                        ssh $ssh_opts {master} "
+                            if [ -f '$tarball' ]; then
+                                echo ready
+                            elif [ -f '$tarball.failed' ]; then
+                                echo failed
+                            fi
+                        " || true
+                    )"
+                    if [ "$build_status" = "ready" ]; then
+                        break
+                    elif [ "$build_status" = "failed" ]; then
+                        echo "The Spark build on the master failed." >&2
+                        exit 1
+                    elif [ "$waited" -ge {timeout} ]; then
+                        echo "Timed out waiting for the Spark build on the master." >&2
+                        exit 1
+                    fi
+                    sleep 10
+                    waited=$((waited + 10))
                 done
-                echo "export SPARK_HOME='$(pwd)/spark'" >> .bashrc
-            """)
+
+                mkdir -p {cache_dir}
+                scp $ssh_opts {master}:"$tarball" "$tarball"
+                mkdir -p spark
+                tar xzf "$tarball" -C spark --strip-components=1
+            """.format(
+                master=shlex.quote(cluster.master_private_host),
+                tarball=shlex.quote(posixpath.join(SPARK_BUILD_CACHE_DIR, self.build_tarball_name)),
+                cache_dir=shlex.quote(SPARK_BUILD_CACHE_DIR),
+                timeout=SPARK_BUILD_TIMEOUT_SECONDS,
+            ))
+
+    def rebuild(self, *, ssh_client: paramiko.client.SSHClient, git_commit: str):
+        """
+        Incrementally rebuild Spark at a new commit in the existing build tree on
+        the master. This reuses the warm Maven, Zinc, and ~/.m2 caches left over
+        from the initial build.
+
+        If the master has no build tree, as when the cluster was launched from
+        a cached build, then we set one up and do a full build instead.
+        """
+        host = ssh_client.get_transport().getpeername()[0]
+
+        has_build_tree = ssh_check_output(
+            client=ssh_client,
+            command="[ -d {source_dir}/.git ] && echo yes || true".format(
+                source_dir=shlex.quote(SPARK_BUILD_SOURCE_DIR)))
+        if has_build_tree.strip() == 'yes':
+            logger.info("[{h}] Rebuilding Spark at {c}...".format(h=host, c=git_commit))
+        else:
+            logger.info(
+                "[{h}] No Spark build tree found. Setting one up and building Spark "
+                "at {c}. This first build takes a while...".format(h=host, c=git_commit))
+
+        ssh_check_output(
+            client=ssh_client,
+            command="""
+                {build_tree_command}
+                ./build/mvn -DskipTests -Phadoop-{hadoop_short_version} package
+            """.format(
+                build_tree_command=get_spark_build_tree_command(
+                    git_repository=self.git_repository,
+                    git_commit=git_commit),
+                hadoop_short_version=SPARK_BUILD_HADOOP_SHORT_VERSION,
+            ))
+
+        self.git_commit = git_commit
+        self.manifest['git_commit'] = git_commit
+
+    def get_jar_hashes(
+            self,
+            *,
+            ssh_client: paramiko.client.SSHClient,
+            build: bool=False) -> dict:
+        """
+        Get a mapping of jar names to SHA-256 hashes for the Spark jars installed
+        on a node, or for the jars in the master's build tree if build is True.
+        """
+        output = ssh_check_output(
+            client=ssh_client,
+            command="""
+                set -e
+                cd {jars_dir}
+                sha256sum *.jar
+            """.format(
+                jars_dir=(
+                    SPARK_BUILD_SOURCE_DIR + '/assembly/target/scala-*/jars'
+                    if build else 'spark/jars')))
+
+        jar_hashes = {}
+        for line in output.splitlines():
+            jar_hash, name = line.split(maxsplit=1)
+            jar_hashes[name.strip()] = jar_hash
+        return jar_hashes
+
+    def distribute_jars(
+            self,
+            *,
+            ssh_client: paramiko.client.SSHClient,
+            cluster: FlintrockCluster,
+            jar_updates: dict):
+        """
+        Push rebuilt jars from the master's build tree out to the nodes.
+
+        jar_updates maps a node's private host to a pair of lists: the jars that
+        changed and must be copied over, and the stale jars that must be removed.
+        The master updates itself from its build tree and copies to the slaves
+        in parallel over the intra-cluster network.
+        """
+        commands = []
+        for batch_start in range(0, len(jar_updates), SPARK_JAR_COPY_PARALLELISM):
+            batch = sorted(jar_updates.items())[
+                batch_start:batch_start + SPARK_JAR_COPY_PARALLELISM]
+            for private_host, (changed_jars, stale_jars) in batch:
+                steps = []
+                if private_host == cluster.master_private_host:
+                    if changed_jars:
+                        steps.append('cp {jars} spark/jars/'.format(
+                            jars=' '.join(
+                                '"$build_jars_dir"/' + shlex.quote(jar)
+                                for jar in changed_jars)))
+                    if stale_jars:
+                        steps.append('rm -f {jars}'.format(
+                            jars=' '.join(
+                                'spark/jars/' + shlex.quote(jar)
+                                for jar in stale_jars)))
+                else:
+                    if changed_jars:
+                        steps.append('scp $ssh_opts {jars} {h}:spark/jars/'.format(
+                            jars=' '.join(
+                                '"$build_jars_dir"/' + shlex.quote(jar)
+                                for jar in changed_jars),
+                            h=shlex.quote(private_host)))
+                    if stale_jars:
+                        steps.append('ssh $ssh_opts {h} {c}'.format(
+                            h=shlex.quote(private_host),
+                            c=shlex.quote('rm -f ' + ' '.join(
+                                'spark/jars/' + shlex.quote(jar)
+                                for jar in stale_jars))))
+                commands.append('( {steps} ) & pids+=($!)'.format(
+                    steps=' && '.join(steps)))
+            commands.append('for pid in "${pids[@]}"; do wait "$pid" || failed=1; done')
+            commands.append('pids=()')
+
+        if not commands:
+            return
+
+        logger.info("Pushing updated Spark jars to {n} node{s}...".format(
+            n=len(jar_updates),
+            s='' if len(jar_updates) == 1 else 's'))
+
+        ssh_check_output(
+            client=ssh_client,
+            command="""
+                ssh_opts="-o StrictHostKeyChecking=no -o BatchMode=yes -o ConnectTimeout=5"
+                build_jars_dir="$(echo {source_dir}/assembly/target/scala-*/jars)"
+                failed=0
+                pids=()
+                {commands}
+                exit "$failed"
+            """.format(
+                source_dir=shlex.quote(SPARK_BUILD_SOURCE_DIR),
+                commands='\n'.join(commands)))
+
+    def restart_master(
+            self,
+            ssh_client: paramiko.client.SSHClient,
+            cluster: FlintrockCluster):
+        """
+        Stop the Spark master and slaves, then start them back up again.
+        """
+        ssh_check_output(
+            client=ssh_client,
+            command="spark/sbin/stop-all.sh")
+        self.configure_master(
+            ssh_client=ssh_client,
+            cluster=cluster)
 
     def configure(
             self,
@@ -372,6 +695,7 @@ class Spark(FlintrockService):
             client=ssh_client,
             command="mkdir -p spark/conf",
         )
+        node_resources = get_node_resources(ssh_client=ssh_client)
 
         for template_path in template_paths:
             ssh_check_output(
@@ -387,6 +711,7 @@ class Spark(FlintrockService):
                                 spark_executor_instances=self.spark_executor_instances,
                                 hadoop_version=self.hadoop_version,
                                 spark_version=self.version or self.git_commit,
+                                node_resources=node_resources,
                             ))),
                     p=shlex.quote(template_path)))
 
@@ -1,5 +1,7 @@
 import errno
 import os
+import posixpath
+import shlex
 import socket
 import subprocess
 import tempfile
@@ -11,11 +13,18 @@ from collections import namedtuple
 import paramiko
 
 # Flintrock modules
-from .util import get_subprocess_env
+from .util import get_file_sha256, get_subprocess_env, is_compressible
 from .exceptions import SSHError
 
 SSHKeyPair = namedtuple('KeyPair', ['public', 'private'])
 
+# A large SFTP channel window lets many pipelined write requests be in flight
+# at once, which is what keeps throughput up on high-latency links.
+SFTP_WINDOW_SIZE = 64 * 1024 * 1024
+SFTP_MAX_PACKET_SIZE = 32 * 1024
+SFTP_UPLOAD_CHUNK_SIZE = 1024 * 1024
+SFTP_UPLOAD_MAX_RETRIES = 5
+
 
 logger = logging.getLogger('flintrock.ssh')
 
@@ -53,10 +62,13 @@ def get_ssh_client(
         host: str,
         identity_file: str,
         wait: bool=False,
-        print_status: bool=None) -> paramiko.client.SSHClient:
+        print_status: bool=None,
+        compress: bool=False) -> paramiko.client.SSHClient:
     """
     Get an SSH client for the provided host, waiting as necessary for SSH to become
     available.
+
+    If compress is True, then ask for zlib compression on the connection.
     """
     if print_status is None:
         print_status = wait
@@ -81,7 +93,8 @@ def get_ssh_client(
                 hostname=host,
                 key_filename=identity_file,
                 look_for_keys=False,
-                timeout=3)
+                timeout=3,
+                compress=compress)
             if print_status:
                 logger.info("[{h}] SSH online.".format(h=host))
             break
@@ -147,6 +160,152 @@ def ssh_check_output(
     return stdout_output
 
 
+def ssh_check_output_with_input(
+        client: paramiko.client.SSHClient,
+        command: str,
+        write_input,
+):
+    """
+    Run a command via the provided SSH client, stream input to it, and return
+    the output captured on stdout.
+
+    write_input is called with a writable file-like object connected to the
+    command's stdin, which is closed once write_input returns. The command
+    should not produce much output before it has consumed all of its input.
+
+    Raise an exception if the command returns a non-zero code.
+    """
+    # No pty here, since a pty would mangle binary input.
+    stdin, stdout, stderr = client.exec_command(command)
+
+    write_input(stdin)
+    stdin.flush()
+    stdin.channel.shutdown_write()
+
+    stdout_output = stdout.read().decode('utf8').rstrip('\n')
+    stderr_output = stderr.read().decode('utf8').rstrip('\n')
+    exit_status = stdout.channel.recv_exit_status()
+
+    if exit_status:
+        raise SSHError(
+            host=client.get_transport().getpeername()[0],
+            message=stdout_output + stderr_output)
+
+    return stdout_output
+
+
+def get_remote_sha256(
+        client: paramiko.client.SSHClient,
+        path: str,
+        size: int=None) -> str:
+    """
+    Get the SHA-256 digest of a remote file, or of just its first size bytes.
+    """
+    if size is None:
+        command = "sha256sum {p}".format(p=shlex.quote(path))
+    else:
+        command = "head -c {s} {p} | sha256sum".format(s=size, p=shlex.quote(path))
+    return ssh_check_output(client=client, command=command).split()[0]
+
+
+def upload_file(
+        *,
+        user: str,
+        host: str,
+        identity_file: str,
+        local_path: str,
+        remote_path: str,
+        sha256: str=None,
+        compress: bool=False):
+    """
+    Upload a file via SFTP and verify it on the remote end.
+
+    The upload goes to a .part file next to the destination with many write
+    requests pipelined over a large channel window. If the connection drops,
+    we reconnect and resume from the end of the partial upload, once its
+    prefix checks out against the local file. The finished upload must match
+    the local SHA-256 digest before it is moved into place.
+
+    sha256 is the local file's digest, if it's already known.
+
+    A remote_path ending in / is taken to be a directory to upload the file
+    into.
+
+    If compress is True, then the connection is compressed, unless a sample of
+    the file suggests it is already compressed.
+    """
+    if remote_path.endswith('/'):
+        remote_path = posixpath.join(remote_path, os.path.basename(local_path))
+
+    if sha256 is None:
+        sha256 = get_file_sha256(local_path)
+
+    if compress and not is_compressible(local_path):
+        logger.debug("[{h}] Not compressing upload of incompressible file.".format(h=host))
+        compress = False
+
+    part_path = remote_path + '.part'
+    file_size = os.path.getsize(local_path)
+    retries = 0
+
+    while True:
+        try:
+            ssh_client = get_ssh_client(
+                user=user,
+                host=host,
+                identity_file=identity_file,
+                compress=compress)
+            with ssh_client:
+                sftp = paramiko.SFTPClient.from_transport(
+                    ssh_client.get_transport(),
+                    window_size=SFTP_WINDOW_SIZE,
+                    max_packet_size=SFTP_MAX_PACKET_SIZE)
+                with sftp:
+                    try:
+                        offset = sftp.stat(part_path).st_size
+                    except FileNotFoundError:
+                        offset = 0
+
+                    if offset > file_size:
+                        offset = 0
+                    elif offset:
+                        remote_prefix_sha256 = get_remote_sha256(ssh_client, part_path, size=offset)
+                        if remote_prefix_sha256 != get_file_sha256(local_path, size=offset):
+                            offset = 0
+                    if offset:
+                        logger.info("[{h}] Resuming upload at byte {o}.".format(h=host, o=offset))
+
+                    with open(local_path, 'rb') as local_file, \
+                            sftp.open(part_path, 'r+b' if offset else 'wb') as remote_file:
+                        remote_file.set_pipelined(True)
+                        local_file.seek(offset)
+                        remote_file.seek(offset)
+                        for chunk in iter(lambda: local_file.read(SFTP_UPLOAD_CHUNK_SIZE), b''):
+                            remote_file.write(chunk)
+
+                    remote_sha256 = get_remote_sha256(ssh_client, part_path)
+                    if remote_sha256 != sha256:
+                        sftp.remove(part_path)
+                        raise SSHError(
+                            host=host,
+                            message="Checksum mismatch after uploading {f}. "
+                                    "Expected SHA-256 {e}, got {a}.".format(
+                                        f=posixpath.basename(remote_path),
+                                        e=sha256,
+                                        a=remote_sha256))
+
+                    sftp.posix_rename(part_path, remote_path)
+            return
+        except (OSError, EOFError, paramiko.ssh_exception.SSHException) as e:
+            if retries >= SFTP_UPLOAD_MAX_RETRIES:
+                raise
+            retries += 1
+            logger.warning(
+                "[{h}] Upload interrupted: {e} Retrying ({r}/{m})..."
+                .format(h=host, e=e, r=retries, m=SFTP_UPLOAD_MAX_RETRIES))
+            time.sleep(min(2 ** retries, 30))
+
+
 def ssh(*, user: str, host: str, identity_file: str):
     """
     SSH into a host for interactive use.
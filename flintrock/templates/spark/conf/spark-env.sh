@@ -3,9 +3,12 @@
 export SPARK_LOCAL_DIRS="{spark_root_ephemeral_dirs}"
 
 # Standalone cluster options
+# These are sized for this node, which may be of a different instance type
+# than the rest of the cluster.
 export SPARK_EXECUTOR_INSTANCES="{spark_executor_instances}"
-export SPARK_EXECUTOR_CORES="$(($(nproc) / {spark_executor_instances}))"
-export SPARK_WORKER_CORES="$(nproc)"
+export SPARK_EXECUTOR_CORES="{spark_executor_cores}"
+export SPARK_WORKER_CORES="{spark_worker_cores}"
+export SPARK_WORKER_MEMORY="{spark_worker_memory}"
 
 export SPARK_MASTER_HOST="{master_private_host}"
 
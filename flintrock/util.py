@@ -1,10 +1,20 @@
+import hashlib
+import json
 import os
 import sys
+import threading
+import time
+import zlib
 from datetime import timedelta
 from decimal import Decimal
 
 FROZEN = getattr(sys, 'frozen', False)
 
+# When this is False, read_cache() always misses, so that every lookup is
+# made afresh (and its result cached again).
+cache_enabled = True
+_cache_lock = threading.Lock()
+
 
 def get_subprocess_env() -> dict:
     """
@@ -20,6 +30,136 @@ def get_subprocess_env() -> dict:
     return env
 
 
+def get_file_sha256(path: str, size: int=None) -> str:
+    """
+    Get the SHA-256 digest of a file, or of just its first size bytes.
+    """
+    hasher = hashlib.sha256()
+    remaining = size
+    with open(path, 'rb') as f:
+        while remaining is None or remaining > 0:
+            chunk = f.read(1024 * 1024 if remaining is None else min(remaining, 1024 * 1024))
+            if not chunk:
+                break
+            hasher.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return hasher.hexdigest()
+
+
+def is_compressible(path: str, *, sample_size: int=64 * 1024, num_samples: int=4) -> bool:
+    """
+    Guess whether compressing a file is worth the CPU time by compressing a
+    few samples from across it. Archives, images, and other files that are
+    already compressed are not worth it.
+    """
+    file_size = os.path.getsize(path)
+    if file_size == 0:
+        return False
+
+    sampled_bytes = 0
+    compressed_bytes = 0
+    with open(path, 'rb') as f:
+        for i in range(num_samples):
+            f.seek(file_size * i // num_samples)
+            sample = f.read(sample_size)
+            sampled_bytes += len(sample)
+            compressed_bytes += len(zlib.compress(sample, 1))
+
+    return compressed_bytes < sampled_bytes * 0.9
+
+
+def get_cache_dir() -> str:
+    """
+    Get the local directory where Flintrock caches build artifacts and other
+    things that are expensive to recreate, creating it if necessary.
+    """
+    cache_home = os.environ.get('XDG_CACHE_HOME')
+    if not cache_home:
+        cache_home = os.path.join(os.path.expanduser('~'), '.cache')
+    cache_dir = os.path.join(cache_home, 'flintrock')
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def get_cache_file() -> str:
+    return os.path.join(get_cache_dir(), 'cache.json')
+
+
+def set_cache_enabled(enabled: bool):
+    global cache_enabled
+    cache_enabled = enabled
+
+
+def read_cache(key: str, *, max_age_seconds: float):
+    """
+    Get a value from Flintrock's local cache, or None if it is missing or
+    older than the given age.
+    """
+    if not cache_enabled:
+        return None
+
+    try:
+        with open(get_cache_file()) as f:
+            entry = json.load(f)[key]
+    except (OSError, ValueError, KeyError):
+        return None
+
+    if time.time() - entry['timestamp'] > max_age_seconds:
+        return None
+    return entry['value']
+
+
+def _update_cache(update):
+    with _cache_lock:
+        _update_cache_file(update)
+
+
+def _update_cache_file(update):
+    cache_file = get_cache_file()
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+
+    update(cache)
+
+    # Write to a temporary file first so concurrent Flintrock invocations
+    # never see a half-written cache.
+    temp_file = '{f}.{p}'.format(f=cache_file, p=os.getpid())
+    with open(temp_file, 'w') as f:
+        json.dump(cache, f, indent=4, sort_keys=True)
+    os.replace(temp_file, cache_file)
+
+
+def write_cache(key: str, value):
+    """
+    Store a JSON-serializable value in Flintrock's local cache.
+    """
+    def update(cache):
+        cache[key] = {'timestamp': time.time(), 'value': value}
+
+    _update_cache(update)
+
+
+def clear_cache(key_prefix: str='') -> int:
+    """
+    Remove the entries whose keys start with key_prefix from Flintrock's local
+    cache, or all of them if no prefix is given. Return how many were removed.
+    """
+    removed_keys = []
+
+    def update(cache):
+        for key in list(cache):
+            if key.startswith(key_prefix):
+                del cache[key]
+                removed_keys.append(key)
+
+    _update_cache(update)
+    return len(removed_keys)
+
+
 def duration_to_timedelta(duration_string):
     """
     Convert a time duration string (e.g. 3h 4m 10s) into a timedelta
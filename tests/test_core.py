@@ -1,11 +1,43 @@
+import hashlib
+import io
 import os
+import random
+import subprocess
+import tarfile
+import zlib
+from datetime import datetime
+from unittest import mock
+
 import pytest
 
 # Flintrock
+import flintrock.core
+from flintrock.exceptions import Error, SSHError
 from flintrock.core import (
+    CommandResult,
+    NodeResources,
+    copy_file_node,
+    format_command_summary,
+    group_command_results,
+    extract_tar_stream,
+    fetch_node,
+    generate_node_environments,
     generate_template_mapping,
+    get_export_command,
+    get_script_command,
     get_formatted_template,
+    get_broadcast_rounds,
+    get_jar_updates,
+    get_manifest,
+    get_rolling_delta,
+    get_sync_hash_candidates,
+    get_sync_plan,
+    merge_log_lines,
+    parse_log_timestamp,
+    SYNC_DELTA_MIN_SIZE,
 )
+from flintrock.services import Spark
+from flintrock.ssh import SSHKeyPair
 
 FLINTROCK_ROOT_DIR = (
     os.path.dirname(
@@ -30,8 +62,387 @@ def test_templates(dummy_cluster, spark_version):
                     hadoop_version='',
                     spark_version=spark_version,
                     spark_executor_instances=0,
+                    node_resources=NodeResources(cores=2, memory_mb=4096, ephemeral_dirs=[]),
                 )
                 get_formatted_template(
                     path=template_path,
                     mapping=mapping,
                 )
+
+
+def test_node_template_mapping(dummy_cluster):
+    def get_mapping(node_resources):
+        return generate_template_mapping(
+            cluster=dummy_cluster,
+            hadoop_version='3.2.0',
+            spark_version='2.4.5',
+            spark_executor_instances=4,
+            node_resources=node_resources,
+        )
+
+    small_node = get_mapping(NodeResources(cores=2, memory_mb=1800, ephemeral_dirs=[]))
+    assert small_node['spark_worker_cores'] == 2
+    assert small_node['spark_executor_cores'] == 1
+    assert small_node['spark_worker_memory'] == '1024m'
+    assert small_node['hadoop_root_ephemeral_dirs'] == '/media/root/hadoop'
+
+    big_node = get_mapping(NodeResources(
+        cores=32,
+        memory_mb=249856,
+        ephemeral_dirs=['/media/ephemeral0', '/media/ephemeral1']))
+    assert big_node['spark_worker_cores'] == 32
+    assert big_node['spark_executor_cores'] == 8
+    assert big_node['spark_worker_memory'] == '248832m'
+    assert big_node['hadoop_root_ephemeral_dirs'] == '/media/ephemeral0/hadoop,/media/ephemeral1/hadoop'
+
+
+def test_generate_node_environments(dummy_cluster):
+    environments = generate_node_environments(cluster=dummy_cluster)
+
+    assert sorted(environments) == ['10.0.0.1', '10.0.0.2']
+    assert environments['10.0.0.1']['FLINTROCK_ROLE'] == 'master'
+    assert environments['10.0.0.2']['FLINTROCK_ROLE'] == 'slave'
+    assert environments['10.0.0.2']['FLINTROCK_NODE_INDEX'] == '1'
+    assert environments['10.0.0.2']['FLINTROCK_PRIVATE_HOST'] == 'slave1.privatehostname'
+    # Each node lists its own instance store volumes.
+    assert 'FLINTROCK_EPHEMERAL_DIRS' not in environments['10.0.0.2']
+
+    export_command = get_export_command({'B': "it's", 'A': '1'})
+    assert export_command == "export A=1 B='it'\"'\"'s';"
+
+
+@pytest.mark.parametrize('leftover_file', [False, True])
+def test_fetch_node_no_matching_files(monkeypatch, tmpdir, leftover_file):
+    host_dir = tmpdir.join('10.0.0.1')
+    if leftover_file:
+        host_dir.ensure('earlier.log')
+
+    # The node has nothing to send back.
+    stdout = mock.Mock()
+    stdout.read.return_value = b''
+    stdout.channel.recv_exit_status.return_value = 0
+    stderr = io.BytesIO()
+    ssh_client = mock.MagicMock()
+    ssh_client.__enter__.return_value = ssh_client
+    ssh_client.exec_command.return_value = (mock.Mock(), stdout, stderr)
+    monkeypatch.setattr(flintrock.core, 'get_ssh_client', lambda **kwargs: ssh_client)
+
+    fetch_node(
+        user='user',
+        host='10.0.0.1',
+        identity_file='key.pem',
+        remote_glob='logs/*.log',
+        local_dir=str(tmpdir))
+
+    if leftover_file:
+        assert host_dir.join('earlier.log').check()
+    else:
+        assert not host_dir.check()
+
+
+@pytest.mark.parametrize(
+    'remote_path, remote_path_type, expected_remote_path', [
+        ('/tmp/data.csv', 'file', '/tmp/data.csv'),
+        ('/tmp/', 'directory', '/tmp/data.csv'),
+        ('/tmp', 'directory', '/tmp/data.csv'),
+    ])
+def test_copy_file_node(monkeypatch, remote_path, remote_path_type, expected_remote_path):
+    ssh_client = mock.MagicMock()
+    monkeypatch.setattr(flintrock.core, 'get_ssh_client', lambda **kwargs: ssh_client)
+    monkeypatch.setattr(flintrock.core, 'ssh_check_output', lambda client, command: remote_path_type)
+    upload_file = mock.Mock()
+    monkeypatch.setattr(flintrock.core, 'upload_file', upload_file)
+
+    copied_path = copy_file_node(
+        user='user',
+        host='10.0.0.1',
+        identity_file='key.pem',
+        local_path='/home/user/data.csv',
+        remote_path=remote_path)
+
+    assert copied_path == expected_remote_path
+    assert upload_file.call_args[1]['remote_path'] == expected_remote_path
+
+
+def test_copy_file_node_missing_directory(monkeypatch):
+    monkeypatch.setattr(flintrock.core, 'get_ssh_client', lambda **kwargs: mock.MagicMock())
+    monkeypatch.setattr(flintrock.core, 'ssh_check_output', lambda client, command: '')
+    monkeypatch.setattr(flintrock.core, 'upload_file', mock.Mock())
+
+    with pytest.raises(Exception, match="Remote directory does not exist: /missing"):
+        copy_file_node(
+            user='user',
+            host='10.0.0.1',
+            identity_file='key.pem',
+            local_path='/home/user/data.csv',
+            remote_path='/missing/')
+
+
+def test_get_script_command(tmpdir):
+    script_path = str(tmpdir.join('script.sh'))
+    with open(script_path, 'w') as f:
+        f.write('echo "[$FLINTROCK_EPHEMERAL_DIRS]" "$@"\n')
+
+    command = get_script_command(script_path=script_path, args=('a b', "it's"))
+    output = subprocess.check_output(['bash', '-c', ' '.join(command)]).decode()
+
+    # There are no instance store volumes here.
+    assert output == "[] a b it's\n"
+
+
+@pytest.mark.parametrize('num_hosts', [1, 2, 5, 8, 400])
+def test_get_broadcast_rounds(num_hosts):
+    hosts = ['host-{}'.format(i) for i in range(num_hosts)]
+    rounds = get_broadcast_rounds(hosts)
+
+    assert len(rounds) == (num_hosts - 1).bit_length()
+
+    has_file = {hosts[0]}
+    for relays in rounds:
+        targets = [target for source, target in relays]
+        assert len(targets) == len(set(targets))
+        for source, target in relays:
+            assert source in has_file
+            assert target not in has_file
+        has_file.update(targets)
+    assert has_file == set(hosts)
+
+
+def test_get_sync_plan():
+    big = SYNC_DELTA_MIN_SIZE
+    local_manifest = {
+        'unchanged': [10, 100],
+        'new': [10, 100],
+        'touched': [10, 200],
+        'touched-same': [10, 200],
+        'big-changed': [big, 200],
+        'big-grew': [big, 200],
+    }
+    remote_manifest = {
+        'unchanged': [10, 100],
+        'touched': [10, 100],
+        'touched-same': [10, 100],
+        'big-changed': [big, 100],
+        'big-grew': [10, 100],
+        'remote-only': [10, 100],
+    }
+    # Only files that may merely have been touched are worth hashing.
+    assert get_sync_hash_candidates(
+        local_manifest=local_manifest,
+        remote_manifest=remote_manifest) == ['big-changed', 'touched', 'touched-same']
+    assert get_sync_plan(
+        local_manifest=local_manifest,
+        remote_manifest=remote_manifest,
+        matching_files=['touched-same']) == (
+            ['big-grew', 'new', 'touched'],
+            ['big-changed'])
+
+
+def get_signatures(data, block_size):
+    return [
+        [zlib.adler32(data[i:i + block_size]) & 0xffffffff,
+         hashlib.md5(data[i:i + block_size]).hexdigest()]
+        for i in range(0, len(data) - block_size + 1, block_size)
+    ]
+
+
+def apply_delta(ops, *, remote_data, data, block_size):
+    return b''.join(
+        remote_data[op[1] * block_size:(op[1] + 1) * block_size] if op[0] == 'copy'
+        else data[op[1]:op[2]]
+        for op in ops)
+
+
+def test_get_rolling_delta():
+    block_size = 64
+    remote_data = bytes(random.Random(0).getrandbits(8) for _ in range(64 * 100))
+    # Insert, delete, and append bytes so that most blocks are unaligned.
+    data = remote_data[:1000] + b'inserted' + remote_data[1000:5000] + remote_data[5100:] + b'appended'
+
+    ops = get_rolling_delta(
+        data=data,
+        block_size=block_size,
+        signatures=get_signatures(remote_data, block_size),
+        max_literal_bytes=len(data))
+
+    assert apply_delta(ops, remote_data=remote_data, data=data, block_size=block_size) == data
+    literal_bytes = sum(op[2] - op[1] for op in ops if op[0] == 'data')
+    assert literal_bytes < 5 * block_size
+
+    assert get_rolling_delta(
+        data=data,
+        block_size=block_size,
+        signatures=[],
+        max_literal_bytes=len(data) // 2) is None
+
+
+def test_extract_tar_stream(tmpdir):
+    def make_tar(names):
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode='w|gz') as tar:
+            for name in names:
+                info = tarfile.TarInfo(name)
+                info.size = 3
+                tar.addfile(info, io.BytesIO(b'log'))
+        buffer.seek(0)
+        return buffer
+
+    extract_tar_stream(make_tar(['media/logs/stderr']), str(tmpdir))
+    assert tmpdir.join('media', 'logs', 'stderr').read() == 'log'
+
+    with pytest.raises(Error):
+        extract_tar_stream(make_tar(['../escaped']), str(tmpdir))
+    assert not tmpdir.join('..', 'escaped').exists()
+
+
+def test_parse_log_timestamp():
+    assert parse_log_timestamp('20/05/12 14:03:01 INFO Worker: Started') == datetime(2020, 5, 12, 14, 3, 1)
+    assert parse_log_timestamp('2020-05-12 14:03:01,234 INFO DataNode') == datetime(2020, 5, 12, 14, 3, 1)
+    assert parse_log_timestamp('\tat org.apache.spark.Foo(Foo.scala:10)') is None
+
+
+def test_merge_log_lines():
+    log_lines = [
+        ('10.0.0.1', 'worker.out', '20/05/12 14:03:05 ERROR Executor: Boom'),
+        ('10.0.0.1', 'worker.out', '\tat org.apache.spark.Foo(Foo.scala:10)'),
+        ('10.0.0.1', 'worker.out', '20/05/12 14:03:09 INFO Executor: Done'),
+        ('10.0.0.2', 'datanode.log', '2020-05-12 14:03:01,234 INFO DataNode: Up'),
+        ('10.0.0.2', 'datanode.log', '2020-05-12 14:03:07,000 INFO DataNode: Block'),
+    ]
+    assert [line for host, file_name, line in merge_log_lines(log_lines)] == [
+        '2020-05-12 14:03:01,234 INFO DataNode: Up',
+        '20/05/12 14:03:05 ERROR Executor: Boom',
+        '\tat org.apache.spark.Foo(Foo.scala:10)',
+        '2020-05-12 14:03:07,000 INFO DataNode: Block',
+        '20/05/12 14:03:09 INFO Executor: Done',
+    ]
+
+
+def test_command_summary():
+    results = {
+        '10.0.0.1': CommandResult(exit_status=0, output='java 1.8'),
+        '10.0.0.2': CommandResult(exit_status=0, output='java 1.8'),
+        '10.0.0.3': CommandResult(exit_status=0, output='java 1.8'),
+        '10.0.0.4': CommandResult(exit_status=1, output='java: command not found'),
+    }
+    groups = group_command_results(results)
+    assert [hosts for hosts, result in groups] == [
+        ['10.0.0.1', '10.0.0.2', '10.0.0.3'],
+        ['10.0.0.4'],
+    ]
+
+    summary = format_command_summary(groups)
+    assert summary.splitlines()[0] == '3 hosts: OK'
+    assert '1 host: exit status 1' in summary
+    assert '    -java 1.8' in summary
+    assert '    +java: command not found' in summary
+
+    del results['10.0.0.4']
+    assert format_command_summary(group_command_results(results)) == '3 hosts: OK, same output'
+
+
+def test_fetch_job_output(monkeypatch, tmpdir):
+    def fetch_job_output_node(*, user, host, identity_file, job_id, local_dir):
+        if host == '2.2.2.2':
+            raise SSHError(host=host, message="Connection refused.")
+        with open(os.path.join(local_dir, host + '.log'), 'a') as f:
+            f.write('done\n')
+
+    monkeypatch.setattr(flintrock.core, 'fetch_job_output_node', fetch_job_output_node)
+    cluster = flintrock.core.FlintrockCluster(name='test')
+
+    # One unreachable node doesn't stop us from collecting the rest.
+    failed_hosts = cluster.fetch_job_output(
+        user='ec2-user',
+        identity_file='key.pem',
+        job_id='job-1',
+        hosts=['1.1.1.1', '2.2.2.2', '3.3.3.3'],
+        local_dir=str(tmpdir))
+
+    assert failed_hosts == ['2.2.2.2']
+    assert sorted(os.listdir(str(tmpdir))) == ['1.1.1.1.log', '3.3.3.3.log']
+
+
+def test_get_jar_updates():
+    build_jar_hashes = {
+        'spark-core.jar': 'new-core',
+        'spark-sql.jar': 'sql',
+        'spark-new.jar': 'new',
+    }
+    node_jar_hashes = {
+        '1.1.1.1': {
+            'spark-core.jar': 'new-core',
+            'spark-sql.jar': 'sql',
+            'spark-new.jar': 'new',
+        },
+        '2.2.2.2': {
+            'spark-core.jar': 'old-core',
+            'spark-sql.jar': 'sql',
+            'spark-old.jar': 'old',
+        },
+        '3.3.3.3': {},
+    }
+    private_hosts = {
+        '1.1.1.1': 'master.internal',
+        '2.2.2.2': 'slave1.internal',
+        '3.3.3.3': 'slave2.internal',
+    }
+
+    jar_updates = get_jar_updates(
+        build_jar_hashes=build_jar_hashes,
+        node_jar_hashes=node_jar_hashes,
+        private_hosts=private_hosts)
+
+    assert jar_updates == {
+        'slave1.internal': (['spark-core.jar', 'spark-new.jar'], ['spark-old.jar']),
+        'slave2.internal': (['spark-core.jar', 'spark-new.jar', 'spark-sql.jar'], []),
+    }
+
+
+def test_rebuild_spark_manifest(monkeypatch):
+    ssh_check_output = mock.Mock(return_value='')
+    monkeypatch.setattr('flintrock.services.ssh_check_output', ssh_check_output)
+    ssh_client = mock.Mock()
+    ssh_client.get_transport.return_value.getpeername.return_value = ('1.1.1.1', 22)
+
+    spark = Spark(
+        spark_executor_instances=1,
+        hadoop_version='2.7.7',
+        git_commit='old-commit',
+        git_repository='https://github.com/apache/spark')
+    ssh_key_pair = SSHKeyPair(public='public', private='private')
+
+    spark.rebuild(ssh_client=ssh_client, git_commit='new-commit')
+
+    rebuild_command = ssh_check_output.call_args[1]['command']
+    assert 'git reset --hard new-commit' in rebuild_command
+    # A cluster launched from a cached build has no build tree to start from.
+    assert 'git clone https://github.com/apache/spark spark-source' in rebuild_command
+    assert 'sudo yum install -y git java-devel' in rebuild_command
+
+    manifest = get_manifest(services=[spark], ssh_key_pair=ssh_key_pair)
+    assert manifest['ssh_key_pair'] == {'public': 'public', 'private': 'private'}
+    [[service_name, service_manifest]] = manifest['services']
+    assert service_name == 'Spark'
+    assert service_manifest['git_commit'] == 'new-commit'
+
+    restored_spark = Spark(**service_manifest)
+    assert restored_spark.git_commit == 'new-commit'
+    assert restored_spark.git_repository == 'https://github.com/apache/spark'
+
+
+def test_get_spark_jar_hashes(monkeypatch):
+    monkeypatch.setattr(
+        'flintrock.services.ssh_check_output',
+        mock.Mock(return_value=(
+            'aaa  spark-core_2.12-3.0.0.jar\n'
+            'bbb  spark-sql_2.12-3.0.0.jar\n')))
+    spark = Spark(
+        spark_executor_instances=1,
+        hadoop_version='2.7.7',
+        version='3.0.0')
+
+    assert spark.get_jar_hashes(ssh_client=None) == {
+        'spark-core_2.12-3.0.0.jar': 'aaa',
+        'spark-sql_2.12-3.0.0.jar': 'bbb',
+    }
@@ -1,6 +1,29 @@
+import time
+
+import boto3
+import botocore
 import pytest
 import click
-from flintrock.ec2 import validate_tags
+from botocore.stub import Stubber
+
+import flintrock.ec2
+from flintrock.exceptions import Error, InterruptedEC2Operation
+from flintrock.ec2 import (
+    EC2Cluster,
+    LAUNCH_TEMPLATE_TAG,
+    TokenBucket,
+    get_launch_template_changes,
+    get_launch_template_data,
+    get_security_group_rule_changes,
+    validate_tags,
+    _create_instances,
+    _delete_security_group,
+    get_launch_overrides,
+    _tag_instances,
+    _terminate_instances,
+    _wait_for_instances,
+)
+from flintrock.services import SecurityGroupRule
 
 
 def test_validate_tags():
@@ -30,3 +53,446 @@ def test_validate_tags():
     for test_case in negative_test_cases:
         with pytest.raises(click.BadParameter):
             validate_tags(test_case)
+
+
+def test_wait_for_instances(monkeypatch):
+    monkeypatch.setattr(time, 'sleep', lambda seconds: None)
+    monkeypatch.setattr(flintrock.ec2, 'EC2_MAX_FILTER_VALUES', 2)
+
+    ec2 = boto3.resource(service_name='ec2', region_name='us-east-1')
+    instances = []
+    for instance_id in ['i-1', 'i-2', 'i-3']:
+        instance = ec2.Instance(instance_id)
+        instance.meta.data = {'InstanceId': instance_id, 'State': {'Code': 0, 'Name': 'pending'}}
+        instances.append(instance)
+
+    def describe_response(states):
+        return {'Reservations': [{'Instances': [
+            {'InstanceId': instance_id, 'State': {'Code': 0, 'Name': state}}
+            for instance_id, state in states.items()]}]}
+
+    def describe_params(instance_ids):
+        return {'Filters': [{'Name': 'instance-id', 'Values': instance_ids}]}
+
+    client = boto3.client(service_name='ec2', region_name='us-east-1')
+    with Stubber(client) as stubber:
+        # The first poll is split into two batches.
+        stubber.add_response(
+            'describe_instances', describe_response({'i-1': 'running', 'i-2': 'pending'}),
+            describe_params(['i-1', 'i-2']))
+        stubber.add_response(
+            'describe_instances', describe_response({'i-3': 'running'}),
+            describe_params(['i-3']))
+        # Later polls only ask about instances that aren't ready yet.
+        stubber.add_response(
+            'describe_instances', describe_response({'i-2': 'running'}),
+            describe_params(['i-2']))
+
+        transitions = []
+        _wait_for_instances(
+            client=client,
+            instances=instances,
+            state='running',
+            on_transition=lambda instance, previous_state: transitions.append(
+                (instance.id, previous_state, instance.state['Name'])))
+
+        stubber.assert_no_pending_responses()
+
+    assert transitions == [
+        ('i-1', 'pending', 'running'),
+        ('i-3', 'pending', 'running'),
+        ('i-2', 'pending', 'running')]
+
+
+def test_create_spot_fleet_instances(monkeypatch):
+    ec2 = boto3.resource(service_name='ec2', region_name='us-east-1')
+    monkeypatch.setattr(flintrock.ec2, 'get_ec2_resource', lambda region: ec2)
+
+    launch_overrides = [
+        {'InstanceType': 'm5.large', 'SubnetId': 'subnet-1', 'AvailabilityZone': 'us-east-1a'},
+        {'InstanceType': 'm4.large', 'SubnetId': 'subnet-1', 'AvailabilityZone': 'us-east-1a'},
+    ]
+    fleet_params = {
+        'Type': 'instant',
+        'TargetCapacitySpecification': {
+            'TotalTargetCapacity': 3,
+            'DefaultTargetCapacityType': 'spot'},
+        'SpotOptions': {
+            'AllocationStrategy': 'capacity-optimized'},
+        'LaunchTemplateConfigs': [{
+            'LaunchTemplateSpecification': {
+                'LaunchTemplateId': 'lt-1',
+                'Version': '$Default'},
+            'Overrides': [
+                dict(override, MaxPrice='0.1')
+                for override in launch_overrides]}]}
+
+    def create_instances():
+        return _create_instances(
+            num_instances=3,
+            region='us-east-1',
+            spot_price=0.1,
+            assume_yes=True,
+            launch_template_id='lt-1',
+            launch_overrides=launch_overrides)
+
+    with Stubber(ec2.meta.client) as stubber:
+        stubber.add_response(
+            'create_fleet',
+            {'Instances': [
+                {'InstanceIds': ['i-1', 'i-2'], 'InstanceType': 'm5.large'},
+                {'InstanceIds': ['i-3'], 'InstanceType': 'm4.large'}],
+             'Errors': []},
+            fleet_params)
+        instances = create_instances()
+
+        # Instances that only partly fill the request are handed back for
+        # cleanup.
+        stubber.add_response(
+            'create_fleet',
+            {'Instances': [{'InstanceIds': ['i-4'], 'InstanceType': 'm5.large'}],
+             'Errors': [{'ErrorCode': 'InsufficientInstanceCapacity'}]},
+            fleet_params)
+        with pytest.raises(InterruptedEC2Operation) as excinfo:
+            create_instances()
+
+        stubber.assert_no_pending_responses()
+
+    assert [i.id for i in instances] == ['i-1', 'i-2', 'i-3']
+    assert {i.state['Name'] for i in instances} == {'pending'}
+    assert [i.id for i in excinfo.value.instances] == ['i-4']
+
+
+def test_create_instances_fallback(monkeypatch):
+    ec2 = boto3.resource(service_name='ec2', region_name='us-east-1')
+    monkeypatch.setattr(flintrock.ec2, 'get_ec2_resource', lambda region: ec2)
+
+    launch_template = {'LaunchTemplateId': 'lt-1', 'Version': '$Default'}
+
+    def run_instances_response(instance_ids):
+        return {'Instances': [{'InstanceId': instance_id} for instance_id in instance_ids]}
+
+    with Stubber(ec2.meta.client) as stubber:
+        # Fallback AZs are placed in a subnet of the cluster's own VPC.
+        stubber.add_response(
+            'describe_subnets',
+            {'Subnets': [
+                {'SubnetId': 'subnet-3', 'AvailabilityZone': 'us-east-1b', 'VpcId': 'vpc-1'},
+                {'SubnetId': 'subnet-2', 'AvailabilityZone': 'us-east-1b', 'VpcId': 'vpc-1'}]},
+            {'Filters': [
+                {'Name': 'vpc-id', 'Values': ['vpc-1']},
+                {'Name': 'availability-zone', 'Values': ['us-east-1b']}]})
+        launch_overrides = get_launch_overrides(
+            region='us-east-1',
+            vpc_id='vpc-1',
+            instance_types=['r5.xlarge', 'r4.xlarge'],
+            subnet_id='subnet-1',
+            alternate_availability_zones=['us-east-1b'])
+
+        stubber.add_client_error(
+            'run_instances', 'InsufficientInstanceCapacity',
+            expected_params={
+                'MinCount': 1, 'MaxCount': 4, 'LaunchTemplate': launch_template,
+                'InstanceType': 'r5.xlarge', 'SubnetId': 'subnet-1'})
+        # Whatever capacity there is gets used before falling back again.
+        stubber.add_response(
+            'run_instances', run_instances_response(['i-1', 'i-2']),
+            {'MinCount': 1, 'MaxCount': 4, 'LaunchTemplate': launch_template,
+             'InstanceType': 'r4.xlarge', 'SubnetId': 'subnet-1'})
+        stubber.add_response(
+            'run_instances', run_instances_response(['i-3', 'i-4']),
+            {'MinCount': 1, 'MaxCount': 2, 'LaunchTemplate': launch_template,
+             'InstanceType': 'r5.xlarge', 'SubnetId': 'subnet-2',
+             'Placement': {'AvailabilityZone': 'us-east-1b'}})
+
+        instances = _create_instances(
+            num_instances=4,
+            region='us-east-1',
+            spot_price=None,
+            assume_yes=True,
+            launch_template_id='lt-1',
+            launch_overrides=launch_overrides)
+        stubber.assert_no_pending_responses()
+
+    assert [i.id for i in instances] == ['i-1', 'i-2', 'i-3', 'i-4']
+
+    # An AZ the VPC has no subnet in is rejected before anything launches.
+    with Stubber(ec2.meta.client) as stubber:
+        stubber.add_response('describe_subnets', {'Subnets': []})
+        with pytest.raises(Error):
+            get_launch_overrides(
+                region='us-east-1',
+                vpc_id='vpc-1',
+                instance_types=['r5.xlarge'],
+                subnet_id='subnet-1',
+                alternate_availability_zones=['us-east-1c'])
+
+
+def test_create_spot_instances(monkeypatch):
+    ec2 = boto3.resource(service_name='ec2', region_name='us-east-1')
+    monkeypatch.setattr(flintrock.ec2, 'get_ec2_resource', lambda region: ec2)
+
+    with Stubber(ec2.meta.client) as stubber:
+        # One-time spot instances can't stop, whatever the launch template
+        # says.
+        stubber.add_response(
+            'run_instances',
+            {'Instances': [{'InstanceId': 'i-1'}, {'InstanceId': 'i-2'}]},
+            {'MinCount': 2, 'MaxCount': 2,
+             'LaunchTemplate': {'LaunchTemplateId': 'lt-1', 'Version': '2'},
+             'InstanceType': 'm5.large', 'SubnetId': 'subnet-1',
+             'InstanceMarketOptions': {
+                 'MarketType': 'spot',
+                 'SpotOptions': {'MaxPrice': '0.1', 'SpotInstanceType': 'one-time'}},
+             'InstanceInitiatedShutdownBehavior': 'terminate'})
+        instances = _create_instances(
+            num_instances=2,
+            region='us-east-1',
+            spot_price=0.1,
+            assume_yes=True,
+            launch_template_id='lt-1',
+            launch_template_version='2',
+            launch_overrides=[{'InstanceType': 'm5.large', 'SubnetId': 'subnet-1'}])
+        stubber.assert_no_pending_responses()
+
+    assert [i.id for i in instances] == ['i-1', 'i-2']
+
+
+@pytest.mark.parametrize(
+    'spot_price, shutdown_behavior, expected_changes', [
+        (0.1, 'stop', {'InstanceInitiatedShutdownBehavior': 'terminate'}),
+        (0.1, 'terminate', {}),
+        (None, 'stop', {}),
+    ])
+def test_get_launch_template_changes(spot_price, shutdown_behavior, expected_changes):
+    launch_template_data = {
+        'InstanceType': 'm5.large',
+        'InstanceInitiatedShutdownBehavior': shutdown_behavior,
+    }
+    assert get_launch_template_changes(
+        launch_template_data=launch_template_data,
+        spot_price=spot_price,
+        min_root_ebs_size_gb=30) == expected_changes
+
+
+def test_get_launch_template_changes_root_ebs_size():
+    launch_template_data = {
+        'InstanceType': 'm5.large',
+        'BlockDeviceMappings': [
+            {'DeviceName': '/dev/xvda', 'Ebs': {'VolumeSize': 30, 'VolumeType': 'gp2'}},
+            {'DeviceName': '/dev/sdb', 'VirtualName': 'ephemeral0'},
+        ],
+    }
+
+    assert get_launch_template_changes(
+        launch_template_data=launch_template_data,
+        spot_price=None,
+        min_root_ebs_size_gb=30) == {}
+
+    # A bigger root volume needs a new template version, which gets all the
+    # block device mappings, not just the root one.
+    assert get_launch_template_changes(
+        launch_template_data=launch_template_data,
+        spot_price=None,
+        min_root_ebs_size_gb=100) == {
+            'BlockDeviceMappings': [
+                {'DeviceName': '/dev/xvda', 'Ebs': {'VolumeSize': 100, 'VolumeType': 'gp2'}},
+                {'DeviceName': '/dev/sdb', 'VirtualName': 'ephemeral0'},
+            ]}
+    assert launch_template_data['BlockDeviceMappings'][0]['Ebs']['VolumeSize'] == 30
+
+
+def test_tag_instances(monkeypatch):
+    monkeypatch.setattr(time, 'sleep', lambda seconds: None)
+    ec2 = boto3.resource(service_name='ec2', region_name='us-east-1')
+    monkeypatch.setattr(flintrock.ec2, 'get_ec2_resource', lambda region: ec2)
+
+    tags = [{'Key': 'flintrock-role', 'Value': 'slave'}]
+    params = {'Resources': ['i-1', 'i-2'], 'Tags': tags}
+
+    with Stubber(ec2.meta.client) as stubber:
+        # EC2 may not know about instances it just launched.
+        stubber.add_client_error('create_tags', 'InvalidInstanceID.NotFound', expected_params=params)
+        stubber.add_response('create_tags', {}, params)
+        _tag_instances(
+            region='us-east-1',
+            instances=[ec2.Instance('i-1'), ec2.Instance('i-2')],
+            tags=tags)
+        stubber.assert_no_pending_responses()
+
+
+def test_terminate_instances(monkeypatch):
+    monkeypatch.setattr(flintrock.ec2, 'EC2_MAX_FILTER_VALUES', 2)
+    ec2 = boto3.resource(service_name='ec2', region_name='us-east-1')
+    monkeypatch.setattr(flintrock.ec2, 'get_ec2_resource', lambda region: ec2)
+
+    with Stubber(ec2.meta.client) as stubber:
+        stubber.add_response('terminate_instances', {}, {'InstanceIds': ['i-1', 'i-2']})
+        stubber.add_response('terminate_instances', {}, {'InstanceIds': ['i-3']})
+        _terminate_instances(
+            region='us-east-1',
+            instances=[ec2.Instance('i-1'), ec2.Instance('i-2'), ec2.Instance('i-3')])
+        stubber.assert_no_pending_responses()
+
+
+def test_delete_security_group(monkeypatch):
+    monkeypatch.setattr(time, 'sleep', lambda seconds: None)
+    ec2 = boto3.resource(service_name='ec2', region_name='us-east-1')
+    monkeypatch.setattr(flintrock.ec2, 'get_ec2_resource', lambda region: ec2)
+
+    params = {'GroupId': 'sg-1'}
+    with Stubber(ec2.meta.client) as stubber:
+        # The group's instances take a moment to let go of it.
+        stubber.add_client_error('delete_security_group', 'DependencyViolation', expected_params=params)
+        stubber.add_client_error('delete_security_group', 'DependencyViolation', expected_params=params)
+        stubber.add_response('delete_security_group', {}, params)
+        assert _delete_security_group(region='us-east-1', group_id='sg-1')
+        stubber.assert_no_pending_responses()
+
+    # Running out of time only gets a warning.
+    with Stubber(ec2.meta.client) as stubber:
+        stubber.add_client_error('delete_security_group', 'DependencyViolation', expected_params=params)
+        assert not _delete_security_group(region='us-east-1', group_id='sg-1', timeout_seconds=0)
+
+    with Stubber(ec2.meta.client) as stubber:
+        stubber.add_client_error('delete_security_group', 'InvalidGroup.NotFound', expected_params=params)
+        with pytest.raises(botocore.exceptions.ClientError):
+            _delete_security_group(region='us-east-1', group_id='sg-1')
+
+
+def test_destroy_no_wait(monkeypatch):
+    ec2 = boto3.resource(service_name='ec2', region_name='us-east-1')
+    monkeypatch.setattr(flintrock.ec2, 'get_ec2_resource', lambda region: ec2)
+    monkeypatch.setattr(flintrock.ec2, '_set_instance_security_groups', lambda **kwargs: None)
+    terminated = []
+    monkeypatch.setattr(
+        flintrock.ec2, '_terminate_instances',
+        lambda region, instances: terminated.extend(i.id for i in instances))
+    deleted_templates = []
+    monkeypatch.setattr(
+        flintrock.ec2, 'delete_launch_template',
+        lambda launch_template_id, region: deleted_templates.append(launch_template_id))
+
+    master_instance = ec2.Instance('i-1')
+    master_instance.meta.data = {
+        'InstanceId': 'i-1',
+        'State': {'Name': 'running'},
+        'Tags': [{'Key': LAUNCH_TEMPLATE_TAG, 'Value': 'lt-1'}]}
+    slave_instance = ec2.Instance('i-2')
+    slave_instance.meta.data = {'InstanceId': 'i-2', 'State': {'Name': 'running'}}
+    cluster = EC2Cluster(
+        name='test',
+        region='us-east-1',
+        vpc_id='vpc-1',
+        ssh_key_pair=None,
+        master_instance=master_instance,
+        slave_instances=[slave_instance])
+
+    def wait_for_state(state, **kwargs):
+        raise AssertionError("destroy(wait=False) waited on the instances.")
+
+    monkeypatch.setattr(cluster, 'wait_for_state', wait_for_state)
+
+    with Stubber(ec2.meta.client) as stubber:
+        stubber.add_response(
+            'describe_security_groups',
+            {'SecurityGroups': [{'GroupId': 'sg-base', 'GroupName': 'flintrock'}]})
+        stubber.add_response(
+            'describe_security_groups',
+            {'SecurityGroups': [{'GroupId': 'sg-cluster', 'GroupName': 'flintrock-test'}]})
+        # The cluster group is still in use, but we don't wait around for it.
+        stubber.add_client_error(
+            'delete_security_group', 'DependencyViolation',
+            expected_params={'GroupId': 'sg-cluster'})
+        cluster.destroy(wait=False)
+        stubber.assert_no_pending_responses()
+
+    assert terminated == ['i-1', 'i-2']
+    assert deleted_templates == ['lt-1']
+
+
+def test_token_bucket():
+    now = [0.0]
+
+    def sleep(seconds):
+        now[0] += seconds
+
+    bucket = TokenBucket(max_rate=10, capacity=5, clock=lambda: now[0], sleep=sleep)
+
+    # The initial burst goes through right away.
+    for _ in range(5):
+        bucket.acquire()
+    assert now[0] == 0
+
+    # After that, requests are spaced out at the refill rate.
+    bucket.acquire()
+    assert now[0] == pytest.approx(0.1)
+
+    # Throttling halves the rate, and success brings it back up.
+    bucket.on_throttle()
+    assert bucket.rate == 5
+    bucket.acquire()
+    assert now[0] == pytest.approx(0.3)
+    for _ in range(10):
+        bucket.on_success()
+    assert bucket.rate == 10
+
+    for _ in range(10):
+        bucket.on_throttle()
+    assert bucket.rate == bucket.min_rate
+
+
+def test_get_security_group_rule_changes():
+    ip_permissions = [
+        {
+            'IpProtocol': 'tcp', 'FromPort': 22, 'ToPort': 22,
+            'IpRanges': [{'CidrIp': '1.2.3.4/32'}, {'CidrIp': '5.6.7.8/32'}],
+            'UserIdGroupPairs': [],
+        },
+        {
+            'IpProtocol': '-1',
+            'IpRanges': [],
+            'UserIdGroupPairs': [{'GroupId': 'sg-1', 'UserId': '123'}],
+        },
+    ]
+    rules = [
+        SecurityGroupRule(ip_protocol='tcp', from_port=22, to_port=22, cidr_ip='1.2.3.4/32', src_group=None),
+        SecurityGroupRule(ip_protocol='tcp', from_port=8080, to_port=8081, cidr_ip='1.2.3.4/32', src_group=None),
+        SecurityGroupRule(ip_protocol='tcp', from_port=8080, to_port=8081, cidr_ip='1.2.3.4/32', src_group=None),
+        SecurityGroupRule(ip_protocol='-1', from_port=-1, to_port=-1, cidr_ip=None, src_group='sg-1'),
+    ]
+
+    to_authorize, to_revoke = get_security_group_rule_changes(
+        ip_permissions=ip_permissions,
+        rules=rules)
+
+    assert to_authorize == [
+        {'IpProtocol': 'tcp', 'FromPort': 8080, 'ToPort': 8081, 'IpRanges': [{'CidrIp': '1.2.3.4/32'}]}]
+    assert to_revoke == [
+        {'IpProtocol': 'tcp', 'FromPort': 22, 'ToPort': 22, 'IpRanges': [{'CidrIp': '5.6.7.8/32'}]}]
+
+    to_authorize, to_revoke = get_security_group_rule_changes(ip_permissions=[], rules=rules[3:])
+    assert to_authorize == [
+        {'IpProtocol': '-1', 'FromPort': -1, 'ToPort': -1, 'UserIdGroupPairs': [{'GroupId': 'sg-1'}]}]
+    assert to_revoke == []
+
+
+def test_get_launch_template_data():
+    launch_template_data = get_launch_template_data(
+        ami='ami-1',
+        key_name='key',
+        instance_type='m5.large',
+        block_device_mappings=[],
+        availability_zone='',
+        placement_group='',
+        tenancy='default',
+        security_group_ids=['sg-1'],
+        instance_profile_arn='',
+        ebs_optimized=False,
+        instance_initiated_shutdown_behavior='terminate',
+        user_data='#!/bin/bash\n')
+
+    # Empty settings are left out, since EC2 rejects them in launch templates.
+    assert launch_template_data['Placement'] == {'Tenancy': 'default'}
+    assert 'IamInstanceProfile' not in launch_template_data
+    assert launch_template_data['UserData'] == 'IyEvYmluL2Jhc2gK'
@@ -1,9 +1,15 @@
+import io
+import json
 import os
+import socket
+import urllib.error
+import urllib.request
 
 # External modules
 import pytest
 
 # Flintrock modules
+import flintrock.util
 from flintrock.exceptions import (
     Error,
     UsageError,
@@ -15,7 +21,11 @@ from flintrock.flintrock import (
     mutually_exclusive,
     get_latest_commit,
     validate_download_source,
+    APACHE_DOWNLOADS_URL,
+    rank_mirror_probes,
+    summarize_job_statuses,
 )
+from flintrock.core import JobStatus
 
 
 def test_option_name_to_variable_name_conversions():
@@ -164,3 +174,64 @@ def test_validate_valid_download_source():
 def test_validate_invalid_download_source():
     with pytest.raises(Error):
         validate_download_source("https://www.apache.org/dyn/closer.lua?action=download&filename=hadoop/common/hadoop-2.8.3/hadoop-2.8.3.tar.gz")
+
+
+def test_validate_download_source_mirror_errors(monkeypatch):
+    monkeypatch.setattr(flintrock.util, 'cache_enabled', False)
+    url = "https://www.apache.org/dyn/closer.lua?action=download&filename=hadoop/common/hadoop-0.0.0/hadoop-0.0.0.tar.gz"
+
+    def urlopen(request, timeout):
+        if isinstance(request, str):
+            return io.BytesIO(json.dumps({
+                'preferred': 'http://slow.example.com/',
+                'http': ['http://missing.example.com/'],
+                'path_info': 'hadoop/common/hadoop-0.0.0/hadoop-0.0.0.tar.gz',
+            }).encode())
+        if 'slow' in request.full_url:
+            raise socket.timeout('timed out')
+        raise urllib.error.HTTPError(request.full_url, 404, 'Not Found', {}, None)
+
+    # Slow mirrors time out, but Apache's own server says the release
+    # doesn't exist.
+    monkeypatch.setattr(urllib.request, 'urlopen', urlopen)
+    with pytest.raises(Error):
+        validate_download_source(url)
+
+    def urlopen_no_mirror_list(request, timeout):
+        raise urllib.error.URLError('unreachable')
+
+    monkeypatch.setattr(urllib.request, 'urlopen', urlopen_no_mirror_list)
+    with pytest.raises(Error):
+        validate_download_source(url)
+
+    # The release exists, even if no mirror is fast enough to tell.
+    def urlopen_all_slow(request, timeout):
+        if isinstance(request, str):
+            return urlopen(request, timeout)
+        if request.full_url.startswith(APACHE_DOWNLOADS_URL):
+            return io.BytesIO(b'data')
+        raise socket.timeout('timed out')
+
+    monkeypatch.setattr(urllib.request, 'urlopen', urlopen_all_slow)
+    assert validate_download_source(url) == [
+        APACHE_DOWNLOADS_URL + 'hadoop/common/hadoop-0.0.0/hadoop-0.0.0.tar.gz']
+
+
+def test_rank_mirror_probes():
+    probes = [
+        {'url': 'slow', 'latency': 0.01, 'throughput': 1024 * 1024},
+        {'url': 'distant', 'latency': 2, 'throughput': 100 * 1024 * 1024},
+        {'url': 'fast', 'latency': 0.05, 'throughput': 100 * 1024 * 1024},
+    ]
+    assert rank_mirror_probes(probes) == ['fast', 'distant', 'slow']
+    assert rank_mirror_probes([]) == []
+
+
+def test_summarize_job_statuses():
+    statuses = {
+        'a': JobStatus(state='done', exit_status=0, output_size=10),
+        'b': JobStatus(state='done', exit_status=0, output_size=10),
+        'c': JobStatus(state='running', exit_status=None, output_size=5),
+        'd': JobStatus(state='done', exit_status=2, output_size=7),
+    }
+    assert summarize_job_statuses(statuses) == "2 done (exit 0), 1 done (exit 2), 1 running"
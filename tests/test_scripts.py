@@ -1,10 +1,19 @@
+import hashlib
+import http.server
+import io
+import json
 import os
+import socketserver
 import subprocess
 import sys
 import tempfile
+import threading
+from unittest import mock
 
 import pytest
 
+from flintrock.core import get_rolling_delta, write_sync_patch
+
 
 @pytest.fixture(scope='module')
 def tgz_file(request):
@@ -39,3 +48,225 @@ def test_download_package(python, project_root_dir, tgz_file):
             ],
             check=True,
         )
+
+
+@pytest.mark.skipif(sys.version_info < (3, 5), reason="Python 3.5+ is required")
+@pytest.mark.parametrize('python', ['python', 'python2'])
+def test_download_package_checksum(python, project_root_dir, tgz_file):
+    with open(tgz_file, 'rb') as f:
+        sha512 = hashlib.sha512(f.read()).hexdigest()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        subprocess.run(
+            [
+                python,
+                os.path.join(project_root_dir, 'flintrock/scripts/download-package.py'),
+                'file://' + tgz_file,
+                temp_dir,
+                '--sha512', sha512,
+            ],
+            check=True,
+        )
+        assert os.listdir(temp_dir)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        p = subprocess.run(
+            [
+                python,
+                os.path.join(project_root_dir, 'flintrock/scripts/download-package.py'),
+                'file://' + tgz_file,
+                temp_dir,
+                '--sha512', '0' * 128,
+                '--max-tries', '0',
+            ],
+            stderr=subprocess.PIPE,
+        )
+        assert p.returncode == 1
+        assert b"Checksum mismatch" in p.stderr
+        assert not os.listdir(temp_dir)
+
+
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        data = self.server.data
+        range_header = self.headers.get('Range')
+        if range_header and self.server.support_ranges:
+            start, end = range_header.replace('bytes=', '').split('-')
+            start = int(start)
+            end = int(end) if end else len(data) - 1
+            body = data[start:end + 1]
+            self.server.range_requests.append((start, end))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {s}-{e}/{t}'.format(s=start, e=end, t=len(data)))
+        else:
+            body = data
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture(scope='module')
+def large_tgz_file(request):
+    with tempfile.TemporaryDirectory() as source_dir:
+        with open(os.path.join(source_dir, 'data'), 'wb') as f:
+            f.write(os.urandom(1024 * 1024))
+        tgz_file_name = source_dir + '.tgz'
+        subprocess.run(
+            ['tar', 'czf', tgz_file_name, '-C', source_dir, '.'],
+            check=True,
+        )
+
+    request.addfinalizer(lambda: os.remove(tgz_file_name))
+    return tgz_file_name
+
+
+@pytest.mark.skipif(sys.version_info < (3, 5), reason="Python 3.5+ is required")
+@pytest.mark.parametrize('support_ranges', [True, False])
+def test_download_package_segmented(support_ranges, project_root_dir, large_tgz_file):
+    with open(large_tgz_file, 'rb') as f:
+        data = f.read()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), RangeRequestHandler)
+    server.data = data
+    server.support_ranges = support_ranges
+    server.range_requests = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    try:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            subprocess.run(
+                [
+                    'python',
+                    os.path.join(project_root_dir, 'flintrock/scripts/download-package.py'),
+                    'http://127.0.0.1:{p}/package.tgz'.format(p=server.server_address[1]),
+                    temp_dir,
+                    '--sha512', hashlib.sha512(data).hexdigest(),
+                    '--segments', '4',
+                    '--min-segment-size', str(64 * 1024),
+                ],
+                check=True,
+            )
+            assert os.path.getsize(os.path.join(temp_dir, 'data')) == 1024 * 1024
+            # Spooled segments are cleaned up.
+            assert not [
+                name for name in os.listdir(os.path.dirname(temp_dir))
+                if name.startswith('.download-')]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    if support_ranges:
+        # One probe plus one request per segment.
+        assert len(server.range_requests) == 5
+    else:
+        assert not server.range_requests
+
+
+@pytest.mark.skipif(sys.version_info < (3, 5), reason="Python 3.5+ is required")
+@pytest.mark.parametrize('python', ['python', 'python2'])
+def test_sync_files(python, project_root_dir):
+    script = os.path.join(project_root_dir, 'flintrock/scripts/sync-files.py')
+    block_size = 4096
+    remote_data = os.urandom(block_size * 64)
+    local_data = remote_data[:10000] + b'changed' + remote_data[10100:]
+
+    with tempfile.TemporaryDirectory() as remote_dir, \
+            tempfile.TemporaryDirectory() as local_dir:
+        os.makedirs(os.path.join(remote_dir, 'lib'))
+        with open(os.path.join(remote_dir, 'lib', 'app.jar'), 'wb') as f:
+            f.write(remote_data)
+        local_path = os.path.join(local_dir, 'app.jar')
+        with open(local_path, 'wb') as f:
+            f.write(local_data)
+
+        manifest = json.loads(subprocess.check_output([python, script, 'manifest', remote_dir]).decode())
+        assert manifest == {'lib/app.jar': [len(remote_data), mock.ANY]}
+
+        signatures = json.loads(subprocess.check_output(
+            [python, script, 'signatures', remote_dir],
+            input=json.dumps({'lib/app.jar': block_size, 'missing': block_size}).encode(),
+        ).decode())
+        assert list(signatures) == ['lib/app.jar']
+
+        ops = get_rolling_delta(
+            data=local_data,
+            block_size=block_size,
+            signatures=signatures['lib/app.jar'],
+            max_literal_bytes=len(local_data))
+        patch = io.BytesIO()
+        write_sync_patch(patch, local_path=local_path, path='lib/app.jar', block_size=block_size, ops=ops)
+        assert len(patch.getvalue()) < 3 * block_size
+
+        subprocess.run([python, script, 'patch', remote_dir], input=patch.getvalue(), check=True)
+        with open(os.path.join(remote_dir, 'lib', 'app.jar'), 'rb') as f:
+            assert f.read() == local_data
+        assert int(os.stat(os.path.join(remote_dir, 'lib', 'app.jar')).st_mtime) == int(os.stat(local_path).st_mtime)
+
+
+@pytest.mark.skipif(sys.version_info < (3, 5), reason="Python 3.5+ is required")
+@pytest.mark.parametrize('python', ['python', 'python2'])
+def test_sync_files_match(python, project_root_dir):
+    script = os.path.join(project_root_dir, 'flintrock/scripts/sync-files.py')
+
+    with tempfile.TemporaryDirectory() as remote_dir:
+        for name, data in [('same', b'same'), ('changed', b'old!')]:
+            path = os.path.join(remote_dir, name)
+            with open(path, 'wb') as f:
+                f.write(data)
+            os.utime(path, (100, 100))
+
+        # Identical content with a newer mtime, as after a fresh checkout.
+        matches = json.loads(subprocess.check_output(
+            [python, script, 'match', remote_dir],
+            input=json.dumps({
+                'same': [hashlib.sha256(b'same').hexdigest(), 200],
+                'changed': [hashlib.sha256(b'new!').hexdigest(), 200],
+                'missing': [hashlib.sha256(b'same').hexdigest(), 200],
+            }).encode(),
+        ).decode())
+        assert matches == ['same']
+
+        # Matches take on the local mtime so the next sync skips them outright.
+        assert int(os.stat(os.path.join(remote_dir, 'same')).st_mtime) == 200
+        assert int(os.stat(os.path.join(remote_dir, 'changed')).st_mtime) == 100
+
+
+@pytest.mark.skipif(sys.version_info < (3, 5), reason="Python 3.5+ is required")
+@pytest.mark.parametrize('python', ['python', 'python2'])
+def test_relay_command(python, project_root_dir):
+    with tempfile.TemporaryDirectory() as bin_dir:
+        # Stand in for ssh by running the command locally as the named host.
+        fake_ssh = os.path.join(bin_dir, 'ssh')
+        with open(fake_ssh, 'w') as f:
+            f.write('#!/bin/sh\n'
+                    'while [ "$1" = -o ]; do shift 2; done\n'
+                    'HOST="$1" exec sh -c "$2"\n')
+        os.chmod(fake_ssh, 0o755)
+
+        p = subprocess.run(
+            [python, os.path.join(project_root_dir, 'flintrock/scripts/relay-command.py')],
+            input=json.dumps({
+                'command': 'echo "hello from $HOST $ROLE"; [ "$HOST" != bad ]',
+                'hosts': ['good1', 'bad', 'good2'],
+                'parallelism': 2,
+                'ssh_options': ['-o', 'BatchMode=yes'],
+                'environments': {'good1': {'ROLE': "the master's"}},
+            }).encode(),
+            stdout=subprocess.PIPE,
+            env=dict(os.environ, PATH=bin_dir + os.pathsep + os.environ['PATH']),
+            check=True,
+        )
+
+    messages = [json.loads(line) for line in p.stdout.decode().splitlines()]
+    assert sorted(m['line'] for m in messages if 'line' in m) == [
+        'hello from bad ', "hello from good1 the master's", 'hello from good2 ']
+    assert {m['host']: m['exit_status'] for m in messages if 'exit_status' in m} == {
+        'good1': 0, 'bad': 1, 'good2': 0}
@@ -1,5 +1,15 @@
+import hashlib
+import os
 from datetime import timedelta
-from flintrock.util import duration_to_timedelta
+from flintrock.util import (
+    clear_cache,
+    duration_to_timedelta,
+    get_file_sha256,
+    is_compressible,
+    read_cache,
+    set_cache_enabled,
+    write_cache,
+)
 
 
 def test_duration_to_timedelta():
@@ -8,3 +18,50 @@ def test_duration_to_timedelta():
     assert duration_to_timedelta('4d 2h 1m 5s') == timedelta(days=4, hours=2, minutes=1, seconds=5)
     assert duration_to_timedelta('36h') == timedelta(hours=36)
     assert duration_to_timedelta('7d') == timedelta(days=7)
+
+
+def test_cache(tmpdir, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir))
+
+    assert read_cache('missing', max_age_seconds=60) is None
+
+    write_cache('key', ['value'])
+    write_cache('other-key', 1)
+    assert read_cache('key', max_age_seconds=60) == ['value']
+    assert read_cache('other-key', max_age_seconds=60) == 1
+    assert read_cache('key', max_age_seconds=-1) is None
+
+    set_cache_enabled(False)
+    try:
+        assert read_cache('key', max_age_seconds=60) is None
+    finally:
+        set_cache_enabled(True)
+
+    assert clear_cache('other-') == 1
+    assert read_cache('other-key', max_age_seconds=60) is None
+    assert read_cache('key', max_age_seconds=60) == ['value']
+    assert clear_cache() == 1
+    assert read_cache('key', max_age_seconds=60) is None
+
+
+def test_get_file_sha256(tmpdir):
+    path = tmpdir.join('file')
+    path.write_binary(b'abc' * 1000)
+
+    assert get_file_sha256(str(path)) == hashlib.sha256(b'abc' * 1000).hexdigest()
+    assert get_file_sha256(str(path), size=5) == hashlib.sha256(b'abcab').hexdigest()
+    assert get_file_sha256(str(path), size=0) == hashlib.sha256(b'').hexdigest()
+
+
+def test_is_compressible(tmpdir):
+    text_file = tmpdir.join('log.txt')
+    text_file.write('INFO Starting executor on worker 3\n' * 100000)
+    assert is_compressible(str(text_file))
+
+    random_file = tmpdir.join('archive.gz')
+    random_file.write_binary(os.urandom(1024 * 1024))
+    assert not is_compressible(str(random_file))
+
+    empty_file = tmpdir.join('empty')
+    empty_file.write('')
+    assert not is_compressible(str(empty_file))